@@ -0,0 +1,483 @@
+"""
+文档树
+
+转换器以规则级联（或单遍扫描引擎）逐个文本块生成HTML，两种引擎的输出逐字节一致；
+文档树由TreeBuilder在同一遍转换中根据各文本块的输出建立，只需识别转换器自身生成的标签，
+不需要再用通用的HTML解析器读取输出文件。文档树的节点：
+
+    Element：元素，以__slots__保存标签名、属性及子节点，自闭合元素（<hr />、<img ... />）的子节点为None
+    Markup：不能确定结构的HTML标记原文（str的子类），如文档中未闭合的HTML标签
+    str：文本，保持HTML源码的形式（其中的实体未还原），TextRenderer输出还原后的纯文本
+
+HtmlRenderer由文档树重新生成与转换结果完全相同的HTML，与TextRenderer一样只是文档树的一种访问者；
+文档树可以保存为JsonML格式的JSON（见to_jsonml）或紧凑的二进制格式（见dump_binary）
+
+使用：
+    tree = parser.parse_tree(open('test.md', 'rb'))
+    html = HtmlRenderer().render(tree)  # 与parser.convert的结果相同
+    text = TextRenderer().render(tree)
+    data = dump_binary(tree)
+    assert load_binary(data) == tree
+"""
+
+import re, json, html
+
+
+BLOCK_TAGS = frozenset(('p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ul', 'ol', 'li', 'blockquote', 'pre', 'hr', 'nav'))
+COMPACT_ATTRIBUTE_TAGS = frozenset(('code',))  # 属性写作name="value"的标签，其余标签写作name = "value"
+DOCUMENT = '#document'  # 根节点的标签名
+BINARY_MAGIC = b'MDAST\x01'  # 二进制格式的文件头
+
+
+class Element:
+    """
+    元素节点
+    """
+    __slots__ = ('tag', 'attrs', 'children')
+
+    def __init__(self, tag, attrs=(), children=None):
+        """
+        构造函数，attrs为((属性名, 属性值), ...)，属性值保持HTML源码的形式；children为子节点列表，自闭合元素为None
+        """
+        self.tag = tag
+        self.attrs = attrs if type(attrs) is tuple else tuple(attrs)
+        self.children = children
+
+    def get(self, name, default=None):
+        """
+        返回属性name的值
+        """
+        for key, value in self.attrs:
+            if key == name:
+                return value
+        return default
+
+    def is_block(self):
+        """
+        是否为块级元素
+        """
+        return self.tag in BLOCK_TAGS
+
+    def __eq__(self, other):
+        return (isinstance(other, Element) and self.tag == other.tag and self.attrs == other.attrs
+                and self.children == other.children)
+
+    def __repr__(self):
+        return 'Element(%r, %r, %r)' % (self.tag, self.attrs, self.children)
+
+
+class Markup(str):
+    """
+    不能确定结构的HTML标记原文
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'Markup(%s)' % str.__repr__(self)
+
+
+def start_tag(element):
+    """
+    返回元素的开始标签，格式与转换器生成的标签相同
+    """
+    separator = '="' if element.tag in COMPACT_ATTRIBUTE_TAGS else ' = "'
+    attrs = ''.join(' %s%s%s"' % (name, separator, value) for name, value in element.attrs)
+    return '<%s%s%s>' % (element.tag, attrs, ' /' if element.children is None else '')
+
+
+class TreeBuilder:
+    """
+    由转换器输出的HTML片段建立文档树
+
+    格式与转换器生成的标签相同的开始标签建立元素，与之配对的结束标签结束元素；
+    结束标签与当前元素不配对时，其间未结束的元素还原为Markup开始标签，子节点并入上一层；
+    格式不同的标签（文档中的HTML标签）及找不到开始标签的结束标签保存为Markup。
+    因此任何输入建立的文档树都能由HtmlRenderer还原为原来的HTML
+    """
+    _markup_pattern = re.compile('(<[^<>]*>)')  # split得到文本与标签交替的列表
+    _start_pattern = re.compile(r'<([a-zA-Z][a-zA-Z0-9]*)((?: [a-zA-Z][\w-]*(?: = |=)"[^"]*")*)( /)?>$')
+    _end_pattern = re.compile(r'</([a-zA-Z][a-zA-Z0-9]*)>$')
+    _attr_pattern = re.compile(r' ([a-zA-Z][\w-]*)(?: = |=)"([^"]*)"')
+
+    def __init__(self):
+        self._root = Element(DOCUMENT, (), [])
+        self._stack = [self._root]  # 未结束的元素
+        self._tail = ''  # 上一片段末尾不完整的标签
+        self._tags = {}  # 标签原文 -> 结束标签的标签名，或开始标签的(标签名, 属性, 是否自闭合)，或None（Markup）
+
+    def feed(self, fragment):
+        """
+        加入一个HTML片段，片段可以在任意位置切分
+        """
+        data = self._tail + fragment
+        cut = data.rfind('<')
+        if cut >= 0 and data.find('>', cut) < 0:
+            data, self._tail = data[:cut], data[cut:]
+        else:
+            self._tail = ''
+        parts = self._markup_pattern.split(data)
+        if parts[0]:
+            self._text(parts[0])
+        markup, text = self._markup, self._text
+        for idx in range(1, len(parts), 2):
+            markup(parts[idx])
+            if parts[idx + 1]:
+                text(parts[idx + 1])
+
+    def close(self):
+        """
+        结束文档，返回根节点；仍未结束的元素还原为Markup开始标签
+        """
+        if self._tail:
+            self._text(self._tail)
+            self._tail = ''
+        while len(self._stack) > 1:
+            self._unwind()
+        return self._root
+
+    def _text(self, text):
+        """
+        加入文本，与前面相邻的文本合并
+        """
+        children = self._stack[-1].children
+        if children and type(children[-1]) is str:
+            children[-1] += text
+        else:
+            children.append(text)
+
+    def _classify(self, tag):
+        """
+        识别标签，返回结束标签的标签名、开始标签的(标签名, 属性, 是否自闭合)，格式与转换器生成的标签不同时返回None
+        同一文档中的标签种类很少，结果按标签原文缓存
+        """
+        try:
+            return self._tags[tag]
+        except KeyError:
+            pass
+        kind = None
+        match = self._end_pattern.match(tag)
+        if match is not None:
+            kind = match.group(1)
+        else:
+            match = self._start_pattern.match(tag)
+            if match is not None:
+                element = Element(match.group(1), self._attr_pattern.findall(match.group(2)),
+                                  None if match.group(3) else [])
+                if start_tag(element) == tag:
+                    kind = (element.tag, element.attrs, element.children is None)
+        if len(self._tags) < 4096:
+            self._tags[tag] = kind
+        return kind
+
+    def _markup(self, tag):
+        """
+        加入一个标签
+        """
+        kind = self._classify(tag)
+        stack = self._stack
+        if type(kind) is tuple:
+            name, attrs, void = kind
+            element = Element(name, attrs, None if void else [])
+            stack[-1].children.append(element)
+            if not void:
+                stack.append(element)
+            return
+        if kind is not None:  # 结束标签
+            if stack[-1].tag == kind and len(stack) > 1:
+                stack.pop()
+                return
+            for depth in range(len(stack) - 2, 0, -1):
+                if stack[depth].tag == kind:
+                    while len(stack) - 1 > depth:
+                        self._unwind()
+                    stack.pop()
+                    return
+        stack[-1].children.append(Markup(tag))
+
+    def _unwind(self):
+        """
+        将最内层未结束的元素还原为Markup开始标签，其子节点并入上一层
+        """
+        element = self._stack.pop()
+        children = self._stack[-1].children
+        children.pop()  # 未结束的元素总是上一层的最后一个子节点
+        children.append(Markup(start_tag(element)))
+        for child in element.children:
+            if type(child) is str:
+                self._text(child)
+            else:
+                children.append(child)
+
+
+class Visitor:
+    """
+    文档树的访问者，visit按节点类型调用visit_text、visit_markup或visit_element，
+    元素节点优先调用visit_<标签名>（如visit_h1），子类只需重写关心的方法
+    """
+    def visit(self, node):
+        if type(node) is str:
+            return self.visit_text(node)
+        if isinstance(node, Markup):
+            return self.visit_markup(node)
+        method = getattr(self, 'visit_' + node.tag, None) if node.tag[0] != '#' else None
+        if method is None:
+            return self.visit_element(node)
+        return method(node)
+
+    def visit_children(self, element):
+        """
+        依次访问元素的子节点
+        """
+        for child in element.children or ():
+            self.visit(child)
+
+    def visit_text(self, text):
+        pass
+
+    def visit_markup(self, markup):
+        pass
+
+    def visit_element(self, element):
+        self.visit_children(element)
+
+
+class HtmlRenderer(Visitor):
+    """
+    由文档树生成HTML，与转换器的输出相同
+    """
+    def render(self, node):
+        """
+        返回node（通常是根节点）的HTML
+        """
+        self._pieces = []
+        self.visit(node)
+        pieces, self._pieces = self._pieces, None
+        return ''.join(pieces)
+
+    def visit_text(self, text):
+        self._pieces.append(text)
+
+    def visit_markup(self, markup):
+        self._pieces.append(markup)
+
+    def visit_element(self, element):
+        if element.tag == DOCUMENT:
+            self.visit_children(element)
+            return
+        self._pieces.append(start_tag(element))
+        if element.children is not None:
+            self.visit_children(element)
+            self._pieces.append('</%s>' % element.tag)
+
+
+class TextRenderer(Visitor):
+    """
+    由文档树生成纯文本：文本中的实体还原为字符，标签及HTML标记原文都被忽略
+    """
+    def render(self, node):
+        """
+        返回node的纯文本
+        """
+        self._pieces = []
+        self.visit(node)
+        pieces, self._pieces = self._pieces, None
+        return html.unescape(''.join(pieces))
+
+    def visit_text(self, text):
+        self._pieces.append(text)
+
+
+def to_jsonml(node):
+    """
+    将文档树转换为JsonML：元素为[标签名, {属性}, 子节点...]（没有属性时省略属性对象），
+    自闭合元素以属性对象中的"/": true标记，Markup为["#markup", 原文]，文本为字符串
+    """
+    if type(node) is str:
+        return node
+    if isinstance(node, Markup):
+        return ['#markup', str(node)]
+    item = [node.tag]
+    attrs = dict(node.attrs)
+    if node.children is None:
+        attrs['/'] = True
+    if attrs:
+        item.append(attrs)
+    item.extend(to_jsonml(child) for child in node.children or ())
+    return item
+
+
+def from_jsonml(item):
+    """
+    由JsonML还原文档树，to_jsonml的逆运算
+    """
+    if isinstance(item, str):
+        return item
+    if item[0] == '#markup':
+        return Markup(item[1])
+    children = item[1:]
+    attrs = {}
+    if children and isinstance(children[0], dict):
+        attrs = dict(children[0])
+        children = children[1:]
+    void = attrs.pop('/', False)
+    return Element(item[0], attrs.items(), None if void else [from_jsonml(child) for child in children])
+
+
+def dump_json(node):
+    """
+    返回文档树的JSON（JsonML格式）
+    """
+    return json.dumps(to_jsonml(node), ensure_ascii=False, separators=(',', ':'))
+
+
+def load_json(text):
+    """
+    由dump_json的结果还原文档树
+    """
+    return from_jsonml(json.loads(text))
+
+
+# 二进制格式：文件头之后是前序排列的节点记录，整数均为LEB128变长编码
+#     文本：0, 字符串
+#     Markup：1, 字符串
+#     元素：2, 名称, 属性数, (名称, 字符串)*, 子节点数+1（自闭合元素为0）, 子节点...
+# 字符串为UTF-8字节数及其内容；标签名及属性名（名称）首次出现时写为名称表大小及字符串，此后只写其在名称表中的序号
+_TEXT, _MARKUP, _ELEMENT = 0, 1, 2
+
+
+def _write_uint(out, number):
+    """
+    以LEB128编码写入非负整数
+    """
+    while number >= 0x80:
+        out.append((number & 0x7f) | 0x80)
+        number >>= 7
+    out.append(number)
+
+
+def _write_string(out, text):
+    data = text.encode('utf-8')
+    _write_uint(out, len(data))
+    out += data
+
+
+def _write_name(out, names, name):
+    index = names.get(name)
+    if index is None:
+        index = names[name] = len(names)
+        _write_uint(out, index)
+        _write_string(out, name)
+    else:
+        _write_uint(out, index)
+
+
+def dump_binary(node):
+    """
+    返回文档树的二进制编码（bytes），标签名和属性名只保存一次，文本不转义，通常比JSON小且解码更快
+    """
+    out = bytearray(BINARY_MAGIC)
+    names = {}  # 名称 -> 序号
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if type(node) is str:
+            out.append(_TEXT)
+            _write_string(out, node)
+        elif isinstance(node, Markup):
+            out.append(_MARKUP)
+            _write_string(out, node)
+        else:
+            out.append(_ELEMENT)
+            _write_name(out, names, node.tag)
+            _write_uint(out, len(node.attrs))
+            for name, value in node.attrs:
+                _write_name(out, names, name)
+                _write_string(out, value)
+            if node.children is None:
+                _write_uint(out, 0)
+            else:
+                _write_uint(out, len(node.children) + 1)
+                stack.extend(reversed(node.children))
+    return bytes(out)
+
+
+def _read_uint(data, position):
+    """
+    从position处读取LEB128编码的非负整数，返回(整数, 结束位置)
+    """
+    number = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        number |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return number, position
+        shift += 7
+
+
+def _read_name(data, position, names):
+    """
+    从position处读取名称，返回(名称, 结束位置)，首次出现的名称加入名称表names
+    """
+    index, position = _read_uint(data, position)
+    if index == len(names):
+        size, position = _read_uint(data, position)
+        names.append(data[position:position + size].decode('utf-8'))
+        position += size
+    return names[index], position
+
+
+def load_binary(data):
+    """
+    由dump_binary的结果还原文档树，格式不正确时抛出ValueError
+    """
+    data = bytes(data)
+    if not data.startswith(BINARY_MAGIC):
+        raise ValueError('Not a binary document tree.')
+    position = len(BINARY_MAGIC)
+    names = []
+    root = None
+    pending = []  # [[子节点列表, 尚待读取的子节点数], ...]
+    try:
+        while True:
+            kind = data[position]
+            if kind == _TEXT or kind == _MARKUP:
+                size, position = _read_uint(data, position + 1)
+                node = data[position:position + size].decode('utf-8')
+                position += size
+                if kind == _MARKUP:
+                    node = Markup(node)
+                count = 0
+            elif kind == _ELEMENT:
+                tag, position = _read_name(data, position + 1, names)
+                size, position = _read_uint(data, position)
+                attrs = []
+                for _ in range(size):
+                    name, position = _read_name(data, position, names)
+                    size, position = _read_uint(data, position)
+                    attrs.append((name, data[position:position + size].decode('utf-8')))
+                    position += size
+                count, position = _read_uint(data, position)
+                node = Element(tag, tuple(attrs), None if count == 0 else [])
+                count -= 1
+            else:
+                raise ValueError('Unknown node kind %d in binary document tree.' % kind)
+            if position > len(data):
+                raise IndexError
+            if pending:
+                top = pending[-1]
+                top[0].append(node)
+                top[1] -= 1
+            else:
+                root = node
+            if count > 0:
+                pending.append([node.children, count])
+            while pending and pending[-1][1] == 0:
+                pending.pop()
+            if not pending:
+                break
+    except (IndexError, UnicodeDecodeError):
+        raise ValueError('Truncated or corrupt binary document tree.')
+    if position != len(data):
+        raise ValueError('Trailing data after binary document tree.')
+    return root
@@ -0,0 +1,406 @@
+"""
+性能基准测试
+
+由test目录下的Markdown样例拼接出不同规模的合成文档，测量Parser.parse的端到端吞吐量
+以及各条规则process方法各自的耗时，并可与保存的基准结果比较，吞吐量下降超过容差时报错退出；
+另有一组病态输入，检查单个文本块的转换耗时随块长线性增长，超过允许的增长倍数时报错退出；
+还可以比较两个转换引擎逐块处理的耗时，单遍扫描引擎的加速比低于要求时报错退出
+
+使用：
+    (1). python Benchmark.py  # 测试默认规模（1KB、10KB、100KB、1MB）的文档
+    (2). python Benchmark.py -s 1KB 100MB  # 测试指定规模的文档
+    (3). python Benchmark.py --save baseline.json  # 保存本次结果作为基准
+    (4). python Benchmark.py --baseline baseline.json  # 与基准比较，出现性能退化时返回非零退出码
+    (5). python Benchmark.py --pathological  # 测试病态输入，单位字节耗时随块长明显增长时返回非零退出码
+    (6). python Benchmark.py --engines  # 比较两个转换引擎，单遍扫描引擎的加速比低于--min-speedup时返回非零退出码
+"""
+
+import os, sys, json, glob, time, tempfile, argparse
+from Parser import Parser
+
+
+SIZES = ('1KB', '10KB', '100KB', '1MB')  # 默认的文档规模
+_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+_MIN_TIME = 0.05  # 单次计时的最短时长（秒），小文档重复转换直至达到此时长以降低计时误差
+
+ENGINE_SIZES = ('100KB', '1MB')  # 比较转换引擎的默认规模
+PATHOLOGICAL_SIZES = ('8KB', '16KB', '32KB', '64KB')  # 病态输入的默认规模
+# 病态输入，每项为(名称, 生成不少于指定字节数的单个文本块的函数)
+# 针对回溯次数曾与块长的平方成正比的写法：水平线、Setext标题、Email、自动链接和HTML标签
+PATHOLOGICAL = (
+    ('hr-star', lambda size: '* \n' * (size // 3 + 1)),  # 每行一个星号，不能构成水平线
+    ('hr-dash', lambda size: '- - \n' * (size // 5 + 1)),  # 不能是Setext标题的下划线
+    ('setext-indent', lambda size: ' ' * size + 'x\n-x'),  # 行首的长串空白，下一行以-开头但不是下划线
+    ('email-domain', lambda size: '<a@' + 'a.' * (size // 2 + 1) + '!'),  # 没有结尾>的Email
+    ('autolink-run', lambda size: '<a://' * (size // 5 + 1)),  # 没有>的一串自动链接开头
+    ('html-tag-line', lambda size: '<a' * (size // 2 + 1)),  # 同一行中没有>的一串标签开头
+)
+
+
+def parse_size(text):
+    """
+    将'1KB'、'100MB'等规模字符串转换为字节数
+    """
+    text = text.strip().upper()
+    for unit in sorted(_UNITS, key=len, reverse=True):
+        if text.endswith(unit):
+            try:
+                return int(float(text[:-len(unit)]) * _UNITS[unit])
+            except ValueError:
+                break
+    raise ValueError('Invalid size "%s".' % text)
+
+
+def corpus_blocks(directory):
+    """
+    读取directory下的全部Markdown样例，按文件名顺序返回其中的非空文本块
+    """
+    blocks = []
+    for filename in sorted(glob.glob(os.path.join(directory, '*.md'))):
+        with open(filename, 'r', -1, 'utf-8') as fin:
+            blocks += [block for block in Parser.blocks(fin) if block]
+    if not blocks:
+        raise ValueError('No Markdown samples found in "%s".' % directory)
+    return blocks
+
+
+def write_document(filename, size, blocks):
+    """
+    循环使用样例文本块拼接出不少于size字节的合成文档并写入filename，返回实际字节数
+    文档逐块写入，不在内存中保存完整内容
+    """
+    total = 0
+    with open(filename, 'w', -1, 'utf-8') as fou:
+        while total < size:
+            for block in blocks:
+                data = block + '\n'  # 文本块之间以空行分隔
+                fou.write(data)
+                total += len(data.encode())
+                if total >= size:
+                    break
+    return total
+
+
+def _best_time(func, repeat):
+    """
+    返回func单次执行的最短耗时（秒）
+    每轮计时重复执行func直至耗时不少于_MIN_TIME，共计时repeat轮
+    """
+    best = None
+    for _ in range(max(1, repeat)):
+        number = 0
+        start = time.perf_counter()
+        while True:
+            func()
+            number += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= _MIN_TIME:
+                break
+        if best is None or elapsed / number < best:
+            best = elapsed / number
+    return best
+
+
+def time_parse(parser, inputfile, outputfile, repeat):
+    """
+    测量Parser.parse转换inputfile的端到端耗时
+    """
+    return _best_time(lambda: parser.parse(inputfile, outputfile), repeat)
+
+
+def time_rules(inputfile, repeat):
+    """
+    按规则级联的顺序逐块执行各条规则，分别统计各规则的耗时（包括检查触发条件的耗时）
+    返回(文本块数, 规则名 -> 耗时, 规则名 -> 跳过的文本块数)，各规则取repeat轮中的最短耗时
+    """
+    best = {}
+    count = 0
+    for _ in range(max(1, repeat)):
+        parser = Parser()
+        rules = [(type(rule).__name__, rule, triggered) for rule, triggered in parser._pipeline]
+        timings = dict.fromkeys([name for name, rule, triggered in rules], 0.0)
+        skipped = dict.fromkeys(timings, 0)
+        count = 0
+        clock = time.perf_counter
+        with open(inputfile, 'r', -1, 'utf-8') as fin:
+            for block in Parser.blocks(fin):
+                count += 1
+                for name, rule, triggered in rules:
+                    start = clock()
+                    if triggered is None or triggered(block):
+                        block = rule.process(block)
+                    else:
+                        skipped[name] += 1
+                    timings[name] += clock() - start
+        for name, seconds in timings.items():
+            if name not in best or seconds < best[name]:
+                best[name] = seconds
+    return count, best, skipped
+
+
+def time_engines(inputfile, repeat):
+    """
+    测量两个转换引擎逐块处理inputfile的耗时（Parser._process），不含分块、输出等两者共用的部分
+    每轮使用新的Parser以保证规则状态相同，两个引擎交替计时以减小机器负载变化的影响
+    返回(文本块数, 引擎 -> 耗时)，各引擎取repeat轮中的最短耗时
+    """
+    with open(inputfile, 'r', -1, 'utf-8') as fin:
+        blocks = list(Parser.blocks(fin))
+    best = {}
+    for _ in range(max(1, repeat)):
+        for engine in ('rules', 'tokenizer'):
+            parser = Parser(engine=engine)
+            start = time.perf_counter()
+            for block in blocks:
+                parser._process(block)
+            seconds = time.perf_counter() - start
+            if engine not in best or seconds < best[engine]:
+                best[engine] = seconds
+    return len(blocks), best
+
+
+def _throughput(size, seconds):
+    """
+    返回吞吐量（MB/s）
+    """
+    return size / _UNITS['MB'] / seconds if seconds > 0 else float('inf')
+
+
+def run(sizes, corpus, engine='rules', repeat=3):
+    """
+    对各规模的合成文档执行基准测试，返回可保存为JSON的结果
+    """
+    blocks = corpus_blocks(corpus)
+    parser = Parser(engine=engine)
+    results = {'engine': engine, 'documents': {}}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        inputfile = os.path.join(tmpdir, 'benchmark.md')
+        outputfile = os.path.join(tmpdir, 'benchmark.html')
+        for label in sizes:
+            size = write_document(inputfile, parse_size(label), blocks)
+            seconds = time_parse(parser, inputfile, outputfile, repeat)
+            count, rule_seconds, rule_skipped = time_rules(inputfile, repeat)
+            results['documents'][label] = {
+                'bytes': size,
+                'blocks': count,
+                'seconds': seconds,
+                'mb_per_s': _throughput(size, seconds),
+                'blocks_per_s': count / seconds if seconds > 0 else float('inf'),
+                'rules': dict((name, {'seconds': rule_time, 'mb_per_s': _throughput(size, rule_time),
+                                      'skipped': rule_skipped[name] / count if count else 0.0})
+                              for name, rule_time in rule_seconds.items()),
+            }
+    return results
+
+
+def run_pathological(sizes, engine='rules', repeat=3):
+    """
+    对各病态输入测量不同规模的单个文本块的转换耗时，返回可保存为JSON的结果
+    growth为最大规模与最小规模的单位字节耗时之比，耗时与块长成正比时约为1，与块长的平方成正比时约为规模之比
+    """
+    parser = Parser(engine=engine)
+    results = {'engine': engine, 'pathological': {}}
+    for name, generate in PATHOLOGICAL:
+        timings = {}
+        for label in sizes:
+            block = generate(parse_size(label))
+            seconds = _best_time(lambda: parser.convert(block), repeat)
+            timings[label] = {'bytes': len(block.encode()), 'seconds': seconds}
+        ordered = sorted(timings.values(), key=lambda timing: timing['bytes'])
+        smallest, largest = ordered[0], ordered[-1]
+        growth = ((largest['seconds'] / largest['bytes']) / (smallest['seconds'] / smallest['bytes'])
+                  if smallest['seconds'] > 0 else 1.0)
+        results['pathological'][name] = {'sizes': timings, 'growth': growth}
+    return results
+
+
+def run_engines(sizes, corpus, repeat=3):
+    """
+    对各规模的合成文档比较两个转换引擎，返回可保存为JSON的结果
+    speedup为规则级联与单遍扫描引擎逐块处理的耗时之比；端到端的Parser.parse耗时一并记录，
+    其中分块、输出等共用部分的耗时与引擎无关
+    """
+    blocks = corpus_blocks(corpus)
+    parsers = dict((engine, Parser(engine=engine)) for engine in ('rules', 'tokenizer'))
+    results = {'engines': {}}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        inputfile = os.path.join(tmpdir, 'benchmark.md')
+        outputfile = os.path.join(tmpdir, 'benchmark.html')
+        for label in sizes:
+            size = write_document(inputfile, parse_size(label), blocks)
+            count, block_seconds = time_engines(inputfile, repeat)
+            results['engines'][label] = {
+                'bytes': size,
+                'blocks': count,
+                'block_seconds': block_seconds,
+                'parse_seconds': dict((engine, time_parse(parser, inputfile, outputfile, repeat))
+                                      for engine, parser in parsers.items()),
+                'speedup': (block_seconds['rules'] / block_seconds['tokenizer']
+                            if block_seconds['tokenizer'] > 0 else float('inf')),
+            }
+    return results
+
+
+def report_engines(results, out=sys.stdout):
+    """
+    打印转换引擎的比较结果
+    """
+    for label, doc in results['engines'].items():
+        out.write('%-8s %12d bytes %9d blocks   speedup %5.2fx\n' % (label, doc['bytes'], doc['blocks'], doc['speedup']))
+        for engine in ('rules', 'tokenizer'):
+            blocks, parse = doc['block_seconds'][engine], doc['parse_seconds'][engine]
+            out.write('    %-10s blocks %10.4fs %9.2f MB/s   parse %10.4fs %9.2f MB/s\n'
+                      % (engine, blocks, _throughput(doc['bytes'], blocks), parse, _throughput(doc['bytes'], parse)))
+
+
+def report_pathological(results, out=sys.stdout):
+    """
+    打印病态输入的测试结果
+    """
+    out.write('Engine: %s\n' % results['engine'])
+    for name, case in results['pathological'].items():
+        out.write('%-16s growth %6.2fx\n' % (name, case['growth']))
+        for label, timing in case['sizes'].items():
+            out.write('    %-8s %10d bytes %10.4fs %9.2f MB/s\n'
+                      % (label, timing['bytes'], timing['seconds'], _throughput(timing['bytes'], timing['seconds'])))
+
+
+def report(results, out=sys.stdout):
+    """
+    打印基准测试结果
+    """
+    out.write('Engine: %s\n' % results['engine'])
+    for label, doc in results['documents'].items():
+        out.write('%-8s %12d bytes %9d blocks %10.4fs %9.2f MB/s %12.0f blocks/s\n'
+                  % (label, doc['bytes'], doc['blocks'], doc['seconds'], doc['mb_per_s'], doc['blocks_per_s']))
+        for name, rule in sorted(doc['rules'].items(), key=lambda item: -item[1]['seconds']):
+            out.write('    %-28s %10.4fs %9.2f MB/s %6.1f%% skipped\n'
+                      % (name, rule['seconds'], rule['mb_per_s'], rule.get('skipped', 0.0) * 100))
+
+
+def compare(results, baseline, tolerance):
+    """
+    与基准结果比较，返回性能退化的描述列表
+    吞吐量低于基准的(1 - tolerance)倍即视为退化，只比较两者共有的文档规模和规则；
+    规则的单轮耗时不足_MIN_TIME时计时误差过大，不参与比较
+    """
+    regressions = []
+    if baseline.get('engine') != results['engine']:
+        return ['engine "%s" differs from baseline engine "%s"' % (results['engine'], baseline.get('engine'))]
+
+    def check(what, current, expected):
+        if current < expected * (1 - tolerance):
+            regressions.append('%s: %.2f MB/s, baseline %.2f MB/s (%.0f%% slower)'
+                               % (what, current, expected, (1 - current / expected) * 100))
+
+    for label, doc in results['documents'].items():
+        base = baseline.get('documents', {}).get(label)
+        if base is None:
+            continue
+        check('%s Parser.parse' % label, doc['mb_per_s'], base['mb_per_s'])
+        for name, rule in doc['rules'].items():
+            base_rule = base.get('rules', {}).get(name)
+            if base_rule is not None and base_rule['seconds'] >= _MIN_TIME:
+                check('%s %s.process' % (label, name), rule['mb_per_s'], base_rule['mb_per_s'])
+    return regressions
+
+
+
+if __name__ == '__main__':  # 主程序
+
+    argparser = argparse.ArgumentParser(description='Benchmark the Markdown parser on synthetic documents.')
+    argparser.add_argument('-s', '--sizes', nargs='+', default=list(SIZES),
+                           help='document sizes, e.g. 1KB 10MB (default: %s)' % ' '.join(SIZES))
+    argparser.add_argument('-c', '--corpus', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test'),
+                           help='directory of Markdown samples used to build the documents')
+    argparser.add_argument('-e', '--engine', default='rules', choices=('rules', 'tokenizer'),
+                           help='conversion engine timed by Parser.parse')
+    argparser.add_argument('-r', '--repeat', type=int, default=3, help='number of timing rounds, the best is kept')
+    argparser.add_argument('--save', metavar='FILE', help='save the results as a baseline JSON file')
+    argparser.add_argument('--baseline', metavar='FILE', help='compare the results against a baseline JSON file')
+    argparser.add_argument('--tolerance', type=float, default=0.2,
+                           help='allowed relative throughput loss before failing (default: 0.2)')
+    argparser.add_argument('--pathological', action='store_true',
+                           help='time adversarial single-block inputs instead of documents (default sizes: %s)'
+                                % ' '.join(PATHOLOGICAL_SIZES))
+    argparser.add_argument('--max-growth', type=float, default=2.0,
+                           help='allowed growth of per-byte time from the smallest to the largest pathological '
+                                'input before failing (default: 2.0)')
+    argparser.add_argument('--engines', action='store_true',
+                           help='compare the block processing time of both engines (default sizes: %s)'
+                                % ' '.join(ENGINE_SIZES))
+    argparser.add_argument('--min-speedup', type=float, default=1.2,
+                           help='required speedup of the tokenizer engine over the rule cascade before failing '
+                                '(default: 1.2)')
+    args = argparser.parse_args()
+
+    if args.engines:
+        sizes = args.sizes if args.sizes != list(SIZES) else list(ENGINE_SIZES)
+        try:
+            for label in sizes:
+                parse_size(label)
+            results = run_engines(sizes, args.corpus, args.repeat)
+        except ValueError as error:
+            print('Fatal Error: %s' % error)
+            sys.exit(2)
+        report_engines(results)
+        if args.save:
+            with open(args.save, 'w', -1, 'utf-8') as fou:
+                json.dump(results, fou, indent=2, sort_keys=True)
+            print('Results saved to "%s".' % args.save)
+        slow = [label for label, doc in results['engines'].items() if doc['speedup'] < args.min_speedup]
+        if slow:
+            print('INSUFFICIENT SPEEDUP (below %.2fx): %s' % (args.min_speedup, ', '.join(slow)))
+            sys.exit(1)
+        print('The tokenizer engine is at least %.2fx faster than the rule cascade.' % args.min_speedup)
+        sys.exit(0)
+
+    if args.pathological:
+        sizes = args.sizes if args.sizes != list(SIZES) else list(PATHOLOGICAL_SIZES)
+        try:
+            for label in sizes:
+                parse_size(label)
+        except ValueError as error:
+            print('Fatal Error: %s' % error)
+            sys.exit(2)
+        results = run_pathological(sizes, args.engine, args.repeat)
+        report_pathological(results)
+        if args.save:
+            with open(args.save, 'w', -1, 'utf-8') as fou:
+                json.dump(results, fou, indent=2, sort_keys=True)
+            print('Results saved to "%s".' % args.save)
+        superlinear = [name for name, case in results['pathological'].items() if case['growth'] > args.max_growth]
+        if superlinear:
+            print('SUPERLINEAR TIME (growth above %.1fx): %s' % (args.max_growth, ', '.join(superlinear)))
+            sys.exit(1)
+        print('All pathological inputs scale linearly (growth at most %.1fx).' % args.max_growth)
+        sys.exit(0)
+
+    try:
+        for label in args.sizes:
+            parse_size(label)
+        results = run(args.sizes, args.corpus, args.engine, args.repeat)
+    except ValueError as error:
+        print('Fatal Error: %s' % error)
+        sys.exit(2)
+    report(results)
+
+    if args.save:
+        with open(args.save, 'w', -1, 'utf-8') as fou:
+            json.dump(results, fou, indent=2, sort_keys=True)
+        print('Baseline saved to "%s".' % args.save)
+
+    if args.baseline:
+        try:
+            with open(args.baseline, 'r', -1, 'utf-8') as fin:
+                baseline = json.load(fin)
+        except (OSError, ValueError):
+            print('Fatal Error: Cannot read baseline file "%s".' % args.baseline)
+            sys.exit(2)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('PERFORMANCE REGRESSION against "%s":' % args.baseline)
+            for regression in regressions:
+                print('    ' + regression)
+            sys.exit(1)
+        print('No regression against "%s" (tolerance %.0f%%).' % (args.baseline, args.tolerance * 100))
@@ -0,0 +1,57 @@
+"""
+文本块转换结果缓存，使多个文档中重复出现的文本块（版权声明、免责声明、链接列表等）只需转换一次
+"""
+
+import collections
+
+
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class BlockCache:
+    """
+    有容量上限的LRU缓存，超出容量时淘汰最久未使用的条目
+    """
+    def __init__(self, maxsize):
+        """
+        构造函数，maxsize为缓存的最大条目数
+        """
+        self._maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        """
+        查找缓存，未命中时返回None
+        """
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self._misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self._hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        添加缓存条目
+        """
+        self._entries[key] = value
+        if len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        清空缓存及统计信息
+        """
+        self._entries.clear()
+        self._hits = 0
+        self._misses = 0
+
+    def info(self):
+        """
+        返回缓存的命中次数、未命中次数、容量和当前条目数
+        """
+        return CacheInfo(self._hits, self._misses, self._maxsize, len(self._entries))
@@ -0,0 +1,196 @@
+"""
+站点链接索引
+
+批量转换目录时先对全部输入文件做一次预扫描，记录每个文档的相对路径及其中各标题的锚点；
+转换时LinkRule据此把指向站点中其它Markdown文档的链接改写为对应的HTML文件，并报告指向不存在的文档或锚点的链接
+预扫描只用一个正则表达式查找标题行和代码块的边界，仅对标题文字执行行内规则，并同时计算文件内容摘要，
+增量转换时不必为计算摘要再次读取文件；索引只保存相对路径和锚点，数万个文档也只占用很少的内存
+
+链接的改写结果取决于其它文档，因此站点链接索引的摘要（见fingerprint）计入转换器指纹，增删文档或锚点后增量转换重新生成全部页面
+
+使用：
+    index = LinkIndex('docs')
+    digests = dict((inputfile, index.scan(inputfile)) for inputfile, outputfile in walker.walk())
+    parser = Parser(link_index=index)
+    parser.parse(inputfile, outputfile)  # [安装](install.md#linux) -> <a href = "install.html#linux">安装</a>
+"""
+
+import os, re, html, codecs, hashlib, posixpath
+from urllib.parse import unquote
+import Rule
+
+
+class LinkIndex:
+    """
+    站点链接索引：文档相对于输入目录的路径（以/分隔）-> 文档中各标题的锚点
+    """
+    _scheme_pattern = re.compile('[a-zA-Z][a-zA-Z0-9+.-]*:')  # 带协议的地址，如http:、mailto:
+    # 预扫描关心的行：代码块的边界、Atx标题及Setext标题的下划线
+    # 与HeaderRule相同，只有#号的行与下一行组成Atx标题
+    _heading_pattern = re.compile(r'^(?:```.*|(#{1,6})(?:[ \t]+|[ \t]*\n[ \t]*)(.+)|[=-]+\s*?)$', re.M)
+    _lone_hash_pattern = re.compile('#{1,6}[ \t]*$')
+
+    def __init__(self, root, suffix='.html'):
+        """
+        构造函数，root为输入目录，suffix为输出文件的扩展名（见Walker）
+        """
+        self._root = os.path.abspath(root)
+        self._suffix = suffix
+        self._documents = {}  # 相对路径 -> 锚点集合
+        # 标题文字经过与转换时相同的行内规则后再生成锚点，HTML标签、链接（包括参考式链接）、强调等的处理与转换结果一致
+        self._references = Rule.ReferenceRule()  # 当前文档中参考式链接的定义，预扫描时收集
+        self._rules = (Rule.SpecialChRule(), Rule.BackslashRule(), Rule.InlineCodeRule(),
+                       Rule.ImageRule(self._references), Rule.LinkRule(self._references), Rule.EmphasisRule())
+
+    def __len__(self):
+        return len(self._documents)
+
+    def anchors(self):
+        """
+        返回全部文档的锚点总数
+        """
+        return sum(len(anchors) for anchors in self._documents.values())
+
+    def fingerprint(self):
+        """
+        返回索引内容的摘要，由输出文件的扩展名、全部文档的路径及其锚点计算得到
+        站点中增删文档或锚点时摘要随之改变，指向其它文档的链接的改写结果可能不同，已有的转换结果须全部重新生成
+        """
+        digest = hashlib.sha256(self._suffix.encode())
+        for document in sorted(self._documents):
+            digest.update(('\n%s\0%s' % (document, '\0'.join(sorted(self._documents[document])))).encode())
+        return digest.hexdigest()
+
+    def document_of(self, inputfile):
+        """
+        返回输入文件inputfile相对于输入目录的路径，不在输入目录中时返回None
+        """
+        relpath = os.path.relpath(os.path.abspath(inputfile), self._root).replace(os.sep, '/')
+        if relpath == '..' or relpath.startswith('../'):
+            return None
+        return relpath
+
+    def scan(self, inputfile, chunk_size=1 << 20):
+        """
+        预扫描输入文件inputfile，登记其中标题的锚点，返回文件内容的摘要（与Manifest.digest相同）
+        扫描标题的同时收集参考式链接的定义，标题中的参考式链接与转换时一样解析
+        文件无法读取时抛出OSError
+        """
+        digest = hashlib.sha256()
+        titles = []
+
+        def chunks():  # 逐个生成由完整的行组成的文本片段，同时查找其中的标题
+            decoder = codecs.getincrementaldecoder('utf-8')('replace')
+            state = [False, '']  # [是否处于代码块中, 上一片段的最后一行]
+            tail = ''  # 留到下一片段扫描的行
+            with open(inputfile, 'rb') as fin:
+                for chunk in iter(lambda: fin.read(chunk_size), b''):
+                    digest.update(chunk)
+                    text = (tail + decoder.decode(chunk)).replace('\r\n', '\n')  # 与转换时相同，换行符统一为\n
+                    # 尚未结束的行留到下一片段；只有#号的行须与其下一行一起匹配，也留到下一片段
+                    end = text.rfind('\n') + 1
+                    while end and self._lone_hash_pattern.match(text, text.rfind('\n', 0, end - 1) + 1, end - 1):
+                        end = text.rfind('\n', 0, end - 1) + 1
+                    self._scan_text(text, end, state, titles)
+                    yield text[:end]
+                    tail = text[end:]
+            tail += decoder.decode(b'', True)
+            self._scan_text(tail, len(tail), state, titles)
+            yield tail
+
+        self._references.reset()
+        self._references.collect(chunks())
+        self.add(self.document_of(inputfile), titles)
+        return digest.hexdigest()
+
+    def _scan_text(self, text, end, state, titles):
+        """
+        从text[:end]（由完整的行组成）中找出标题文字追加到titles，state为跨片段的扫描状态（见scan）
+        与CodeBlockandParagraphRule相同，以```开头的行切换代码块状态，代码块中的行不是标题；
+        Setext标题的下划线与其上一行（不能是空白行或另一个标题的下划线）组成标题；
+        上一行是Atx标题时，两者嵌套为同一个标题，只有一个锚点
+        """
+        inside_code, previous_line = state
+        consumed = -1  # 已作为下划线的行或Atx标题行的结束位置，该行不能再作为Setext标题
+        for match in self._heading_pattern.finditer(text, 0, end):
+            start = match.start()
+            line = match.group(0)
+            if line.startswith('```'):
+                inside_code = not inside_code
+            elif inside_code:
+                continue
+            elif match.group(1) is not None:
+                titles.append(Rule.HeaderRule._atx_title(match.group(2)))
+                consumed = match.end()
+            elif start == 0:
+                if previous_line.strip():
+                    titles.append(previous_line)
+                    consumed = match.end()
+            elif start - 1 > consumed:
+                title = text[text.rfind('\n', 0, start - 1) + 1:start - 1]
+                if title.strip():
+                    titles.append(title)
+                    consumed = match.end()
+        state[0] = inside_code
+        if end:
+            last = text.rfind('\n', 0, end - 1) + 1
+            state[1] = text[last:end - 1] if end - 1 > consumed else ''
+
+    def add(self, document, titles):
+        """
+        登记文档document（相对路径），titles为其中的标题文字（Markdown原文），按出现顺序排列
+        标题文字经行内规则转换后由Rule.slugify生成锚点，同一文档中重复的锚点依次加上后缀，
+        与转换时生成的标题锚点相同（见Rule.HeaderRule.assign_ids）；标题中的参考式链接按最近一次scan收集的定义解析
+        """
+        if document is None:
+            return
+        anchors = set()
+        suffixes = {}
+        for title in titles:
+            for rule in self._rules:
+                title = rule.process(title)
+            anchor = Rule.slugify(title)
+            if anchor:
+                Rule.unique_slug(anchor, anchors, suffixes)
+        self._documents[document] = frozenset(anchors)
+
+    def discard(self, inputfile):
+        """
+        从索引中删除输入文件inputfile
+        """
+        self._documents.pop(self.document_of(inputfile), None)
+
+    def resolve(self, document, address):
+        """
+        解析文档document（相对路径）中的链接地址address（已经过规则级联的转义），返回(改写后的地址, 问题描述)
+        指向索引中文档的地址替换扩展名为输出文件的扩展名，查询字符串和锚点保持不变；
+        指向不存在的Markdown文档或文档中不存在的锚点时返回问题描述，否则问题描述为None
+        带协议的地址、以//开头的地址及指向输入目录之外的地址保持原样
+        """
+        if address.startswith('//') or self._scheme_pattern.match(address):
+            return address, None
+        path, sharp, fragment = address.partition('#')
+        path, question, query = path.partition('?')
+        if path:
+            name = unquote(html.unescape(path))
+            if name.startswith('/'):  # 相对于输入目录
+                target = posixpath.normpath(name.lstrip('/'))
+            else:
+                target = posixpath.normpath(posixpath.join(posixpath.dirname(document), name))
+            if target == '..' or target.startswith('../'):
+                return address, None
+            anchors = self._documents.get(target)
+            stem, suffix = posixpath.splitext(path)
+            if anchors is None:
+                if suffix.lower() in ('.md', '.markdown', '.mdown'):
+                    return address, 'links to missing document "%s"' % target
+                return address, None
+            address = stem + self._suffix + question + query + sharp + fragment
+        else:  # 只有锚点，指向当前文档
+            target = document
+            anchors = self._documents.get(target)
+            if anchors is None:
+                return address, None
+        if fragment and unquote(html.unescape(fragment)) not in anchors:
+            return address, 'links to missing anchor "%s#%s"' % (target, fragment)
+        return address, None
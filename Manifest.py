@@ -0,0 +1,88 @@
+"""
+增量转换清单，记录每个输入文件的内容摘要及转换器指纹，批量转换时据此跳过未修改的文件
+"""
+
+import os, json, hashlib
+
+
+class Manifest:
+    """
+    增量转换清单，保存为JSON文件
+    """
+    def __init__(self, filename, fingerprint):
+        """
+        构造函数，filename为清单文件名，fingerprint为当前转换器的指纹（见Parser.fingerprint）
+        """
+        self._filename = filename
+        self._fingerprint = fingerprint
+        self._entries = {}  # 输入文件名 -> {'digest': 内容摘要, 'output': 输出文件名}
+        try:
+            with open(filename, 'r', -1, 'utf-8') as fin:
+                data = json.load(fin)
+        except (OSError, ValueError):  # 清单不存在或已损坏，视为全部文件都需要转换
+            return
+        # 转换器指纹不同时，已有的转换结果全部失效
+        if isinstance(data, dict) and data.get('fingerprint') == fingerprint:
+            self._entries = data.get('files', {})
+
+    @classmethod
+    def digest(cls, filename):
+        """
+        计算文件内容摘要
+        """
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as fin:
+            for chunk in iter(lambda: fin.read(1 << 16), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def is_fresh(self, inputfile, outputfile, digest):
+        """
+        检查inputfile自上次转换以来是否未被修改，且其转换结果outputfile仍然存在
+        digest为None（文件无法读取）或记录已失效（见invalidate）时总是需要重新转换
+        """
+        entry = self._entries.get(inputfile)
+        return (digest is not None and entry is not None and entry['digest'] == digest
+                and entry['output'] == outputfile and os.path.isfile(outputfile))
+
+    def update(self, inputfile, outputfile, digest):
+        """
+        记录inputfile的转换结果
+        """
+        self._entries[inputfile] = {'digest': digest, 'output': outputfile}
+
+    def discard(self, inputfile):
+        """
+        删除inputfile的记录，下次转换时将重新转换该文件
+        """
+        self._entries.pop(inputfile, None)
+
+    def invalidate(self):
+        """
+        使全部记录失效，全部文件都将重新转换；记录中的转换结果保留，已不存在的输入文件的转换结果仍由remove_stale删除
+        """
+        for entry in self._entries.values():
+            entry['digest'] = None
+
+    def remove_stale(self, input_files):
+        """
+        删除已不在输入文件列表中的文件的记录及其转换结果，返回删除的转换结果数目
+        """
+        removed = 0
+        for inputfile in set(self._entries) - set(input_files):
+            outputfile = self._entries.pop(inputfile)['output']
+            try:
+                os.remove(outputfile)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def save(self):
+        """
+        保存清单，先写入临时文件再替换，避免中途失败损坏清单
+        """
+        tmpfile = self._filename + '.tmp'
+        with open(tmpfile, 'w', -1, 'utf-8') as fou:
+            json.dump({'fingerprint': self._fingerprint, 'files': self._entries}, fou, indent=1, sort_keys=True)
+        os.replace(tmpfile, self._filename)
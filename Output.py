@@ -0,0 +1,206 @@
+"""
+HTML输出
+
+转换得到的HTML片段先收集在列表中，累计达到一定大小或距上次刷新超过一定时间后再以writelines批量写出，
+避免逐个文本块写入在网络文件系统或管道上产生大量小块写操作
+输出目标可以是文本文件、标准输出、二进制文件（包括gzip、brotli压缩文件）及套接字
+
+使用：
+    with open_output('test.html.gz') as writer:  # 按扩展名选择压缩格式，'-'表示标准输出
+        parser.convert_stream(source, writer)
+"""
+
+import io, sys, gzip, time, socket
+
+
+FLUSH_SIZE = 1 << 16  # 批量写出的默认阈值（字符数）
+STDOUT_FLUSH_INTERVAL = 0.5  # 输出到标准输出时的默认刷新间隔（秒），便于管道下游及时处理
+COMPRESSIONS = {'.gz': 'gz', '.br': 'br'}  # 扩展名 -> 压缩格式
+
+
+class BrotliFile(io.BufferedIOBase):
+    """
+    brotli压缩文件（只写），需要安装brotli模块
+    """
+    def __init__(self, filename):
+        self._compressor = None  # 关闭后为None
+        try:
+            import brotli
+        except ImportError:
+            raise ValueError('Brotli compression requires the "brotli" module.')
+        self._file = open(filename, 'wb')
+        self._compressor = brotli.Compressor()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._file.write(self._compressor.process(bytes(data)))
+        return len(data)
+
+    def flush(self):
+        """
+        将已压缩的数据写入文件，会降低压缩率，只在需要及时输出时调用
+        """
+        if self._compressor is not None:
+            self._file.write(self._compressor.flush())
+            self._file.flush()
+
+    def close(self):
+        if self._compressor is not None:
+            compressor, self._compressor = self._compressor, None
+            try:
+                self._file.write(compressor.finish())
+            finally:
+                self._file.close()
+        super().close()
+
+
+class BatchWriter:
+    """
+    批量写出HTML片段的输出对象，可作为Parser.convert_stream的writer
+
+    收集的片段累计达到flush_size个字符时写出；flush_interval不为None时，距上次写出超过flush_interval秒，
+    下一次写入时也会写出并刷新输出目标。按大小写出时不刷新输出目标，以免降低压缩率
+    """
+    def __init__(self, target, flush_size=FLUSH_SIZE, flush_interval=None, encoding='utf-8', close_target=False):
+        """
+        构造函数，target为文本文件对象、二进制文件对象或套接字；close_target为True时close()一并关闭target
+        """
+        self._target = target
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval
+        self._encoding = encoding
+        self._close_target = close_target
+        self._fragments = []
+        self._size = 0
+        self._last_flush = time.monotonic()
+        if isinstance(target, socket.socket):
+            self._write_batch = self._send
+        elif isinstance(target, (io.BufferedIOBase, io.RawIOBase)):
+            self._write_batch = self._write_bytes
+        else:
+            self._write_batch = target.writelines
+
+    def _send(self, fragments):
+        """
+        写出到套接字
+        """
+        self._target.sendall(''.join(fragments).encode(self._encoding))
+
+    def _write_bytes(self, fragments):
+        """
+        写出到二进制文件，整批编码后一次写入，压缩文件每批只调用一次压缩器
+        """
+        self._target.write(''.join(fragments).encode(self._encoding))
+
+    def write(self, fragment):
+        """
+        写入一个HTML片段
+        """
+        self._fragments.append(fragment)
+        self._size += len(fragment)
+        if self._size >= self._flush_size:
+            self._drain()
+        if self._flush_interval is not None and time.monotonic() - self._last_flush >= self._flush_interval:
+            self.flush()
+
+    def writelines(self, fragments):
+        """
+        写入多个HTML片段
+        """
+        for fragment in fragments:
+            self.write(fragment)
+
+    def _drain(self):
+        """
+        写出已收集的片段
+        """
+        if self._fragments:
+            self._write_batch(self._fragments)
+            self._fragments = []
+            self._size = 0
+
+    def flush(self):
+        """
+        写出已收集的片段并刷新输出目标
+        """
+        self._drain()
+        flush = getattr(self._target, 'flush', None)
+        if flush is not None:
+            flush()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """
+        写出剩余的片段，close_target为True时关闭输出目标
+        """
+        try:
+            self._drain()
+        finally:
+            if self._close_target:
+                self._target.close()
+            else:
+                flush = getattr(self._target, 'flush', None)
+                if flush is not None:
+                    flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def compression_of(filename):
+    """
+    按扩展名判断输出文件的压缩格式，不压缩时返回None
+    """
+    for suffix, compression in COMPRESSIONS.items():
+        if filename.lower().endswith(suffix):
+            return compression
+    return None
+
+
+def open_output(filename, compression=None, encoding='utf-8', flush_size=FLUSH_SIZE, flush_interval=None):
+    """
+    打开输出文件，返回BatchWriter
+    filename为'-'时输出到标准输出，默认每STDOUT_FLUSH_INTERVAL秒至少刷新一次；
+    compression为'gz'或'br'时压缩输出，为None时按扩展名判断（见compression_of）
+    打开失败时抛出OSError，压缩格式不受支持时抛出ValueError
+    """
+    if filename == '-':
+        if flush_interval is None:
+            flush_interval = STDOUT_FLUSH_INTERVAL
+        return BatchWriter(sys.stdout, flush_size, flush_interval, encoding)
+    if compression is None:
+        compression = compression_of(filename)
+    if compression == 'gz':
+        target = gzip.open(filename, 'wb')
+    elif compression == 'br':
+        target = BrotliFile(filename)
+    elif compression is None:
+        target = open(filename, 'w', -1, encoding)
+    else:
+        raise ValueError('Unknown compression "%s".' % compression)
+    return BatchWriter(target, flush_size, flush_interval, encoding, close_target=True)
+
+
+def open_binary_output(filename, compression=None):
+    """
+    打开二进制输出文件（如文档树的二进制格式），返回可写的二进制文件对象，整个输出一次写入，不需要批量写出
+    filename为'-'时写入标准输出（关闭返回的文件对象不关闭标准输出）；compression与open_output相同
+    打开失败时抛出OSError，压缩格式不受支持时抛出ValueError
+    """
+    if filename == '-':
+        sys.stdout.flush()
+        return open(sys.stdout.fileno(), 'wb', closefd=False)
+    if compression is None:
+        compression = compression_of(filename)
+    if compression == 'gz':
+        return gzip.open(filename, 'wb')
+    if compression == 'br':
+        return BrotliFile(filename)
+    if compression is None:
+        return open(filename, 'wb')
+    raise ValueError('Unknown compression "%s".' % compression)
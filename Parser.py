@@ -2,29 +2,80 @@
 解析转换器，应用Rule模块定义的规则进行转换
 """
 
+import io, re, sys, html, time, codecs, hashlib, collections
 import Rule
+import Tokenizer
+import Cache
+import Profile
+import Output
+import Ast
+import SearchIndex
+
+
+TOC_MARKER = '[TOC]'  # 单独成段时替换为目录
+TOC_PLACEHOLDER = '\x02toc\x03'  # 目录的占位符，文档结束时替换为目录
+
 
 class Parser:
     """
     解析转换器
     """
-    def __init__(self):
+    output_formats = ('html', 'json', 'binary')  # parse的输出格式
+    def __init__(self, engine='rules', cache_size=0, chunk_size=0, max_block=0, email_obfuscation='random',
+                 link_index=None, toc=False, output_format='html', sections=False):
         """
         构造函数
+
+        engine选择转换引擎：'rules'依次执行规则集中的各条规则，'tokenizer'使用单遍扫描引擎，两者输出相同
+        cache_size大于0时缓存最近cache_size个文本块的转换结果，在多个文档之间共享
+        chunk_size大于0时启用大文件模式：文本输入每次读取chunk_size个字符并直接在缓冲区中查找文本块边界（见read_blocks），
+        读取过程占用的内存不超过chunk_size加上当前文本块的大小
+        max_block大于0时对超过max_block个字符的文本块打印警告
+        email_obfuscation为Email地址的混淆方式：'random'每次转换结果不同，'deterministic'结果可重现（见Rule.LinkRule）
+        link_index为站点链接索引（见LinkIndex）时，parse转换的文件中指向站点中其它文档的链接改写为对应的HTML文件
+        toc为True时，单独成段的[TOC]替换为由文档中全部标题生成的目录（见iter_convert）
+        output_format为parse的输出格式：'html'输出完整页面，'json'和'binary'输出文档树（见parse_tree及Ast模块）
+        sections为True时，转换的同时按标题记录各小节的纯文本，供建立全文检索索引（见sections及SearchIndex模块）
         """
-        self._rulesets = []  # 转换规则集
+        if engine not in ('rules', 'tokenizer'):
+            raise ValueError('Unknown engine "%s".' % engine)
+        if output_format not in self.output_formats:
+            raise ValueError('Unknown output format "%s".' % output_format)
+        self._output_format = output_format
+        self._engine = engine
+        self._email_obfuscation = email_obfuscation
+        self._link_index = link_index
+        self._toc = toc
+        self._outline = []  # 最近转换的文档的标题大纲，见outline
+        self._collect_sections = sections
+        self._sections = []  # 最近转换的文档各小节的纯文本，见sections
+        self._tokenizer = None  # 单遍扫描引擎，首次使用时构造
+        self._cache = Cache.BlockCache(cache_size) if cache_size > 0 else None  # 文本块转换结果缓存
+        self._profile = None  # 性能剖析统计，见enable_profiling
+        self._chunk_size = chunk_size  # 大文件模式每次读取的字符数，0表示逐行读取
+        self._max_block = max_block  # 文本块大小的警告阈值，0表示不检查
+        self._state_attrs = []  # 规则中跨文本块的状态，即名称以_inside开头的属性
+        self._htmltitle = ''  # HTML页面标题
+        self._rulesets = []  # 转换规则集，按执行顺序排列
+        self._pipeline = []  # 执行用的(规则, 触发条件)列表，规则没有触发条件时为None，见Rule.trigger
+        self._skipped = []  # 各条规则因触发条件不满足而跳过的文本块数，与_pipeline一一对应
+        self._rule_blocks = 0  # 规则级联处理的文本块数
 
-        # 添加规则，其顺序会影响执行结果，调整须慎重
+        # 添加内置规则，执行顺序由各规则声明的约束计算得出（见Rule.order_rules），与添加的次序无关
+        self._references = Rule.ReferenceRule()  # 参考式链接的定义索引，由ImageRule和LinkRule共享
+        self._codeblocks = Rule.CodeBlockandParagraphRule()  # 代码片段在全部规则执行后才换回，见_process
         self.add_rule(Rule.SpecialChRule())
         self.add_rule(Rule.BackslashRule())
-        self.add_rule(Rule.CodeBlockandParagraphRule())
+        self.add_rule(self._codeblocks)
+        self.add_rule(self._references)
         self.add_rule(Rule.InlineCodeRule())
-        self.add_rule(Rule.HeaderRule())
+        self._headers = Rule.HeaderRule()  # 标题的锚点在文本块转换完成后加上，见iter_convert
+        self.add_rule(self._headers)
         self.add_rule(Rule.HrRule()) 
-        self.add_rule(Rule.BlockquoteRule())
-        self.add_rule(Rule.ListRule())
-        self.add_rule(Rule.ImageRule())
-        self.add_rule(Rule.LinkRule())
+        self.add_rule(Rule.ContainerRule())
+        self.add_rule(Rule.ImageRule(self._references))
+        self._links = Rule.LinkRule(self._references, email_obfuscation, link_index)  # 解析相对链接时须知道当前文档
+        self.add_rule(self._links)
         self.add_rule(Rule.EmphasisRule())
 
     @classmethod
@@ -40,16 +91,83 @@ class Parser:
     def blocks(cls, fileobject):
         """
         将文件对象fileobject的内容按空行切分成文本块，返回迭代器
+        行间代码块（以```开头的行之间）中的空行不切分文本块，整个代码块位于同一文本块中
         """
         block = []
+        fenced = False  # 当前是否在行间代码块中
         for line in Parser.lines(fileobject):
-            if line.strip():  # 当前行不是空行
+            if line.startswith('```'):
+                fenced = not fenced
+            if line.strip() or fenced:  # 当前行不是空行，或是代码块中的空行
                 block.append(line)
             else:  # 当前行是空行，输出文本块
                 yield ''.join(block)
                 block = []
+        if block:  # 代码块直到文末仍未结束，去掉lines在文末添加的换行符
+            yield ''.join(block[:-1])
 
 
+    # 空行（只含空白字符的行）或行间代码块的起止标志
+    _boundary_pattern = Rule.LazyPattern('^(?:[^\\S\\n]*\\n|```)', re.M)
+
+    @classmethod
+    def read_blocks(cls, fileobject, chunk_size=1 << 20):
+        """
+        以固定大小的缓冲区读取文本文件对象fileobject，按空行切分成文本块，返回迭代器，结果与blocks相同
+        在缓冲区中用正则表达式直接查找空行及代码块标志，不为每一行生成字符串对象，
+        只有跨越缓冲区边界的文本块才需要拼接，读取过程中最多保存一个缓冲区及当前文本块
+        """
+        pieces = []  # 当前文本块已读取的部分
+        # 上一缓冲区末尾尚未结束的行，若只含空白字符（可能是空行）或是```的前缀（可能是代码块标志），需与下一缓冲区一起查找
+        tail = ''
+        dirty = False  # 上一缓冲区末尾尚未结束的行既不是空行也不是代码块标志
+        fenced = False  # 当前是否在行间代码块中
+        while True:
+            chunk = fileobject.read(chunk_size)
+            if not chunk:
+                break
+            if chunk.endswith('\r'):  # 避免\r\n被缓冲区边界分开
+                chunk += fileobject.read(1)
+            if '\r' in chunk:
+                chunk = chunk.replace('\r\n', '\n')
+            text = tail + chunk
+            tail = ''
+            pos = start = 0  # 未输出部分的起点及查找空行的起点
+            if dirty:  # 跳过上一缓冲区遗留的行的剩余部分
+                start = text.find('\n') + 1
+                if not start:
+                    pieces.append(text)
+                    continue
+                dirty = False
+            for match in cls._boundary_pattern.finditer(text, start):
+                if text[match.start()] == '`':  # 代码块标志
+                    fenced = not fenced
+                    continue
+                if fenced:  # 代码块中的空行
+                    continue
+                if pieces:  # 文本块跨越缓冲区边界
+                    pieces.append(text[pos:match.start()])
+                    yield ''.join(pieces)
+                    pieces = []
+                else:
+                    yield text[pos:match.start()]
+                pos = match.end()
+            # 缓冲区末尾尚未结束的行
+            line_start = max(pos, text.rfind('\n', pos) + 1)
+            pieces.append(text[pos:line_start])
+            if text[line_start:].strip() and text[line_start:] not in ('`', '``'):
+                pieces.append(text[line_start:])
+                dirty = True
+            else:
+                tail = text[line_start:]
+        if fenced or tail.strip():  # 代码块直到文末仍未结束，或文末的行是``
+            pieces.append(tail)
+            yield ''.join(pieces)
+        else:  # 与lines相同，文末视为还有一个空行
+            yield ''.join(pieces)
+            if tail:
+                yield ''
+
     def set_html_title(self, title):
         """
         设定HTML页面标题
@@ -59,9 +177,44 @@ class Parser:
 
     def add_rule(self, rule):
         """
-        添加新的转换规则
+        添加新的转换规则，按规则声明的consumes、after和before插入到合适的位置（见Rule.order_rules），
+        没有声明约束的规则在已有规则之后执行；规则声明了触发字符triggers或定义了may_apply(block)时，
+        只在满足触发条件的文本块上执行。约束存在循环时抛出ValueError，规则集保持不变
+        """
+        self._rulesets = Rule.order_rules(self._rulesets + [rule])
+        self._pipeline = [(each, Rule.trigger(each)) for each in self._rulesets]
+        self._skipped = [0] * len(self._pipeline)
+        self._rule_blocks = 0
+        self._tokenizer = None  # 规则集变化后需重新构造单遍扫描引擎
+        self._state_attrs = [(each, name) for each in self._rulesets
+                             for name in sorted(vars(each)) if name.startswith('_inside')]
+        if self._cache is not None:
+            self._cache.clear()
+
+    def fingerprint(self):
+        """
+        转换器指纹，由转换引擎、Email混淆方式、站点链接索引的摘要、是否生成目录、输出格式、是否记录小节、
+        规则类型及定义规则的模块源码计算得到
+        规则集或规则实现发生变化时指纹随之改变，用于判断已有的转换结果是否仍然有效；
+        使用站点链接索引时，站点中增删文档或锚点都会改变指纹（见LinkIndex.fingerprint）；
+        记录小节时指纹还包括SearchIndex模块，分词方式改变后全部文档重新转换，全文检索索引随之重建
         """
-        self._rulesets.append(rule)
+        links = self._link_index.fingerprint() if self._link_index is not None else None
+        digest = hashlib.sha256(('%s\n%s\n%s\n%s\n%s\n%s\n' % (self._engine, self._email_obfuscation, links, self._toc,
+                                                               self._output_format, self._collect_sections)).encode())
+        modules = [sys.modules[__name__], Tokenizer, Ast]
+        if self._collect_sections:
+            modules.append(SearchIndex)
+        if self._link_index is not None:
+            modules.append(sys.modules[type(self._link_index).__module__])
+        for rule in self._rulesets:
+            digest.update(('%s.%s\n' % (type(rule).__module__, type(rule).__qualname__)).encode())
+            modules.append(sys.modules[type(rule).__module__])
+        for filename in sorted(set(getattr(module, '__file__', None) or '' for module in modules)):
+            if filename:
+                with open(filename, 'rb') as source:
+                    digest.update(source.read())
+        return digest.hexdigest()
 
     def reset(self):
         """
@@ -73,9 +226,365 @@ class Parser:
             except (AttributeError, NameError):
                 pass
 
-    def parse(self, inputfile, outputfile):
+    def cache_info(self):
+        """
+        返回文本块缓存的命中次数、未命中次数、容量和当前条目数，未启用缓存时返回None
+        """
+        return self._cache.info() if self._cache is not None else None
+
+    def skip_info(self):
+        """
+        返回有触发条件的各条规则跳过的文本块数：规则名 -> (跳过的文本块数, 规则级联处理的文本块数)
+        单遍扫描引擎不逐条执行内置规则，其处理的文本块只在退回规则级联时计入
+        """
+        return collections.OrderedDict((type(rule).__name__, (skipped, self._rule_blocks))
+                                       for (rule, triggered), skipped in zip(self._pipeline, self._skipped)
+                                       if triggered is not None)
+
+    def enable_profiling(self, stats=None):
+        """
+        启用性能剖析，此后逐条规则统计耗时、调用次数及输入输出字节数，返回统计对象（Profile.ProfileStats）
+        启用时以带计时的_profiled_process替换_process，未启用时转换过程没有额外开销
+        """
+        Rule.warm_up()  # 预先编译正则表达式，以免首次编译的耗时计入规则
+        self._profile = stats if stats is not None else Profile.ProfileStats()
+        self._process = self._profiled_process
+        return self._profile
+
+    def disable_profiling(self):
+        """
+        停用性能剖析，返回此前的统计对象
+        """
+        stats, self._profile = self._profile, None
+        self.__dict__.pop('_process', None)  # 恢复未插桩的_process
+        return stats
+
+    def profile_stats(self):
+        """
+        返回性能剖析统计对象，未启用时返回None
+        """
+        return self._profile
+
+    def _get_state(self):
+        """
+        返回各规则跨文本块的状态
+        """
+        return tuple(getattr(rule, name) for rule, name in self._state_attrs)
+
+    def _set_state(self, state):
+        """
+        恢复各规则跨文本块的状态
+        """
+        for (rule, name), value in zip(self._state_attrs, state):
+            setattr(rule, name, value)
+
+    def process(self, block):
+        """
+        处理一个文本块，启用缓存时先查找缓存
+        文本块的转换结果取决于此前文本块留下的状态，因此缓存以文本块及转换前的状态为键，
+        并同时保存转换后的状态，命中时一并恢复；含有参考式链接定义或引用的文本块，其结果还取决于定义索引，不使用缓存；
+        使用站点链接索引时，含有链接的文本块的结果还取决于当前文档的路径，同样不使用缓存
+        """
+        if (self._cache is None or self._references.may_apply(block)
+                or (self._link_index is not None and '](' in block)):
+            return self._process(block)
+        key = (block, self._get_state())
+        entry = self._cache.get(key)
+        if entry is not None:
+            block, state = entry
+            self._set_state(state)
+            return block
+        result = self._process(block)
+        self._cache.put(key, (result, self._get_state()))
+        return result
+
+    def _process(self, block):
+        """
+        使用选定的转换引擎处理一个文本块
+        """
+        if self._engine == 'tokenizer':
+            if self._tokenizer is None:
+                self._tokenizer = Tokenizer.Tokenizer(self._rulesets)
+            block = self._tokenizer.process(block)
+        else:
+            skipped = self._skipped
+            self._rule_blocks += 1
+            for idx, (rule, triggered) in enumerate(self._pipeline):
+                if triggered is None or triggered(block):
+                    block = rule.process(block)
+                else:
+                    skipped[idx] += 1
+        return self._codeblocks.restore(block)
+
+    def _profiled_process(self, block):
+        """
+        带计时的_process，逐条规则计时；单遍扫描引擎内部不区分规则，整体计为一项
+        """
+        clock = time.perf_counter
+        source = block
+        timings = []
+        skipped = []  # 因触发条件不满足而跳过的规则名
+        if self._engine == 'tokenizer':
+            start = clock()
+            block = Parser._process(self, block)
+            timings.append(('Tokenizer', clock() - start, source, block))
+        else:
+            self._rule_blocks += 1
+            for idx, (rule, triggered) in enumerate(self._pipeline):
+                if triggered is not None and not triggered(block):
+                    self._skipped[idx] += 1
+                    skipped.append(type(rule).__name__)
+                    continue
+                start = clock()
+                result = rule.process(block)
+                timings.append((type(rule).__name__, clock() - start, block, result))
+                block = result
+            block = self._codeblocks.restore(block)
+        self._profile.record(source, timings, skipped)
+        return block
+
+    @classmethod
+    def source_lines(cls, source, encoding='utf-8'):
+        """
+        将输入source切分成行，返回迭代器
+        source可以是str、bytes、文本或二进制文件对象，也可以是由str或bytes组成的可迭代对象；
+        bytes按encoding解码，换行符统一为\n
+        """
+        if isinstance(source, (bytes, bytearray)):
+            source = source.decode(encoding)
+        if isinstance(source, str):
+            source = io.StringIO(source, newline=None)
+        decoder = None
+        for line in source:
+            if not isinstance(line, str):  # 二进制文件对象或bytes组成的可迭代对象，逐行增量解码
+                if decoder is None:
+                    decoder = codecs.getincrementaldecoder(encoding)()
+                line = decoder.decode(line)
+            if line.endswith('\r\n'):
+                line = line[:-2] + '\n'
+            yield line
+
+    def _source_blocks(self, source, encoding, title=None):
+        """
+        将输入source切分成文本块，大文件模式下文本输入由read_blocks按缓冲区读取，其余输入逐行读取
+        max_block大于0时检查文本块大小，title用于在警告中指明文档
+        """
+        if self._chunk_size > 0 and isinstance(source, str):
+            source = io.StringIO(source, newline=None)
+        if self._chunk_size > 0 and isinstance(source, io.TextIOBase):
+            blocks = self.read_blocks(source, self._chunk_size)
+        else:
+            blocks = self.blocks(self.source_lines(source, encoding))
+        if self._max_block <= 0:
+            return blocks
+        return self._check_blocks(blocks, title)
+
+    def _check_blocks(self, blocks, title=None):
+        """
+        对超过max_block个字符的文本块打印警告，以免转换日志等超长文本块时内存耗尽而无从查找原因
+        """
+        line = 1  # 当前文本块的起始行号
+        for index, block in enumerate(blocks, 1):
+            if len(block) > self._max_block:
+                print('Warning: block %d (line %d)%s has %d characters, exceeding the limit of %d.'
+                      % (index, line, '' if title is None else ' of "%s"' % title, len(block), self._max_block))
+            line += block.count('\n') + 1
+            yield block
+
+    def html_header(self, title=None):
+        """
+        返回HTML页面的头部，title为None时使用set_html_title设定的标题；标题是纯文本，其中的HTML特殊字符被转义
+        """
+        return ('<html>\n<head>\n'
+                '<meta http-equiv="Content-Type" content="text/html; charset=utf-8" />\n'
+                '<title>%s</title>\n'
+                '</head>\n\n<body>\n' % html.escape(self._htmltitle if title is None else title, False))
+
+    @classmethod
+    def html_footer(cls):
+        """
+        返回HTML页面的尾部
+        """
+        return '</body>\n</html>\n'
+
+    def iter_convert(self, source, full_page=False, title=None, encoding='utf-8'):
+        """
+        转换source（见source_lines），逐个文本块生成HTML片段，不需要一次读入全部输入
+        full_page为True时生成包括<html>、<head>和<body>在内的完整页面，否则只生成正文片段
+        不可重复读取的输入中，含有尚未定义的参考式引用的文本块暂缓输出，待定义出现或文档结束后按当时的规则状态重新转换；
+        标题带有锚点id，全部标题按顺序记入大纲（见outline）；锚点在输出时生成，由解析后的标题文字计算；启用目录时，第一个单独成段的[TOC]先输出为占位符，
+        此后的HTML片段暂缓到文档结束，待大纲完整后将占位符替换为目录再输出
+        记录小节时，正文片段在输出前交给SearchIndex.SectionCollector，目录不计入小节的正文
+        转换结束（或生成器被关闭）后自动重置转换器
+        """
+        references = self._references
+        headers = self._headers
+        toc = False  # 是否已输出目录占位符
+        collector = SearchIndex.SectionCollector(title) if self._collect_sections else None
+        try:
+            if full_page:
+                yield self.html_header(title)
+            self._prescan(source, encoding)
+            pending = []  # 暂缓输出的HTML片段，及含有未解析引用的文本块（见_flush），待定义出现或文档结束后再输出
+            for block in self._source_blocks(source, encoding, title):
+                if (self._toc and not toc and block.strip() == TOC_MARKER
+                        and not self._codeblocks._inside_code):
+                    toc = True
+                    pending.append(TOC_PLACEHOLDER + '\n')
+                    continue
+                state = self._get_state() if references.may_apply(block) else None
+                html = self.process(block) + '\n'
+                if state is not None and references.unresolved(html):
+                    pending.append((block, state))
+                elif pending or references.waiting():
+                    pending.append(html)
+                    if not references.waiting() and not toc:
+                        html = headers.assign_ids(self._flush(pending))
+                        pending = []
+                        if collector is not None:
+                            collector.feed(html)
+                        yield html
+                else:
+                    html = headers.assign_ids(html)
+                    if collector is not None:
+                        collector.feed(html)
+                    yield html
+            if pending:  # 文档结束，仍未定义的引用保留原文
+                references.finish()
+                html = headers.assign_ids(self._flush(pending))
+                if collector is not None:
+                    collector.feed(html.replace(TOC_PLACEHOLDER, '', 1))
+                if toc:
+                    html = html.replace(TOC_PLACEHOLDER, self.toc_html(headers.outline), 1)
+                yield html
+            if full_page:
+                yield self.html_footer()
+        finally:
+            self._outline = headers.outline
+            self._sections = collector.sections() if collector is not None else []
+            self.reset()
+
+    def _flush(self, pending):
+        """
+        拼接暂缓输出的片段，其中的(文本块, 转换前的规则状态)按该状态重新转换，此时引用都已定义或文档已经结束
+        """
+        state = self._get_state()
+        output = []
+        for entry in pending:
+            if isinstance(entry, tuple):
+                block, before = entry
+                self._set_state(before)
+                entry = self.process(block) + '\n'
+            output.append(entry)
+        self._set_state(state)
+        return ''.join(output)
+
+    def outline(self):
+        """
+        返回最近转换的文档的标题大纲：[(层级, 锚点, 标题文字), ...]，按标题在文档中出现的顺序排列
+        """
+        return list(self._outline)
+
+    def sections(self):
+        """
+        返回最近转换的文档各小节的纯文本：[(锚点, 标题, 纯文本), ...]，未启用sections时返回空列表
+        第一个标题之前的正文为锚点为空、标题为文档标题的小节（见SearchIndex.SectionCollector）
+        """
+        return list(self._sections)
+
+    @classmethod
+    def toc_html(cls, outline):
+        """
+        由标题大纲outline生成目录的HTML，层级较低的标题嵌套在其前面层级较高的标题之下
+        """
+        if not outline:
+            return ''
+        lines = ['<nav class = "toc">']
+        levels = []  # 已打开的各层列表对应的标题层级
+        for level, anchor, title in outline:
+            while levels and level < levels[-1]:
+                lines.append('</li>\n</ul>')
+                levels.pop()
+            if levels and level == levels[-1]:
+                lines.append('</li>')
+            else:
+                lines.append('<ul>')
+                levels.append(level)
+            lines.append('<li><a href = "#%s">%s</a>' % (anchor, title))
+        lines.extend(['</li>\n</ul>'] * len(levels))
+        lines.append('</nav>')
+        return '\n'.join(lines)
+
+    def _prescan(self, source, encoding):
+        """
+        可重复读取的输入（str、bytes及可定位的文件对象）先扫描一遍，收集参考式链接的定义，
+        此后的引用都可以立即解析而不需要占位符；其余输入（管道、套接字等）在转换过程中延迟解析
+        """
+        if isinstance(source, (bytes, bytearray)):
+            source = source.decode(encoding)
+        if isinstance(source, str):
+            self._references.collect((source,))
+            return
+        try:
+            if not source.seekable():
+                return
+            position = source.tell()
+        except (AttributeError, OSError, ValueError):
+            return
+        self._references.collect(self._read_chunks(source, encoding))
+        source.seek(position)
+
+    @classmethod
+    def _read_chunks(cls, fileobject, encoding, chunk_size=1 << 20):
+        """
+        按固定大小读取文件对象，二进制文件按encoding增量解码，返回文本片段迭代器
+        """
+        decoder = None
+        while True:
+            chunk = fileobject.read(chunk_size)
+            if not chunk:
+                break
+            if not isinstance(chunk, str):
+                if decoder is None:
+                    decoder = codecs.getincrementaldecoder(encoding)()
+                chunk = decoder.decode(chunk)
+            yield chunk
+
+    def convert(self, source, full_page=False, title=None, encoding='utf-8'):
+        """
+        转换source（见source_lines），返回HTML字符串
+        """
+        return ''.join(self.iter_convert(source, full_page, title, encoding))
+
+    def convert_stream(self, source, writer, full_page=False, title=None, encoding='utf-8'):
+        """
+        转换source（见source_lines），将HTML片段逐个写入writer
+        writer可以是带write方法的对象（文件、socket.makefile()、Output.BatchWriter等），也可以是接受字符串的函数；
+        逐个文本块写入的片段较小，输出到管道或网络文件系统时宜用Output.BatchWriter包装以批量写出
+        """
+        write = writer.write if hasattr(writer, 'write') else writer
+        for chunk in self.iter_convert(source, full_page, title, encoding):
+            write(chunk)
+
+    def parse_tree(self, source, title=None, encoding='utf-8'):
+        """
+        转换source（见source_lines），返回文档树的根节点（见Ast模块），title不为None时记为根节点的title属性
+        文档树在转换过程中逐个文本块建立，由Ast.HtmlRenderer生成的HTML与convert的结果相同
+        """
+        builder = Ast.TreeBuilder()
+        for chunk in self.iter_convert(source, False, title, encoding):
+            builder.feed(chunk)
+        root = builder.close()
+        if title is not None:
+            root.attrs = (('title', title),)
+        return root
+
+    def parse(self, inputfile, outputfile, compression=None):
         """
         执行实际转换
+        输出经Output.BatchWriter批量写出，outputfile为'-'时输出到标准输出；
+        compression为'gz'或'br'时压缩输出，为None时按outputfile的扩展名判断（见Output.open_output）
+        输出格式为'json'或'binary'时输出文档树而不是HTML页面
         """
         try:
             fin = open(inputfile, 'r', -1, 'utf-8')
@@ -84,27 +593,29 @@ class Parser:
             return 0
 
         try:
-            fou = open(outputfile, 'w', -1, 'utf-8')
+            if self._output_format == 'binary':
+                fou = Output.open_binary_output(outputfile, compression)
+            else:
+                fou = Output.open_output(outputfile, compression)
         except OSError:
+            fin.close()
             print('Error: I/O failure occurred when opening file "%s".' % outputfile)
             return 0
+        except ValueError as error:
+            fin.close()
+            print('Error: %s' % error)
+            return 0
 
-        fou.write('<html>\n<head>\n')
-        fou.write('<meta http-equiv="Content-Type" content="text/html; charset=utf-8" />\n')
-
-        # 写入头部信息
         # 以输入文件名作为HTML页面标题
-        fou.write('<title>%s</title>\n' % inputfile.rsplit('.', 1)[0].rsplit('/', 1)[-1])
-        fou.write('</head>\n\n<body>\n')
-
-        # 写入正文信息
-        for block in self.blocks(fin):
-            for rule in self._rulesets:
-                block = rule.process(block)      
-            fou.write(block + '\n')
-
-        fou.write('</body>\n</html>\n')
-        fin.close()
-        fou.close()
-        self.reset()
+        title = inputfile.rsplit('.', 1)[0].rsplit('/', 1)[-1]
+        if self._profile is not None:
+            self._profile.begin_document(inputfile)
+        self._links.begin_document(inputfile)
+        with fin, fou:
+            if self._output_format == 'html':
+                self.convert_stream(fin, fou, True, title)
+            elif self._output_format == 'json':
+                fou.write(Ast.dump_json(self.parse_tree(fin, title)) + '\n')
+            else:
+                fou.write(Ast.dump_binary(self.parse_tree(fin, title)))
         return 1
@@ -0,0 +1,131 @@
+"""
+转换过程的性能剖析统计，记录各条规则的累计耗时、调用次数、输入输出字节数、因触发条件不满足而跳过的次数以及耗时最长的文本块
+由Parser.enable_profiling()启用，未启用时转换过程没有任何额外开销
+"""
+
+import json, heapq, collections
+
+
+class ProfileStats:
+    """
+    性能剖析统计
+    """
+    def __init__(self, slowest=10, preview=80):
+        """
+        构造函数，slowest为保留的最慢文本块数目，preview为记录的文本块内容的最大长度
+        """
+        self._slowest = slowest
+        self._preview = preview
+        self._rules = collections.OrderedDict()  # 规则名 -> [调用次数, 累计耗时, 输入字节数, 输出字节数, 跳过次数]
+        self._heap = []  # 最慢文本块的小顶堆，元素为(耗时, 序号, 记录)
+        self._counter = 0  # 堆元素的序号，耗时相同时按记录先后比较
+        self._blocks = 0
+        self._seconds = 0.0
+        self._document = None  # 当前文档名
+        self._index = 0  # 当前文本块在文档中的序号
+
+    def begin_document(self, name):
+        """
+        开始统计一个新文档，此后记录的最慢文本块以name及块序号标识
+        """
+        self._document = name
+        self._index = 0
+
+    def record(self, block, timings, skipped=()):
+        """
+        记录一个文本块的转换，timings为[(规则名, 耗时, 输入, 输出), ...]，skipped为跳过的规则名
+        """
+        total = 0.0
+        slowest_rule, slowest_time = None, -1.0
+        for name, seconds, source, result in timings:
+            entry = self._rule_entry(name)
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] += len(source.encode())
+            entry[3] += len(result.encode())
+            total += seconds
+            if seconds > slowest_time:
+                slowest_rule, slowest_time = name, seconds
+        for name in skipped:
+            self._rule_entry(name)[4] += 1
+        self._blocks += 1
+        self._seconds += total
+        self._index += 1
+        if self._slowest > 0:
+            self._push_block({
+                'seconds': total,
+                'document': self._document,
+                'index': self._index,
+                'rule': slowest_rule,
+                'rule_seconds': slowest_time,
+                'bytes': len(block.encode()),
+                'preview': block[:self._preview],
+            })
+
+    def _rule_entry(self, name):
+        """
+        返回规则的统计项，首次出现时创建
+        """
+        entry = self._rules.get(name)
+        if entry is None:
+            entry = self._rules[name] = [0, 0.0, 0, 0, 0]
+        return entry
+
+    def _push_block(self, record):
+        """
+        将文本块记录加入最慢文本块堆，只保留耗时最长的self._slowest个
+        """
+        self._counter += 1
+        item = (record['seconds'], self._counter, record)
+        if len(self._heap) < self._slowest:
+            heapq.heappush(self._heap, item)
+        else:
+            heapq.heappushpop(self._heap, item)
+
+    def clear(self):
+        """
+        清空统计信息
+        """
+        self._rules.clear()
+        self._heap = []
+        self._blocks = 0
+        self._seconds = 0.0
+        self._index = 0
+
+    def to_dict(self):
+        """
+        返回可保存为JSON的统计结果
+        """
+        return {
+            'blocks': self._blocks,
+            'seconds': self._seconds,
+            'rules': collections.OrderedDict(
+                (name, {'calls': calls, 'seconds': seconds, 'bytes_in': bytes_in, 'bytes_out': bytes_out,
+                        'skipped': skipped})
+                for name, (calls, seconds, bytes_in, bytes_out, skipped) in self._rules.items()),
+            'slowest_blocks': [record for seconds, counter, record in sorted(self._heap, reverse=True)],
+        }
+
+    def merge(self, data):
+        """
+        合并另一份统计结果（to_dict的返回值），用于汇总多个工作进程的统计
+        """
+        for name, rule in data['rules'].items():
+            entry = self._rule_entry(name)
+            entry[0] += rule['calls']
+            entry[1] += rule['seconds']
+            entry[2] += rule['bytes_in']
+            entry[3] += rule['bytes_out']
+            entry[4] += rule.get('skipped', 0)
+        self._blocks += data['blocks']
+        self._seconds += data['seconds']
+        if self._slowest > 0:
+            for record in data['slowest_blocks']:
+                self._push_block(record)
+
+    def dump(self, fileobject):
+        """
+        将统计结果以JSON格式写入文件对象fileobject
+        """
+        json.dump(self.to_dict(), fileobject, indent=2, ensure_ascii=False)
+        fileobject.write('\n')
@@ -1,34 +1,257 @@
 """
 各种解析转换规则
 
-规则执行的顺序会影响程序结果，以下是经测试正确的顺序：
+规则执行的顺序会影响程序结果，每条规则以类属性声明执行顺序的约束，由order_rules计算执行顺序：
+
+    consumes：规则处理的语法结构名称
+    after：须在处理这些语法结构的规则之后执行
+    before：须在处理这些语法结构的规则之前执行
+
+规则还可以声明触发字符triggers，文本块中不含其中任何字符时转换器跳过该规则；
+或定义may_apply(block)方法作为更一般的触发条件，返回False时跳过该规则（见trigger）。
+规则被跳过时不得改变文本块及自身状态，因此有跨文本块状态的规则不声明触发条件。
+内置规则的声明得出以下顺序：
 
     1. SpecialChRule
     2. BackslashRule
     3. CodeBlockandParagraphRule
-    4. InlineCodeRule
-    5. HeaderRule
-    6. HrRule
-    7. BlockquoteRule
-    8. ListRule
+    4. ReferenceRule
+    5. InlineCodeRule
+    6. HeaderRule
+    7. HrRule
+    8. ContainerRule
     9. ImageRule
     10. LinkRule
     11. EmphasisRule
+
+各规则的正则表达式登记在模块级的注册表中，由所有规则实例共享：
+规则类以LazyPattern声明正则表达式，首次使用时才编译，因此构造规则对象几乎没有开销；
+需要尽快响应的进程可以预先调用warm_up()编译全部正则表达式
+
+字符到HTML实体的转义统一由模块级的转义表完成（见ENTITIES及escape_table），
+各规则以str.translate单遍替换，不再逐字符拼接字符串或逐个字符调用正则替换
 """
 
-import re, random, binascii
+import re, html, heapq, random, hashlib
+
+
+_compiled_patterns = {}  # 正则表达式注册表：(表达式, 标志) -> 编译结果
+_declared_patterns = []  # 已声明的全部延迟编译正则表达式
+
+
+def compile_pattern(regex, flags=0):
+    """
+    从注册表中取出编译后的正则表达式，首次使用时编译
+    """
+    try:
+        return _compiled_patterns[regex, flags]
+    except KeyError:
+        compiled = _compiled_patterns[regex, flags] = re.compile(regex, flags)
+        return compiled
+
+
+class LazyPattern:
+    """
+    延迟编译的正则表达式
+    作为类属性时，首次访问即从注册表中取出编译结果并替换自身，之后的访问与普通类属性相同
+    """
+    def __init__(self, regex, flags=0):
+        self.regex = regex
+        self.flags = flags
+        self._name = None
+        _declared_patterns.append(self)
+
+    def __set_name__(self, owner, name):
+        self._name = name
+
+    def __get__(self, instance, owner):
+        compiled = self.compile()
+        setattr(owner, self._name, compiled)
+        return compiled
+
+    def compile(self):
+        """
+        返回编译后的正则表达式
+        """
+        return compile_pattern(self.regex, self.flags)
+
+    def sub(self, repl, string):
+        """
+        与re.Pattern.sub相同
+        """
+        return compile_pattern(self.regex, self.flags).sub(repl, string)
+
+
+def warm_up():
+    """
+    预先编译全部已声明的正则表达式
+    """
+    for pattern in _declared_patterns:
+        pattern.compile()
+
+
+def trigger(rule):
+    """
+    返回规则的触发条件函数，规则既没有声明triggers也没有定义may_apply时返回None
+    触发字符在规则执行时的文本块上检查，前面的规则可能已经改写了文本块（例如SpecialChRule将<替换为&lt;）
+    """
+    triggers = getattr(rule, 'triggers', None)
+    may_apply = getattr(rule, 'may_apply', None)
+    if not triggers:
+        return may_apply
+
+    def triggered(block):
+        for c in triggers:
+            if c in block:
+                return may_apply is None or may_apply(block)
+        return False
+    return triggered
+
+
+def order_rules(rules):
+    """
+    按各规则声明的consumes、after和before计算执行顺序，返回排序后的规则列表
+    约束所引用的语法结构没有规则处理时忽略该约束；满足约束的前提下尽量保持rules中的先后次序：
+    须在某条规则之前执行的规则紧挨在它之前，没有声明约束的规则排在其它规则之后。约束存在循环时抛出ValueError
+    """
+    consumers = {}  # 语法结构 -> 处理它的规则在rules中的序号
+    for idx, rule in enumerate(rules):
+        for construct in getattr(rule, 'consumes', ()):
+            consumers.setdefault(construct, []).append(idx)
+    successors = [set() for _ in rules]  # 须在该规则之后执行的规则
+    for idx, rule in enumerate(rules):
+        for construct in getattr(rule, 'after', ()):
+            for other in consumers.get(construct, ()):
+                successors[other].add(idx)
+        for construct in getattr(rule, 'before', ()):
+            for other in consumers.get(construct, ()):
+                successors[idx].add(other)
+    indegree = [0] * len(rules)
+    for idx, following in enumerate(successors):
+        following.discard(idx)
+        for other in following:
+            indegree[other] += 1
+    # 规则的优先级取它及其全部后继规则中最小的序号
+    priority = list(range(len(rules)))
+    for _ in rules:
+        for idx, following in enumerate(successors):
+            for other in following:
+                if priority[other] < priority[idx]:
+                    priority[idx] = priority[other]
+    # 拓扑排序，每次取出可执行的规则中优先级最高的一个
+    ready = [(priority[idx], idx) for idx, degree in enumerate(indegree) if degree == 0]
+    heapq.heapify(ready)
+    ordered = []
+    while ready:
+        idx = heapq.heappop(ready)[1]
+        ordered.append(rules[idx])
+        for other in successors[idx]:
+            indegree[other] -= 1
+            if indegree[other] == 0:
+                heapq.heappush(ready, (priority[other], other))
+    if len(ordered) < len(rules):
+        raise ValueError('Cyclic rule dependencies among %s.'
+                         % ', '.join(type(rule).__name__ for idx, rule in enumerate(rules) if indegree[idx] > 0))
+    return ordered
+
+
+# 可能会被其它规则错误解析的特殊字符及其HTML实体
+ENTITIES = {
+    '&': '&amp;',
+    '#': '&num;',
+    '_': '&lowbar;',
+    '*': '&ast;',
+    '+': '&plus;',
+    '`': '&grave;',
+    '[': '&lbrack;',
+    ']': '&rbrack;',
+    '(': '&lpar;',
+    ')': '&rpar;',
+    '{': '&lbrace;',
+    '}': '&rbrace;',
+    '\\': '&bsol;',
+    '!': '&excl;',
+    '.': '&period;',
+    '-': '&#45;',
+}
+
+
+def escape_table(chars, entities=ENTITIES):
+    """
+    生成供str.translate使用的转义表，将chars中的每个字符替换为entities中对应的实体
+    """
+    return str.maketrans({c: entities[c] for c in chars})
+
+
+INLINE_CODE_ESCAPES = escape_table('&#_*[](){}\\!')    # 行内代码
+LINK_ESCAPES = escape_table('_*[]()')                   # 链接及图片地址
+# 转换过程中占位符（代码片段、参考式链接、目录）由\x02和\x03界定，输入中的这两个控制字符由SpecialChRule替换为U+FFFD
+PLACEHOLDER_ESCAPES = {0x02: '\ufffd', 0x03: '\ufffd'}
+# email地址中固定替换的字符，其余字符随机替换为ASCII编码
+EMAIL_ENTITIES = {'@': '&#64;', '.': '&#x2E;', '_': '&lowbar;', '*': '&ast;'}
+_hex_entities = {}  # 字符 -> 其UTF-8编码的十六进制实体，按需填充
+_deterministic_emails = {}  # Email地址 -> 确定性混淆的结果
+_DETERMINISTIC_EMAIL_CACHE = 4096  # 缓存的Email地址数目上限，超出时清空
+_ASCII_LETTERS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ')
+
+
+def _hex_entity(c):
+    """
+    将字符c替换为其UTF-8编码的十六进制实体
+    """
+    try:
+        return _hex_entities[c]
+    except KeyError:
+        entity = _hex_entities[c] = '&#x%s;' % c.encode().hex()
+        return entity
+
+
+_slug_tag_pattern = LazyPattern('<[^>]*>')
+_slug_drop_pattern = LazyPattern(r'[^\w\s-]')
+_slug_space_pattern = LazyPattern(r'\s')
+
+
+def slugify(title):
+    """
+    由标题生成锚点：去掉HTML标签并还原实体，转为小写，删除字母、数字、_、-及空白以外的字符，每个空白替换为-
+    标题中没有字母、数字等字符时返回空字符串，这样的标题（例如段落标签被误认为Setext标题）不生成锚点
+    """
+    text = html.unescape(_slug_tag_pattern.sub('', title)).lower()
+    text = _slug_drop_pattern.sub('', text).strip()
+    return _slug_space_pattern.sub('-', text)
+
+
+def unique_slug(slug, used, suffixes):
+    """
+    返回在集合used中尚未出现的锚点并加入used，同一文档中重复的锚点依次加上后缀-1、-2……
+    suffixes记录各锚点下次尝试的后缀（锚点 -> 序号），同一文档共用一个字典，
+    重复多次的标题不必每次从-1开始逐个尝试
+    """
+    if slug not in used:
+        used.add(slug)
+        return slug
+    number = suffixes.get(slug, 1)
+    candidate = '%s-%d' % (slug, number)
+    while candidate in used:  # 后缀形式的锚点也可能来自其它标题，如"Usage 1"
+        number += 1
+        candidate = '%s-%d' % (slug, number)
+    suffixes[slug] = number + 1
+    used.add(candidate)
+    return candidate
 
 
 class SpecialChRule:
     """
     HTML特殊字符<, >, &及HTML标签，此规则必须先于其它所有规则执行
+    输入中的\x02和\x03同时替换为U+FFFD，以免与转换过程中的占位符混淆
     """
-    def __init__(self):
-        self._leftangle_pattern = re.compile('<')
-        self._rightangle_pattern = re.compile('>')
-        # 匹配字符&时必须使用否定预测零宽断言（negative lookahead assertion）以避免破坏HTML实体
-        self._ampersand_pattern = re.compile('&(?!#[0-9]+|[a-zA-Z]+|#x[0-9a-fA-F]+;)')
-        
+    consumes = ('special_char',)
+    triggers = '<>&\x02\x03'
+    _leftangle_pattern = LazyPattern('<')
+    _rightangle_pattern = LazyPattern('>')
+    # 匹配字符&时必须使用否定预测零宽断言（negative lookahead assertion）以避免破坏HTML实体
+    _ampersand_pattern = LazyPattern('&(?!#[0-9]+|[a-zA-Z]+|#x[0-9a-fA-F]+;)')
+
     def process(self, block):
         """
         按照规则进行处理
@@ -36,6 +259,8 @@ class SpecialChRule:
         block = self._leftangle_pattern.sub('&lt;', block)
         block = self._rightangle_pattern.sub('&gt;', block)
         block = self._ampersand_pattern.sub('&amp;', block)
+        if '\x02' in block or '\x03' in block:
+            block = block.translate(PLACEHOLDER_ESCAPES)
         return block
 
 
@@ -44,8 +269,10 @@ class InlineCodeRule:
     """
     HTML行内代码 <code>
     """
-    def __init__(self):
-        self._inlinecode_pattern = re.compile('`(.+?)`')
+    consumes = ('inline_code',)
+    triggers = '`'
+    after = ('code_block',)
+    _inlinecode_pattern = LazyPattern('`(.+?)`')
 
     @classmethod
     def _inlinecode_substring(cls, match):
@@ -53,20 +280,7 @@ class InlineCodeRule:
         行内代码替换函数
         """
         # 替换掉可能会被其它规则错误解析的特殊字符
-        substring = match.group(1)
-        substring = re.sub('&', '&amp;', substring)
-        substring = re.sub('#', '&num;', substring)
-        substring = re.sub('_', '&lowbar;', substring)
-        substring = re.sub('\*', '&ast;', substring)
-        substring = re.sub('\[', '&lbrack;', substring)
-        substring = re.sub('\]', '&rbrack;', substring)
-        substring = re.sub('\(', '&lpar;', substring)
-        substring = re.sub('\)', '&rpar;', substring)
-        substring = re.sub('{', '&lbrace;', substring)
-        substring = re.sub('}', '&rbrace;', substring)
-        substring = re.sub(r'\\', '&bsol;', substring)
-        substring = re.sub('!', '&excl;', substring)
-        return '<code>%s</code>' % substring
+        return '<code>%s</code>' % match.group(1).translate(INLINE_CODE_ESCAPES)
 
     def process(self, block):
         """
@@ -79,97 +293,263 @@ class InlineCodeRule:
 
 class CodeBlockandParagraphRule:
     """
-    HTML行间代码块 <pre><code> 
+    HTML行间代码块 <pre><code>
     HTML段落 <p>
+
+    行间代码块的内容直接生成最终的HTML，在文本块中以一行占位符代替，之后的规则不会在其中匹配，
+    所有规则执行完毕后再由restore换回（见Parser._process）；代码块不放在段落<p>中，
+    起始标志```之后的信息字符串的第一个词作为代码语言，生成<code class="language-xxx">
     """
+    consumes = ('code_block', 'paragraph')
+    after = ('special_char', 'backslash')
+    _fence_pattern = LazyPattern(r'```[ \t]*([^\s`]*)')  # 代码块的起止标志及语言
+    _placeholder_pattern = LazyPattern(r'\x02c(\d+)\x03')  # 代码片段的占位符
+
     def __init__(self):
-        self._code_pattern = re.compile('(?<=^)`{3}.*(?=$)', re.M)
-        self._inside_code = False  # 记录行间代码块的开始和终止
+        self._inside_code = False  # 记录行间代码块的开始和终止，代码块通常整个位于同一文本块中（见Parser.blocks）
+        self._segments = []  # 当前文本块中已生成HTML的代码片段
 
-    @classmethod
-    def special_char_sub(cls, line):
-        """
-        替换代码行中可能会被其它规则错误解析的特殊字符
-        """
-        substring = line
-        substring = re.sub('&', '&amp;', substring)
-        substring = re.sub('#', '&num;', substring)
-        substring = re.sub('_', '&lowbar;', substring)
-        substring = re.sub('\*', '&ast;', substring)
-        substring = re.sub('\+', '&plus;', substring)
-        substring = re.sub('`', '&grave;', substring)
-        substring = re.sub('\[', '&lbrack;', substring)
-        substring = re.sub('\]', '&rbrack;', substring)
-        substring = re.sub('\(', '&lpar;', substring)
-        substring = re.sub('\)', '&rpar;', substring)
-        substring = re.sub('{', '&lbrace;', substring)
-        substring = re.sub('}', '&rbrace;', substring)
-        substring = re.sub(r'\\', '&bsol;', substring)
-        substring = re.sub('!', '&excl;', substring)
-        substring = re.sub('\.', '&period;', substring)
-        substring = re.sub('-', '&#45;', substring)
-        return substring
+    def render_lines(self, block, inside_code):
+        """
+        按代码块状态inside_code处理文本块，返回(行列表, 处理后的代码块状态)，不改变代码块状态；
+        行列表的元素为(行, 是否为普通文本行)，代码片段的HTML保存在self._segments中，行列表中以占位符代替
+        """
+        self._segments = segments = []
+        lines = []
+        code = [] if inside_code else None  # 当前代码片段的各行
+        inside_paragraph = False
+        source = block.split('\n')
+        if not source[-1]:  # 文本块末尾的换行符
+            source.pop()
+        for line in source:
+            if inside_code:
+                if line.startswith('```'):  # 结束当前代码块
+                    code.append('</code></pre>')
+                    inside_code = False
+                else:  # 代码行，SpecialChRule已经转义HTML特殊字符，原样保留
+                    code.append(line + '\n')
+                    continue
+            elif line.startswith('```'):  # 开启新的代码块，先结束之前的段落
+                if inside_paragraph:
+                    lines.append(('</p>', False))
+                    inside_paragraph = False
+                language = self._fence_pattern.match(line).group(1)
+                if language:
+                    code = ['<pre><code class="language-%s">' % language.replace('"', '&quot;')]
+                else:
+                    code = ['<pre><code>']
+                inside_code = True
+                continue
+            elif line:  # 普通文本行
+                if not inside_paragraph:
+                    lines.append(('<p>', False))
+                    inside_paragraph = True
+                lines.append((line, True))
+                continue
+            else:
+                continue
+            # 代码块结束，以占位符代替整个代码片段
+            lines.append(('\x02c%d\x03' % len(segments), False))
+            segments.append(''.join(code))
+            code = None
+        if inside_paragraph:
+            lines.append(('</p>', False))
+        if code is not None:  # 代码块延续到下一个文本块
+            lines.append(('\x02c%d\x03' % len(segments), False))
+            segments.append(''.join(code))
+        return lines, inside_code
+
+    def _placeholder_substring(self, match):
+        """
+        占位符的替换函数，编号不对应代码片段时保持原样
+        """
+        number = int(match.group(1))
+        if number >= len(self._segments):
+            return match.group(0)
+        return self._segments[number]
+
+    def restore(self, block):
+        """
+        将文本块中的占位符换回代码片段的HTML
+        """
+        if self._segments:
+            block = self._placeholder_pattern.sub(self._placeholder_substring, block)
+            self._segments = []
+        return block
 
     def process(self, block):
         """
         按照规则进行处理
         """
-        new_block = ''
-        # 考虑到行间代码有可能整个位于同一block中，因此必须在line level上进行处理
-        # 将block切分成行，注意其末尾可能有\n，如此则split('\n')会产生无意义的空白行
-        line_list = [line for line in block.split('\n') if line]
-        for idx in range(0, len(line_list)):
-            line = line_list[idx]
-            # print('LINE: ' + line)
-            if idx == 0:  # 首行
-                match = self._code_pattern.search(line)  # 找```标志
-                if match and self._inside_code:  # 结束当前代码块
-                    line = '</code></pre>\n</p>'
-                    self._inside_code = False
-                elif match and not self._inside_code:  # 开启当前代码块
-                    line = '<p>\n<pre><code>'
-                    self._inside_code = True
-                elif not self._inside_code:  # 普通文本行
-                    line = '<p>\n' + line
-                    if len(line_list) == 1:  # 如果文本块只有一行，还需添加</p>
-                        line += '\n</p>'
-                else:  # self._inside_code == True，代码行，替换特殊字符
-                    line = self.special_char_sub(line)
-
-            elif idx == len(line_list) - 1:  # 末行
-                match = self._code_pattern.search(line)  # 找```标志
-                if match and self._inside_code:  # 结束当前代码块
-                    line = '</code></pre>\n</p>'
-                    self._inside_code = False
-                elif match and not self._inside_code:  # 开启当前代码块
-                    line = '</p>\n<p>\n<pre><code>'  # 需要首先用</p>结束之前的段落再新开<p><pre><code>
-                    self._inside_code = True
-                elif not self._inside_code:  # 普通文本行
-                    line += '\n</p>'
-                else:  # self._inside_code == True，代码行，替换特殊字符
-                    line = self.special_char_sub(line)
-
-            else:  # 其它行
-                match = self._code_pattern.search(line)  # 搜索当前文本行中的```标志
-                if match and self._inside_code:  # 当前文本行中有```标志且在行间代码块中，结束当前代码块
-                    line = '</code></pre>\n</p>\n<p>'
-                    self._inside_code = False                      
-                elif match and not self._inside_code:  # 当前文本行中有```标志且不在行间代码块中，开启新的代码块
-                    line = '</p>\n<p>\n<code><pre>'
-                    self._inside_code = True
-                elif self._inside_code: # 当前文本行中没有```标志且在行间代码块中，替换特殊字符
-                    line = self.special_char_sub(line)
-                else:  # self._inside_code == False，普通文本行
-                    pass 
-            line += '\n'  # split('\n')切分得到的行本身是没有换行符的，这里添加换行符     
-            new_block += line
-        return new_block
+        lines, self._inside_code = self.render_lines(block, self._inside_code)
+        return ''.join(line + '\n' for line, text in lines)
 
     def reset(self):
         """
         重置规则
         """
         self._inside_code = False
+        self._segments = []
+
+
+
+class ReferenceRule:
+    """
+    参考式链接及图片的定义 [id]: url "title"
+    定义行从输出中删除并登记到文档级的定义索引中，由ImageRule和LinkRule据此解析参考式的图片和链接；
+    引用出现在定义之前时先输出占位符，含有占位符的文本块待定义出现或文档结束后重新转换（见Parser.iter_convert）；
+    经过预扫描（见collect）的文档已知全部定义，未定义的引用直接保留原文，不输出占位符
+    此规则紧接在CodeBlockandParagraphRule之后执行，此时代码行中的[已被转义，不会误认为定义
+    """
+    consumes = ('reference_definition',)
+    triggers = ']'  # 另见may_apply
+    after = ('code_block',)  # 定义须在行间代码块之外，并在行内规则之前移除
+    before = ('inline_code',)
+    _definition_pattern = LazyPattern(r'^ {0,3}\[([^\[\]]+)\]:[ \t]*(?:&lt;(\S+?)&gt;|(\S+))'
+                                      r'(?:[ \t]+(?:"(.*)"|\'(.*)\'|\((.*)\)))?[ \t]*\n', re.M)
+    _prescan_pattern = LazyPattern(r'^(?:```|[^\n]*\]:)[^\n]*', re.M)  # 预扫描时关心的行
+
+    def __init__(self):
+        self._definitions = {}  # 定义索引：规范化的id -> (url, title)
+        self._waiting = set()  # 已被引用但尚未定义的id
+        self._complete = False  # 是否已知整个文档的定义（经过预扫描或文档已经结束）
+        self._escapes = (SpecialChRule(), BackslashRule())  # 预扫描时对定义行进行与规则级联相同的转义
+        self.link_resolver = None  # 参考式链接地址的改写函数，由使用站点链接索引的LinkRule设定
+
+    @classmethod
+    def may_apply(cls, block):
+        """
+        文本块中是否可能含有定义或引用，不含时此规则及参考式链接的解析都不会改变文本块
+        """
+        return ']:' in block or '][' in block or '] [' in block
+
+    @classmethod
+    def _normalize(cls, label):
+        """
+        规范化id：忽略大小写，连续的空白视为一个空格
+        """
+        return ' '.join(label.split()).lower()
+
+    def define(self, label, url, title=None):
+        """
+        登记一个定义，同一id以最先出现的定义为准
+        """
+        key = self._normalize(label)
+        if key not in self._definitions:
+            if title is not None:
+                title = title.replace('"', '&quot;').translate(LINK_ESCAPES)
+            self._definitions[key] = (url.translate(LINK_ESCAPES), title)
+            self._waiting.discard(key)
+
+    def _definition_substring(self, match):
+        """
+        定义行的替换函数，登记定义并删除该行
+        """
+        title = match.group(4)
+        if title is None:
+            title = match.group(5) if match.group(5) is not None else match.group(6)
+        self.define(match.group(1), match.group(2) or match.group(3), title)
+        return ''
+
+    def collect(self, chunks):
+        """
+        预扫描：从文本片段迭代器chunks中收集全部定义，此后的引用都可以立即解析
+        只查找以```开头的行和含有]:的行，不含这两种写法的片段直接跳过
+        chunks须包含整个文档，此后未定义的引用不会再被定义
+        """
+        inside_code = False
+        tail = ''  # 上一片段末尾尚未结束的行
+        for chunk in chunks:
+            text = tail + chunk if tail else chunk
+            end = text.rfind('\n') + 1
+            inside_code = self._collect_text(text, end, inside_code)
+            tail = text[end:]
+        self._collect_text(tail, len(tail), inside_code)
+        self._complete = True
+
+    def _collect_text(self, text, end, inside_code):
+        """
+        从text[:end]中收集定义，返回扫描结束时是否处于代码块中
+        与CodeBlockandParagraphRule相同，以```开头的行切换代码块状态，代码块中的行不视为定义
+        """
+        if '```' not in text and ']:' not in text:
+            return inside_code
+        for match in self._prescan_pattern.finditer(text, 0, end):
+            line = match.group(0)
+            if line.startswith('```'):
+                inside_code = not inside_code
+            elif not inside_code:
+                for rule in self._escapes:
+                    line = rule.process(line)
+                match = self._definition_pattern.match(line.rstrip('\r') + '\n')
+                if match:
+                    self._definition_substring(match)
+        return inside_code
+
+    def _render(self, kind, label, definition):
+        """
+        生成参考式图片或链接的HTML
+        """
+        url, title = definition
+        title = '' if title is None else ' title = "%s"' % title
+        if kind == 'image':
+            return '<img src = "%s" alt = "%s"%s />' % (url, label.translate(LINK_ESCAPES), title)
+        if self.link_resolver is not None:
+            url = self.link_resolver(url)
+        return '<a href = "%s"%s>%s</a>' % (url, title, label.translate(LINK_ESCAPES))
+
+    def reference(self, kind, label, ref, source):
+        """
+        解析一个引用，kind为'image'或'link'，label为文字，ref为id（为空时以文字为id），source为引用的原文
+        id已定义时直接返回HTML；未定义时，预扫描过的或已经结束的文档返回原文，否则返回包裹原文的占位符
+        占位符只标记所在文本块须重新转换，解析结果可能与其前后的文字组成链接或强调，不能在转换后单独替换
+        """
+        key = self._normalize(ref or label)
+        definition = self._definitions.get(key)
+        if definition is not None:
+            return self._render(kind, label, definition)
+        if self._complete:  # 不会再出现定义，不必暂缓之后的输出
+            return source
+        self._waiting.add(key)
+        return '\x02ref \x03%s\x02/ref \x03' % source
+
+    def waiting(self):
+        """
+        是否有尚未定义的引用，此时含有占位符的输出须暂缓输出
+        """
+        return bool(self._waiting)
+
+    @classmethod
+    def unresolved(cls, text):
+        """
+        转换结果text中是否含有未解析引用的占位符
+        """
+        return '\x02/ref \x03' in text
+
+    def finish(self):
+        """
+        文档结束，此后未定义的引用直接保留原文
+        """
+        self._complete = True
+
+    def process(self, block):
+        """
+        按照规则进行处理
+        """
+        if ']:' not in block:
+            return block
+        block = self._definition_pattern.sub(self._definition_substring, block)
+        if block == '<p>\n</p>\n':  # 段落中只有定义
+            return ''
+        return block
+
+    def reset(self):
+        """
+        重置规则，定义索引只在当前文档中有效
+        """
+        self._definitions = {}
+        self._waiting = set()
+        self._complete = False
 
 
 
@@ -177,165 +557,367 @@ class HeaderRule:
     """
     HTML标题 <h1>~<h6>
     """
+    consumes = ('header',)
+    triggers = '#=-'  # Atx标题的#，Setext标题下划线的=或-
+    after = ('inline_code',)  # 行内代码中的#已被转义
+    # Atx风格的<h1>~<h6>标签，根据开头字符#的数目判定层级
+    _atx_pattern = LazyPattern(r'(?<=^)(#+)\s+(.+)(?=$)', re.M)
+    # Setext风格的<h1>、<h2>标签，根据字符=或-判定层级，由_setext_sub扫描（见其说明）
+    _underline_start_pattern = LazyPattern('^[=-]', re.M)  # 以=或-开头的行，可能是下划线
+    _underline_run_pattern = LazyPattern('[=-]+')
+    _space_run_pattern = LazyPattern(r'\s*')
+    _heading_tag_pattern = LazyPattern('<h([1-6])>(.*?)</h\\1>', re.S)  # 生成的标题，见assign_ids
+
     def __init__(self):
-        # Atx风格的<h1>~<h6>标签，根据开头字符#的数目判定层级
-        self._atx_pattern = re.compile('(?<=^)(#+)\s+(.+)(?=$)', re.M)
-        # Setext风格的<h1>、<h2>标签，根据字符=或-判定层级
-        self._setext_pattern = re.compile('(?<=^)\s*(.+)\n([=-]+)\s*(?=$)', re.M)
+        self._anchors = set()  # 当前文档中已使用的锚点
+        self._suffixes = {}  # 重复的锚点下次尝试的后缀，见unique_slug
+        self.outline = []  # 当前文档的标题大纲：[(层级, 锚点, 标题文字), ...]，标题文字已去掉HTML标签
 
     @classmethod
     def _atx_substring(cls, match):
         """
         Atx风格的替换函数，Python正则表达式的替换符可以是函数，其参数是match对象
         """
+        titlestring = cls._atx_title(match.group(2))
+        return '<h%d>%s</h%d>' % (len(match.group(1)), titlestring, len(match.group(1)))
+
+    @classmethod
+    def _atx_title(cls, text):
+        """
+        Atx风格标题#号之后的文字text中的标题，站点链接索引（见LinkIndex）预扫描时以同样方式确定标题
+        """
         # 考虑到闭合形式Atx风格标题，标题文字之后可能跟有若干连续的#字符
-        header_split_last = match.group(2).split(' ', 1)[-1]
+        header_split_last = text.split(' ', 1)[-1]
         # 判断标题后是否跟有一连串的#
         if header_split_last == '#' * len(header_split_last):
-            titlestring = match.group(2).split(' ', 1)[0]
-        else:
-            titlestring = match.group(2)
-        return '<h%d>%s</h%d>' % (len(match.group(1)), titlestring, len(match.group(1)))
+            return text.split(' ', 1)[0]
+        return text
+
+    @classmethod
+    def _underline_end(cls, block, start):
+        """
+        从行首start开始匹配下划线及其后的空白，返回匹配的结束位置，不能匹配时返回-1
+        下划线之后的空白可以跨行，匹配结束于其中最后一个换行符之前；空白延续到文本块末尾时结束于末尾
+        """
+        end = cls._underline_run_pattern.match(block, start).end()
+        space_end = cls._space_run_pattern.match(block, end).end()
+        if space_end == len(block):
+            return space_end
+        return block.rfind('\n', end, space_end)
 
     @classmethod
-    def _setext_substring(cls, match):
+    def _setext_sub(cls, block):
         """
-        Setext风格的替换函数
+        Setext风格的替换，结果与re.sub('(?<=^)\\s*(.+)\\n([=-]+)\\s*(?=$)', ..., block, flags=re.M)相同
+
+        该正则表达式中开头的\\s*与.+可以划分同一串空白，一行开头的n个空白之后没有下划线时回溯约n^2步，
+        下划线之后的\\s*还会跨行匹配。这里按它的回溯顺序直接确定匹配：从行首p开始，
+        跳过空白（可以跨行）后第一个非空白字符所在的行作为标题（其后一行须是下划线）；
+        否则若该字符位于行首且是下划线，其上一行（只有空白）的最后一个字符作为标题。
+        只有以=或-开头的行及其上一行需要检查，每个字符只扫描常数次
         """
-        if match.group(2)[0] == '=':  # 第二行是字符=
-            return '<h1>%s</h1>' % match.group(1)
-        elif match.group(2)[0] == '-':  # 第二行是字符-
-            return '<h2>%s</h2>' % match.group(1)
+        pieces = []
+        copied = 0  # 已复制到结果中的位置
+        position = 0  # 下一次匹配的最早起点（行首）
+        examined = -1  # 上一个检查过的标题行的行首
+        for match in cls._underline_start_pattern.finditer(block):
+            underline = match.start()
+            for start in (block.rfind('\n', 0, underline - 1) + 1 if underline else -1, underline):
+                if start < position or start <= examined:
+                    continue
+                line_end = block.find('\n', start)
+                if line_end < 0:
+                    line_end = len(block)
+                line = block[start:line_end]
+                title_start = start + len(line) - len(line.lstrip())
+                if title_start == line_end:  # 只有空白的行
+                    continue
+                # 匹配的起点：标题行之前连续的只有空白的行的行首
+                lower = max(position, examined)
+                head = block[lower:start].rstrip()
+                match_start = block.find('\n', lower + len(head) - 1) + 1 if head else lower
+                examined = start
+                end = -1
+                if line_end + 1 < len(block) and block[line_end + 1] in '=-':  # 标题行之后是下划线
+                    end = cls._underline_end(block, line_end + 1)
+                    title, mark = block[title_start:line_end], block[line_end + 1]
+                if end < 0 and block[start] in '=-' and start - 2 >= match_start and block[start - 2] != '\n':
+                    # 标题行本身是下划线，其上一行只有空白，最后一个空白字符作为标题
+                    end = cls._underline_end(block, start)
+                    title, mark = block[start - 2], block[start]
+                if end < 0:
+                    continue
+                level = 1 if mark == '=' else 2  # 第二行是字符=或-
+                pieces.append(block[copied:match_start])
+                pieces.append('<h%d>%s</h%d>' % (level, title, level))
+                copied = end
+                position = end if block[end - 1] == '\n' else end + 1  # 匹配结束处之后的第一个行首
+        if not pieces:
+            return block
+        pieces.append(block[copied:])
+        return ''.join(pieces)
 
     def process(self, block):
         """
         按照规则进行处理
         """
         block = self._atx_pattern.sub(self._atx_substring, block)  # Atx <h1>~<h6>
-        block = self._setext_pattern.sub(self._setext_substring, block)  # Setext <h1>、<h2>
+        block = self._setext_sub(block)  # Setext <h1>、<h2>
         return block
 
+    def _heading_id_substring(self, match):
+        """
+        标题加上锚点id的替换函数，同时将标题记入大纲
+        """
+        level, title = int(match.group(1)), match.group(2)
+        anchor = slugify(title)
+        if not anchor:
+            return match.group(0)
+        anchor = unique_slug(anchor, self._anchors, self._suffixes)
+        self.outline.append((level, anchor, _slug_tag_pattern.sub('', title).strip()))
+        return '<h%d id = "%s">%s</h%d>' % (level, anchor, title, level)
+
+    def assign_ids(self, html):
+        """
+        为文本块转换结果html中的标题加上锚点id（见slugify及unique_slug），并按出现顺序记入大纲
+        锚点取决于同一文档中此前的标题，因此由转换器在文本块转换完成之后调用，不随文本块缓存；
+        Atx与Setext标题在此按文档中的顺序统一编号，与站点链接索引（见LinkIndex）预扫描得到的锚点相同
+        """
+        if '<h' not in html:
+            return html
+        return self._heading_tag_pattern.sub(self._heading_id_substring, html)
+
+    def reset(self):
+        """
+        重置规则，锚点和大纲只在当前文档中有效
+        """
+        self._anchors = set()
+        self._suffixes = {}
+        self.outline = []
+
 
 class HrRule:
     """
     HTML水平线 <hr>
     """
-    def __init__(self):
-        self._hr_1_pattern = re.compile('(?<=^)_{3,}(?=$)', re.M)  # 3个以上连续的下划线
-        self._hr_2_pattern = re.compile('(?<=^)\*\s*\*\s*\*(\**|(\s*\*)*)(?=$)', re.M)  # 3个以上星号，中间可以有空格
-        self._hr_3_pattern = re.compile('(?<=^)-\s*-\s*-(-*|(\s*-)*)(?=$)', re.M)  # 3个以上减号，中间可以有空格
+    consumes = ('hr',)
+    triggers = '_*-'
+    after = ('header',)  # Setext标题的下划线---须先由HeaderRule处理
+    _hr_1_pattern = LazyPattern('(?<=^)_{3,}(?=$)', re.M)  # 3个以上连续的下划线
+    # 3个以上星号（减号），中间可以有空格，由_hr_sub扫描（见其说明）
+    _star_start_pattern = LazyPattern(r'^\*', re.M)  # 以星号开头的行
+    _star_head_pattern = LazyPattern(r'\*\s*\*\s*\*\**')  # 前三个星号及紧随其后的星号
+    _star_run_pattern = LazyPattern(r'\*(?:\s*\*)*')  # 以空白分隔的一串星号
+    _dash_start_pattern = LazyPattern('^-', re.M)
+    _dash_head_pattern = LazyPattern(r'-\s*-\s*--*')
+    _dash_run_pattern = LazyPattern(r'-(?:\s*-)*')
+
+    @classmethod
+    def _hr_sub(cls, block, mark, start_pattern, head_pattern, run_pattern):
+        """
+        星号（mark为'*'）或减号（mark为'-'）水平线的替换，以星号为例，
+        结果与re.sub('(?<=^)\\*\\s*\\*\\s*\\*(\\**|(\\s*\\*)*)(?=$)', '<hr />', block, flags=re.M)相同
+
+        该正则表达式中的\\s*可以跨行，每个以星号开头的行都会重新扫描其后以空白分隔的整串星号，
+        "* \\n"重复n次的文本块需要约n^2步。这里按它的回溯顺序直接确定匹配：
+        前三个星号及紧随其后的星号位于行尾时匹配到此为止，否则匹配到这串星号中最后一个位于行尾的星号；
+        同一串星号中各行的最后一个行尾星号相同，只需查找一次
+        """
+        pieces = []
+        copied = 0  # 已复制到结果中的位置
+        run_end = 0  # 当前这串星号的结束位置
+        last = -1  # 当前这串星号中最后一个位于行尾的星号之后的位置
+        for match in start_pattern.finditer(block):
+            start = match.start()
+            if start < copied:
+                continue
+            head = head_pattern.match(block, start)
+            if head is None:
+                continue
+            end = head.end()
+            if end < len(block) and block[end] != '\n':
+                if start >= run_end:
+                    run_end = run_pattern.match(block, start).end()
+                    if run_end == len(block):
+                        last = run_end
+                    else:
+                        last = block.rfind(mark + '\n', start, run_end + 1)
+                        last = last + 1 if last >= 0 else -1
+                if last < end:
+                    continue
+                end = last
+            pieces.append(block[copied:start])
+            pieces.append('<hr />')
+            copied = end
+        if not pieces:
+            return block
+        pieces.append(block[copied:])
+        return ''.join(pieces)
 
     def process(self, block):
         """
         按照规则进行处理
         """
         block = self._hr_1_pattern.sub('<hr />', block)
-        block = self._hr_2_pattern.sub('<hr />', block)
-        block = self._hr_3_pattern.sub('<hr />', block)
+        if '*' in block:
+            block = self._hr_sub(block, '*', self._star_start_pattern, self._star_head_pattern, self._star_run_pattern)
+        if '-' in block:
+            block = self._hr_sub(block, '-', self._dash_start_pattern, self._dash_head_pattern, self._dash_run_pattern)
         return block
 
 
 
-class ListRule:
+class ContainerRule:
     """
-    HTML列表 <ul>、<ol>
+    HTML区块引用 <blockquote> 与列表 <ul>、<ol>
+
+    以容器栈记录当前所在的区块引用和列表（由外到内），逐行扫描文本块一次即可直接确定各容器的起止：
+    行首>（&gt;）的个数为区块引用的层数，列表项的缩进决定列表的层级，
+    缩进比所在列表多_nesting_indent个以上空白时开始嵌套列表，缩进相同而标志类型不同时结束当前列表并开始新列表；
+    文本块中没有引用行时结束全部区块引用，没有列表项时结束最内层区块引用中的全部列表，
+    其余的行视为所在容器的延续
     """
+    consumes = ('blockquote', 'list')
+    after = ('hr',)  # * * *和- - -须先由HrRule处理为水平线
+    # 由于HTML特殊字符的原因，使用中会首先调用SpecialChRule将>替换为&gt;，之后须有空白或位于行尾
+    _quote_pattern = LazyPattern(r'[ ]{0,3}&gt;(?:[ \t]*&gt;)*(?=\s|$)')
+    _item_pattern = LazyPattern(r'(\s*)(?:([\+\-\*])|\d+\.)\s+(.+)$')
+    _item_search_pattern = LazyPattern(r'^\s*(?:[\+\-\*]|\d+\.)\s', re.M)  # 快速判断文本块中是否可能有列表项
+    _nesting_indent = 2  # 嵌套列表相对所在列表的最小缩进
+    _tags = {'blockquote': 'blockquote', 'unord': 'ul', 'ord': 'ol'}
+
     def __init__(self):
-        self._insidelist_unord = False # 记录当前是否在某一无序列表内
-        self._insidelist_ord = False  # 记录当前是否在某一有序列表内
-        self._list_unord_pattern = re.compile('(?<=^)\s*([\+\-\*])\s+(.+)(?=$)', re.M)
-        self._list_ord_pattern = re.compile('(?<=^)\s*(\d+\.)\s+(.+)(?=$)', re.M)
+        # 容器栈，元素为('blockquote', 0)或('unord'/'ord', 列表项缩进)，由外到内排列
+        # 区块引用与列表存在跨文本块的情况，以元组保存以便作为缓存键的一部分
+        self._inside_containers = ()
 
     @classmethod
-    def _list_substring(cls, match):
+    def _close(cls, stack, tags, depth):
         """
-        列表的替换函数
+        关闭容器直至栈中只剩depth个元素，结束标签依次加入tags
         """
-        return '<li>%s</li>\n' % match.group(2)
+        while len(stack) > depth:
+            tags.append('</%s>' % cls._tags[stack.pop()[0]])
 
-    def process(self, block):
+    @classmethod
+    def _quote_depth(cls, stack):
         """
-        按照规则进行处理
+        返回栈中区块引用的层数
         """
-        # 先考虑无序列表
-        tmp_block_unord = self._list_unord_pattern.sub(self._list_substring, block)
-        if self._insidelist_unord:  # 已经在无序列表内
-            if tmp_block_unord == block:  # 当前文本块无列表项，结束当前列表
-                block = '</ul>\n' + tmp_block_unord
-                self._insidelist_unord = False
-            else:  # 当前文本块有列表项，延续当前列表
-                block = tmp_block_unord
-        else:  # 不在无序列表内
-            if tmp_block_unord != block:  # 当前文本块有列表项，开始新的无序列表
-                block = '<ul>\n' + tmp_block_unord
-                self._insidelist_unord = True
-
-        # 再考虑有序列表
-        tmp_block_ord = self._list_ord_pattern.sub(self._list_substring, block)           
-        if self._insidelist_ord:  # 已经在有序列表内
-            if tmp_block_ord == block:  # 当前文本块无列表项，结束当前列表
-                block = '</ol>\n' + tmp_block_ord
-                self._insidelist_ord = False
-            else:  # 当前文本块有列表项，延续当前列表
-                block = tmp_block_ord
-        else:  # 不在有序列表内
-            if tmp_block_ord != block:  # 当前文本块有列表项，开始新的有序列表
-                block = '<ol>\n' + tmp_block_ord
-                self._insidelist_ord = True
-        return block
+        return sum(1 for kind, indent in stack if kind == 'blockquote')
 
-    def reset(self):
+    @classmethod
+    def _innermost_quote(cls, stack):
         """
-        重置规则
+        返回栈中最内层区块引用之上的位置，即属于当前区块引用的列表在栈中的起始位置
         """
-        self._insidelist_unord = False
-        self._insidelist_ord = False
+        for idx in range(len(stack) - 1, -1, -1):
+            if stack[idx][0] == 'blockquote':
+                return idx + 1
+        return 0
 
+    def structure(self, block, containers):
+        """
+        按容器栈containers处理文本块，返回(处理后的文本块, 处理后的容器栈)，不改变规则状态
+        """
+        lines = block.split('\n')
+        parsed = []  # 各行的(区块引用层数, 去掉引用标志后的内容, 列表项)，非引用行的层数为None
+        has_quote = has_item = False
+        quote_match, item_match = self._quote_pattern.match, self._item_pattern.match
+        for line in lines:
+            depth = item = None
+            if '&gt;' in line:
+                match = quote_match(line)
+                if match:
+                    depth = match.group(0).count('&gt;')
+                    line = line[match.end():]  # 保留标志之后的空白
+                    has_quote = True
+            if line and (line[0] in '+-*' or line[0].isdigit() or line[0].isspace()):
+                match = item_match(line)
+                if match:
+                    item = ('unord' if match.group(2) else 'ord', len(match.group(1).expandtabs(4)), match.group(3))
+                    has_item = True
+            parsed.append((depth, line, item))
+        if not has_quote and not has_item:  # 没有引用行和列表项时结束全部容器，文本块不变
+            tags = []
+            self._close(list(containers), tags, 0)
+            return ('\n'.join(tags) + '\n' + block if tags else block), ()
 
-class BlockquoteRule:
-    """
-    HTML区块引用 <blockquote>
-    """
-    def __init__(self):
-        self._insideblockquote = False  # 记录当前是否在某一区块引用内，因为区块引用存在跨文本块的情况
-        # 由于HTML特殊字符的原因，使用中会首先调用SpecialChRule将>替换为&gt;
-        self._blockquote_pattern = re.compile('(?<=^)&gt;(?=\s+.+$)', re.M)
+        stack = list(containers)
+        prefix = []  # 文本块开头的标签：文本块级的结束以及第一个引用行或列表项引起的起止
+        if not has_quote and containers:
+            self._close(stack, prefix, next((idx for idx, (kind, indent) in enumerate(stack)
+                                             if kind == 'blockquote'), len(stack)))
+        if not has_item:
+            self._close(stack, prefix, self._innermost_quote(stack))
+
+        output = []
+        started = False  # 是否已经遇到第一个引用行或列表项
+        for depth, line, item in parsed:
+            tags = prefix if not started else []
+            if depth is not None:
+                quotes = self._quote_depth(stack)
+                while quotes > depth:
+                    if stack[-1][0] == 'blockquote':
+                        quotes -= 1
+                    self._close(stack, tags, len(stack) - 1)
+                for _ in range(depth - quotes):
+                    stack.append(('blockquote', 0))
+                    tags.append('<blockquote>')
+            if item is not None:
+                kind, indent, text = item
+                bottom = self._innermost_quote(stack)
+                while len(stack) > bottom and indent < stack[-1][1]:
+                    self._close(stack, tags, len(stack) - 1)
+                if len(stack) > bottom and indent < stack[-1][1] + self._nesting_indent:  # 同一层的列表项
+                    if stack[-1][0] != kind:
+                        indent = stack[-1][1]
+                        self._close(stack, tags, len(stack) - 1)
+                        stack.append((kind, indent))
+                        tags.append('<%s>' % self._tags[kind])
+                else:  # 开始新的（嵌套）列表
+                    stack.append((kind, indent))
+                    tags.append('<%s>' % self._tags[kind])
+                line = '<li>%s</li>\n' % text
+            if depth is not None or item is not None:
+                if started:
+                    output += tags
+                started = True
+            output.append(line)
+        block = '\n'.join(output)
+        if prefix:
+            block = '\n'.join(prefix) + '\n' + block
+        return block, tuple(stack)
 
     def process(self, block):
         """
         按照规则进行处理
         """
-        tmp_block = self._blockquote_pattern.sub('', block)  # 去掉开头的字符>（&gt;）
-        if self._insideblockquote:  # 当前在区块引用内
-            if tmp_block == block:  # 文本未替换，说明当前文本块无区块引用
-                block = '</blockquote>\n' + tmp_block  # 终止区块引用
-                self._insideblockquote = False  #　重置标志符
-            else:  # 发生了文本替换，说明当前文本块中有区块引用
-                block = tmp_block  #　直接替换文本，延续当前区块引用
-        else:  # 当前不在区块引用内
-            if tmp_block != block:  # 发生了文本替换，说明当前文本块中有区块引用
-                block = '<blockquote>\n' + tmp_block  # 开始区块引用
-                self._insideblockquote = True
-            # 还剩最后一种可能性：不在区块引用内，且未发生文本替换，这种情况不需处理
+        if not self._inside_containers and '&gt;' not in block and not self._item_search_pattern.search(block):
+            return block
+        block, self._inside_containers = self.structure(block, self._inside_containers)
         return block
 
     def reset(self):
         """
         重置规则
         """
-        self._insideblockquote = False
+        self._inside_containers = ()
 
 
 class EmphasisRule:
     """
     HTML强调 <strong> <em>
     """
-    def __init__(self):
-        self._strong_1_pattern = re.compile('\*{2}([^*\s]+)\*{2}')
-        self._strong_2_pattern = re.compile('_{2}([^_\s]+)_{2}')
-        self._em_1_pattern = re.compile('\*([^*\s]+)\*')
-        self._em_2_pattern = re.compile('_([^_\s]+)_')
-    
+    consumes = ('emphasis',)
+    triggers = '*_'
+    after = ('link',)  # 地址中的*和_须先由ImageRule和LinkRule转义
+    # 成对的标记字符写作\*\*而不是\*{2}，正则引擎才能按字面前缀快速跳过无关位置
+    _strong_1_pattern = LazyPattern(r'\*\*([^*\s]+)\*\*')
+    _strong_2_pattern = LazyPattern(r'__([^_\s]+)__')
+    _em_1_pattern = LazyPattern(r'\*([^*\s]+)\*')
+    _em_2_pattern = LazyPattern(r'_([^_\s]+)_')
+
     @classmethod
     def _strong_substring(cls, match):
         """
@@ -354,64 +936,160 @@ class EmphasisRule:
         """
         按照规则进行处理
         """       
-        block = self._strong_1_pattern.sub(self._strong_substring, block)
-        block = self._strong_2_pattern.sub(self._strong_substring, block)
-        block = self._em_1_pattern.sub(self._em_substring, block)
-        block = self._em_2_pattern.sub(self._em_substring, block)
+        # 文本块中没有对应的标记字符时该次替换不会匹配，直接跳过
+        if '**' in block:
+            block = self._strong_1_pattern.sub(self._strong_substring, block)
+        if '__' in block:
+            block = self._strong_2_pattern.sub(self._strong_substring, block)
+        if '*' in block:
+            block = self._em_1_pattern.sub(self._em_substring, block)
+        if '_' in block:
+            block = self._em_2_pattern.sub(self._em_substring, block)
         return block
 
 
 
+class AngleScanner:
+    """
+    自动链接与HTML标签的扫描器，从&lt;开始确定匹配的结束位置
+
+    结果与正则'&lt;([a-zA-z]+://[^\\s]*)&gt;'（自动链接）及'&lt;(/[a-zA-Z]+?[0-9]*?|[a-zA-Z]+?.*?)&gt;'（HTML标签）相同。
+    这两个正则表达式在不能匹配的&lt;处会扫描到非空白串或行的末尾，同一行中的n个&lt;需要约n^2步；
+    匹配的结束位置只取决于其后第一个&gt;、换行符或非空白串中最后一个&gt;，扫描器缓存这些位置，
+    按从左到右的顺序查询时，每个字符只扫描常数次
+    """
+    _scheme_pattern = LazyPattern('&lt;[a-zA-z]+://')
+    _closing_tag_pattern = LazyPattern('&lt;/[a-zA-Z]+[0-9]*&gt;')
+    _nonspace_pattern = LazyPattern(r'\S*')
+
+    def __init__(self, block):
+        self._block = block
+        self._run_end = -1  # 当前非空白串的结束位置
+        self._run_last = -1  # 当前非空白串中最后一个&gt;的位置
+        self._next_close = -1  # 下一个&gt;的位置，没有时为len(block)
+        self._next_newline = -1  # 下一个换行符的位置，没有时为len(block)
+
+    def autolink_end(self, start):
+        """
+        返回从start处的&lt;开始的自动链接的结束位置，不能匹配时返回-1，start须单调不减
+        """
+        block = self._block
+        scheme = self._scheme_pattern.match(block, start)
+        if scheme is None:
+            return -1
+        address = scheme.end()
+        if address > self._run_end:
+            self._run_end = self._nonspace_pattern.match(block, address).end()
+            self._run_last = block.rfind('&gt;', address, self._run_end)
+        # 地址在非空白串中尽量延伸，结束于其中最后一个&gt;
+        return self._run_last + 4 if self._run_last >= address else -1
+
+    def tag_end(self, start):
+        """
+        返回从start处的&lt;开始的HTML标签的结束位置，不能匹配时返回-1，start须单调不减
+        """
+        block = self._block
+        closing = self._closing_tag_pattern.match(block, start)
+        if closing is not None:
+            return closing.end()
+        if start + 4 >= len(block) or block[start + 4] not in _ASCII_LETTERS:
+            return -1
+        # 以字母开头的标签结束于同一行中其后的第一个&gt;
+        if self._next_close < start + 5:
+            self._next_close = block.find('&gt;', start + 5)
+            if self._next_close < 0:
+                self._next_close = len(block)
+        if self._next_newline < start:
+            self._next_newline = block.find('\n', start)
+            if self._next_newline < 0:
+                self._next_newline = len(block)
+        return self._next_close + 4 if self._next_close < self._next_newline else -1
+
+
 class LinkRule:
     """
     HTML链接 <a>
     HTML标签
     """
-    def __init__(self):
-        self._link_1_pattern = re.compile('\[([^\[\]]+)\]\(([^\(\)]+)\)')
-        self._link_2_pattern = re.compile('&lt;([a-zA-z]+://[^\s]*)&gt;')
-        self._email_pattern = re.compile('&lt;(\w+([-+.]\w+)*@\w+([-.]\w+)*\.\w+([-.]\w+)*)&gt;')
-        self._html_tag_pattern = re.compile('&lt;(/[a-zA-Z]+?[0-9]*?|[a-zA-Z]+?.*?)&gt;')
-        random.seed()
+    consumes = ('link', 'autolink', 'email', 'html_tag')
+    triggers = '[&'  # 链接的[，自动链接、Email及HTML标签的&lt;
+    after = ('image',)  # 图片的![...](...)中含有链接的写法
+    _link_1_pattern = LazyPattern(r'\[([^\[\]]+)\]\(([^\(\)]+)\)')
+    # 域名以-或.分隔，至少有一个.；原写法'\w+([-.]\w+)*\.\w+([-.]\w+)*'中必需的.可以是任意一个.，
+    # 匹配失败时回溯次数与域名长度的平方成正比，这里限定为第一个.，匹配的语言不变
+    _email_pattern = LazyPattern(r'&lt;(\w+(?:[-+.]\w+)*@\w+(?:-\w+)*\.\w+(?:[-.]\w+)*)&gt;')
+    _link_ref_pattern = LazyPattern(r'(?<!!)\[([^\[\]]+)\] ?\[([^\[\]]*)\]')  # 参考式链接，排除未解析的参考式图片
+
+    email_obfuscations = ('random', 'deterministic')  # Email地址的混淆方式
+
+    def __init__(self, references=None, email_obfuscation='random', link_index=None):
+        """
+        构造函数
+        email_obfuscation为'random'时Email地址中的字符随机替换为编码，每次转换的结果不同；
+        为'deterministic'时由地址的散列值决定替换哪些字符，同一地址在任何进程中的结果都相同，便于缓存和比较输出
+        link_index为站点链接索引时，指向站点中其它Markdown文档的链接（包括参考式链接）改写为对应的HTML文件，
+        并对指向不存在的文档或锚点的链接打印警告；须在转换每个文件之前调用begin_document
+        """
+        if email_obfuscation not in self.email_obfuscations:
+            raise ValueError('Unknown email obfuscation "%s".' % email_obfuscation)
+        if email_obfuscation == 'random':
+            random.seed()
+            self._render_email = self._random_render_email
+        else:
+            self._render_email = self._deterministic_render_email
+        self._references = references  # 解析参考式链接的ReferenceRule，为None时不支持参考式链接
+        self._link_index = link_index  # 站点链接索引（见LinkIndex），为None时链接地址保持原样
+        self._document = None  # 当前文档在站点链接索引中的相对路径，见begin_document
+        self._reported = set()  # 当前文档中已报告的失效链接
+        if link_index is not None and references is not None:
+            references.link_resolver = self._resolve
+
+    def begin_document(self, inputfile):
+        """
+        开始转换输入文件inputfile，此后其中的相对链接以该文件所在的目录为基准解析
+        """
+        if self._link_index is not None:
+            self._document = self._link_index.document_of(inputfile)
+
+    def _resolve(self, address):
+        """
+        由站点链接索引改写指向其它Markdown文档的链接地址，指向不存在的文档或锚点时打印警告（每个文档中只报告一次）
+        """
+        if self._document is None:
+            return address
+        address, problem = self._link_index.resolve(self._document, address)
+        if problem is not None and problem not in self._reported:
+            self._reported.add(problem)
+            print('Warning: "%s" %s.' % (self._document, problem))
+        return address
 
     @classmethod
     def _render_link(cls, address):
         """
         对address进行修饰，替换其中的Markdown特殊字符*和_，以及字符[、]、(和)
         """
-        new_address = ''
-        for c in address:
-            if c == '_':
-                new_address += '&lowbar;'
-            elif c == '*':
-                new_address += '&ast;'
-            elif c == '[':
-                new_address += '&lbrack;'
-            elif c == ']':
-                new_address += '&rbrack;'
-            elif c == '(':
-                new_address += '&lpar;'
-            elif c == ')':
-                new_address += '&rpar;'
-            else:
-                new_address += c
-        return new_address
+        return address.translate(LINK_ESCAPES)
 
-    @classmethod
-    def _link_1_substring(cls, match):
+    def _link_html(self, text, address):
         """
-        链接的替换函数
+        链接[text](address)的HTML
         """
-        linkstring1 = LinkRule._render_link(match.group(1))
-        linkstring2 = LinkRule._render_link(match.group(2))
+        linkstring1 = LinkRule._render_link(text)
+        linkstring2 = LinkRule._render_link(self._resolve(address))
         return '<a href = "%s">%s</a>' % (linkstring2, linkstring1)
 
-    @classmethod
-    def _link_2_substring(cls, match):
+    def _link_1_substring(self, match):
         """
         链接的替换函数
         """
-        linkstring = LinkRule._render_link(match.group(1))
+        return self._link_html(match.group(1), match.group(2))
+
+    @classmethod
+    def _autolink_html(cls, address):
+        """
+        自动链接&lt;address&gt;的HTML
+        """
+        linkstring = LinkRule._render_link(address)
         return '<a href = "%s">%s</a>' % (linkstring, linkstring)
 
     @classmethod
@@ -420,91 +1098,140 @@ class LinkRule:
         Markdown语法要求对email地址进行处理，将其中某些字符改为对应的HTML实体编码或ASCII编码
         如此可避免部分垃圾邮件骚扰
         """
-        new_email = ''
-        for c in email:
-            if c == '@':
-                new_email += '&#64;'
-            elif c == '.':
-                new_email += '&#x2E;'
-            elif c == '_':
-                new_email += '&lowbar;'
-            elif c == '*':
-                new_email += '&ast;'
-            elif random.random() > 0.2:
-                new_email += ('&#x' + binascii.b2a_hex(c.encode()).decode() + ';')
-            else:
-                new_email += c
-        return new_email
+        # 随机数的抽取顺序与逐字符处理时相同：固定替换的字符不抽取，其余字符各抽取一次
+        rand = random.random
+        return ''.join(EMAIL_ENTITIES.get(c) or (_hex_entity(c) if rand() > 0.2 else c)
+                       for c in email)
 
     @classmethod
-    def _email_substring(cls, match):
+    def _deterministic_render_email(cls, email):
+        """
+        与_random_render_email相同，但由email的SHAKE-256散列值决定各字符是否替换为编码，结果可以缓存
+        """
+        try:
+            return _deterministic_emails[email]
+        except KeyError:
+            pass
+        # 散列值的每个字节对应一个字符，与随机方式相同，约80%的字符替换为编码
+        digest = hashlib.shake_256(email.encode()).digest(len(email))
+        rendered = ''.join(EMAIL_ENTITIES.get(c) or (_hex_entity(c) if byte > 51 else c)
+                           for c, byte in zip(email, digest))
+        if len(_deterministic_emails) >= _DETERMINISTIC_EMAIL_CACHE:
+            _deterministic_emails.clear()
+        _deterministic_emails[email] = rendered
+        return rendered
+
+    def _email_substring(self, match):
         """
         Email链接的替换函数
         """
-        email_address = LinkRule._random_render_email(match.group(1)) # 处理email地址
+        email_address = self._render_email(match.group(1)) # 处理email地址
         return '<a href = "&#x6D;&#x61;&#x69;l&#x74;&#x6F;:%s">%s</a>' % (email_address, email_address)
 
     @classmethod
-    def _html_tag_substring(cls, match):
+    def _html_tag_html(cls, tag):
         """
-        HTML标签替换函数
+        HTML标签&lt;tag&gt;的HTML
         """
-        return '<%s>' % match.group(1)
+        return '<%s>' % tag
+
+    @classmethod
+    def _angle_sub(cls, block, end_of, render):
+        """
+        替换block中的自动链接或HTML标签，end_of为AngleScanner的方法名'autolink_end'或'tag_end'，
+        render由&lt;与&gt;之间的文本生成HTML
+        """
+        end_of = getattr(AngleScanner(block), end_of)
+        pieces = []
+        copied = 0  # 已复制到结果中的位置
+        start = block.find('&lt;')
+        while start >= 0:
+            end = end_of(start)
+            if end >= 0:
+                pieces.append(block[copied:start])
+                pieces.append(render(block[start + 4:end - 4]))
+                copied = end
+            start = block.find('&lt;', max(end, start + 1))
+        if not pieces:
+            return block
+        pieces.append(block[copied:])
+        return ''.join(pieces)
+
+    def _link_ref_substring(self, match):
+        """
+        参考式链接的替换函数
+        """
+        return self._references.reference('link', match.group(1), match.group(2), match.group(0))
 
     def process(self, block):
         """
         按照规则进行处理
         """
         block = self._link_1_pattern.sub(self._link_1_substring, block)
-        block = self._link_2_pattern.sub(self._link_2_substring, block)
-        block = self._email_pattern.sub(self._email_substring, block)
-        block = self._html_tag_pattern.sub(self._html_tag_substring, block)
+        if self._references is not None and ('][' in block or '] [' in block):
+            block = self._link_ref_pattern.sub(self._link_ref_substring, block)
+        if '&lt;' in block:
+            block = self._angle_sub(block, 'autolink_end', self._autolink_html)
+            block = self._email_pattern.sub(self._email_substring, block)
+            block = self._angle_sub(block, 'tag_end', self._html_tag_html)
         return block
 
+    def reset(self):
+        """
+        重置规则，当前文档在转换下一个文件之前由begin_document重新设定
+        """
+        self._document = None
+        self._reported = set()
+
 class ImageRule:
     """
     HTML链接 <a>
     """
-    def __init__(self):
-        self._img_pattern = re.compile('!\[([^\[\]]+)\]\(([^\(\)]+)\)')
+    consumes = ('image',)
+    triggers = '!'
+    after = ('blockquote', 'list')  # 行内规则在块级规则之后执行
+    _img_pattern = LazyPattern(r'!\[([^\[\]]+)\]\(([^\(\)]+)\)')
+    _img_ref_pattern = LazyPattern(r'!\[([^\[\]]+)\] ?\[([^\[\]]*)\]')  # 参考式图片
+
+    def __init__(self, references=None):
+        self._references = references  # 解析参考式图片的ReferenceRule，为None时不支持参考式图片
 
     @classmethod
     def _render_link(cls, address):
         """
         对address进行修饰，替换其中的Markdown特殊字符*和_，以及字符[、]、(和)
         """
-        new_address = ''
-        for c in address:
-            if c == '_':
-                new_address += '&lowbar;'
-            elif c == '*':
-                new_address += '&ast;'
-            elif c == '[':
-                new_address += '&lbrack;'
-            elif c == ']':
-                new_address += '&rbrack;'
-            elif c == '(':
-                new_address += '&lpar;'
-            elif c == ')':
-                new_address += '&rpar;'
-            else:
-                new_address += c
-        return new_address
+        return address.translate(LINK_ESCAPES)
+
+    @classmethod
+    def _img_html(cls, text, address):
+        """
+        图片![text](address)的HTML
+        """
+        linkstring1 = ImageRule._render_link(text)
+        linkstring2 = ImageRule._render_link(address)
+        return '<img src = "%s" alt = "%s" />' % (linkstring2, linkstring1)
 
     @classmethod
     def _img_substring(cls, match):
         """
         链接的替换函数
         """
-        linkstring1 = ImageRule._render_link(match.group(1))
-        linkstring2 = ImageRule._render_link(match.group(2))
-        return '<img src = "%s" alt = "%s" />' % (linkstring2, linkstring1)
+        return cls._img_html(match.group(1), match.group(2))
+
+    def _img_ref_substring(self, match):
+        """
+        参考式图片的替换函数
+        """
+        return self._references.reference('image', match.group(1), match.group(2), match.group(0))
 
     def process(self, block):
         """
         按照规则进行处理
         """
         block = self._img_pattern.sub(self._img_substring, block)
+        if self._references is not None and ('][' in block or '] [' in block):
+            block = self._img_ref_pattern.sub(self._img_ref_substring, block)
         return block
 
 
@@ -513,44 +1240,17 @@ class BackslashRule:
     """
     反斜杠逃逸
     """
-    def __init__(self):
-        self._backslash_pattern = re.compile(r'\\([*+()[\]{}\\_.!#`-])')
+    consumes = ('backslash',)
+    triggers = '\\'
+    after = ('special_char',)
+    _backslash_pattern = LazyPattern(r'\\([*+()[\]{}\\_.!#`-])')
 
     @classmethod
     def _backslash_substring(cls, match):
         """
         反斜杠逃逸替换函数
         """
-        if match.group(1) == '_':
-            return '&lowbar;'
-        elif match.group(1) == '*':
-            return '&ast;'
-        elif match.group(1) == '+':
-            return '&plus;'
-        elif match.group(1) == '`':
-            return '&grave;'
-        elif match.group(1) == '[':
-            return '&lbrack;'
-        elif match.group(1) == ']':
-            return '&rbrack;'
-        elif match.group(1) == '(':
-            return '&lpar;'
-        elif match.group(1) == ')':
-            return '&rpar;'
-        elif match.group(1) == '{':
-            return '&lbrace;'
-        elif match.group(1) == '}':
-            return '&rbrace;' 
-        elif match.group(1) == '\\':
-            return '&bsol;'
-        elif match.group(1) == '#':
-            return '&num;'
-        elif match.group(1) == '!':
-            return '&excl;'
-        elif match.group(1) == '.':
-            return '&period;'
-        else:    # match.group(1) == '-'
-            return '&#45;'
+        return ENTITIES[match.group(1)]
 
     def process(self, block):
         """
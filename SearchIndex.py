@@ -0,0 +1,447 @@
+"""
+全文检索索引
+
+转换时由SectionCollector在同一遍转换中按标题把正文切分为小节，记录各小节的纯文本；
+IndexBuilder据此建立倒排索引（词项 -> 含有该词项的小节及词频），写成一个紧凑的二进制文件，
+SearchIndex以mmap打开该文件，查询时只对词项表做二分查找并读取命中词项的倒排表，不需要把索引读入内存
+
+再次转换时IndexBuilder先从原索引中合并未修改文档的倒排表，再加入重新转换的文档，
+增量转换只需对修改过的文档分词
+
+词项：英文等以空白分隔的文字按\\w+切分并转为小写；中日文字（汉字、假名）没有分隔，连续的一串切分为相邻两字的组合，
+单独一个字时即为该字本身；查询时对查询文字做同样的切分，返回包含全部词项的小节
+
+使用：
+    (1). python SearchIndex.py output/search.idx 安装 linux  # 查询索引，打印得分最高的小节
+    (2). python SearchIndex.py -n 50 output/search.idx parser  # 最多打印50个结果
+
+    builder = IndexBuilder()
+    builder.add('guide/install.html', [(anchor, title, count_terms(title + '\\n' + text)) for anchor, title, text in parser.sections()])
+    builder.write('output/search.idx')
+    for score, document, anchor, title in query('output/search.idx', '安装 linux'):
+        print(document, anchor, title)
+"""
+
+import os, re, sys, html, math, mmap, array, struct, argparse, collections
+
+
+MAGIC = b'MDSRCH\x01\x00'  # 索引文件头
+MAX_TERM_LENGTH = 64  # 更长的词项（如base64编码的数据）不编入索引
+# 文件头：文件头标识，文档数，小节数，词项数，倒排记录数，字符串区字节数
+_HEADER = struct.Struct('<8s5Q')
+# 文件头之后依次为以下各表，表中均为小端序的32位无符号整数，字符串以(在字符串区中的偏移, UTF-8字节数)表示：
+#     文档表：(路径,)
+#     小节表：(文档序号, 锚点, 标题)
+#     词项表：(词项, 倒排表起始位置, 倒排记录数)，按词项的UTF-8字节序排列
+#     倒排表：(小节序号, 词频)，同一词项的记录按小节序号排列
+# 最后是字符串区
+_DOCUMENT_FIELDS, _SECTION_FIELDS, _TERM_FIELDS, _POSTING_FIELDS = 2, 5, 4, 2
+
+_CJK = '぀-ヿ㐀-䶿一-鿿豈-﫿'  # 假名及汉字
+_word_pattern = re.compile('[^\\W%s]+' % _CJK)  # 以空白和标点分隔的词
+_cjk_pattern = re.compile('[%s]+' % _CJK)  # 连续的中日文字
+
+
+def _cjk_terms(text):
+    """
+    逐个生成text中中日文字的词项
+    """
+    for word in _cjk_pattern.findall(text):
+        if len(word) == 1:
+            yield word
+        else:
+            for idx in range(len(word) - 1):
+                yield word[idx:idx + 2]
+
+
+def terms(text):
+    """
+    返回text中的词项列表，先是以空白和标点分隔的词，后是中日文字的词项
+    """
+    text = text.lower()
+    result = [word for word in _word_pattern.findall(text) if len(word) <= MAX_TERM_LENGTH]
+    result.extend(_cjk_terms(text))
+    return result
+
+
+def count_terms(text):
+    """
+    返回text中各词项的出现次数：词项 -> 次数
+    词的计数全部由Counter在C代码中完成，只有出现中日文字时才逐字切分
+    """
+    text = text.lower()
+    counts = collections.Counter(_word_pattern.findall(text))
+    for word in [word for word in counts if len(word) > MAX_TERM_LENGTH]:
+        del counts[word]
+    if _cjk_pattern.search(text):
+        counts.update(_cjk_terms(text))
+    return dict(counts)
+
+
+def document_path(filename, base):
+    """
+    返回文件filename相对于目录base的路径（以/分隔），作为索引中文档的路径
+    """
+    return os.path.relpath(os.path.abspath(filename), base).replace(os.sep, '/')
+
+
+class SectionCollector:
+    """
+    由转换器输出的HTML片段收集各小节的纯文本
+
+    每个标题开始一个新的小节，直到下一个标题（不论层级）为止；第一个标题之前的正文为一个锚点为空的小节，
+    标题为文档标题。标签替换为空白，实体还原为字符
+    """
+    _heading_pattern = re.compile('<h[1-6](?: id = "([^"]*)")?>(.*?)</h[1-6]>', re.S)
+    _tag_pattern = re.compile('<[^<>]*>')
+
+    def __init__(self, title=None):
+        """
+        构造函数，title为文档标题
+        """
+        self._sections = [['', title or '', []]]  # [[锚点, 标题, 正文HTML片段], ...]
+
+    def feed(self, fragment):
+        """
+        加入一个HTML片段，片段由完整的文本块转换而来，其中的标题不会被切开
+        """
+        position = 0
+        for match in self._heading_pattern.finditer(fragment):
+            self._sections[-1][2].append(fragment[position:match.start()])
+            self._sections.append([html.unescape(match.group(1) or ''), self.plain_text(match.group(2)), []])
+            position = match.end()
+        self._sections[-1][2].append(fragment[position:])
+
+    @classmethod
+    def plain_text(cls, fragment):
+        """
+        返回HTML片段fragment的纯文本，连续的空白合并为一个空格
+        """
+        return ' '.join(html.unescape(cls._tag_pattern.sub(' ', fragment)).split())
+
+    def sections(self):
+        """
+        返回[(锚点, 标题, 纯文本), ...]，按小节在文档中出现的顺序排列；第一个标题之前没有正文时不含该小节
+        """
+        result = [(anchor, title, self.plain_text(''.join(parts))) for anchor, title, parts in self._sections]
+        if not result[0][2]:
+            del result[0]
+        return result
+
+
+def _u32_array(values):
+    """
+    返回以小端序保存values的32位无符号整数数组
+    """
+    data = array.array('I', values)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data
+
+
+class IndexBuilder:
+    """
+    倒排索引的构造器
+    """
+    def __init__(self):
+        self._documents = []  # 文档路径，下标为文档序号
+        self._sections = []  # (文档序号, 锚点, 标题)，下标为小节序号
+        self._postings = {}  # 词项 -> [小节序号, 词频, 小节序号, 词频, ...]
+
+    def __len__(self):
+        return len(self._documents)
+
+    def section_count(self):
+        return len(self._sections)
+
+    def term_count(self):
+        return len(self._postings)
+
+    def add(self, document, sections):
+        """
+        加入文档document（路径），sections为[(锚点, 标题, 词频), ...]，词频为词项 -> 出现次数（见count_terms）
+        """
+        doc = len(self._documents)
+        self._documents.append(document)
+        postings = self._postings
+        for anchor, title, counts in sections:
+            section = len(self._sections)
+            self._sections.append((doc, anchor, title))
+            for term, count in counts.items():
+                entry = postings.get(term)
+                if entry is None:
+                    postings[term] = [section, count]
+                else:
+                    entry.append(section)
+                    entry.append(count)
+
+    def merge(self, index, keep):
+        """
+        从已有的索引index（SearchIndex）中合并keep(文档路径)为True的文档，不需要重新分词
+        """
+        documents = {}  # 原文档序号 -> 新文档序号
+        for doc, document in enumerate(index.documents()):
+            if keep(document):
+                documents[doc] = len(self._documents)
+                self._documents.append(document)
+        if not documents:
+            return
+        sections = {}  # 原小节序号 -> 新小节序号
+        for section in range(index.section_count()):
+            doc, anchor, title = index.section(section)
+            if doc in documents:
+                sections[section] = len(self._sections)
+                self._sections.append((documents[doc], anchor, title))
+        postings = self._postings
+        for term, records in index.items():
+            entry = None
+            for idx in range(0, len(records), 2):
+                section = sections.get(records[idx])
+                if section is None:
+                    continue
+                if entry is None:
+                    entry = postings.setdefault(term, [])
+                entry.append(section)
+                entry.append(records[idx + 1])
+
+    def write(self, filename):
+        """
+        写入索引文件，先写入临时文件再替换，避免中途失败损坏已有的索引
+        字符串区超过4GB时抛出ValueError，无法写入时抛出OSError
+        """
+        strings = bytearray()
+        offsets = {}  # 字符串 -> (偏移, 字节数)，相同的字符串只保存一次
+
+        def string(text):
+            location = offsets.get(text)
+            if location is None:
+                data = text.encode('utf-8')
+                location = offsets[text] = (len(strings), len(data))
+                strings.extend(data)
+            return location
+
+        documents = []
+        for document in self._documents:
+            documents.extend(string(document))
+        sections = []
+        for doc, anchor, title in self._sections:
+            sections.append(doc)
+            sections.extend(string(anchor))
+            sections.extend(string(title))
+        table = []
+        postings = array.array('I')
+        for data, term in sorted((term.encode('utf-8'), term) for term in self._postings):
+            entry = self._postings[term]
+            table.extend(string(term))
+            table.append(len(postings) // _POSTING_FIELDS)
+            table.append(len(entry) // _POSTING_FIELDS)
+            postings.extend(entry)
+        if len(strings) > 0xffffffff or len(postings) > 0xffffffff:
+            raise ValueError('Search index is too large.')
+        if sys.byteorder == 'big':
+            postings.byteswap()
+
+        tmpfile = filename + '.tmp'
+        with open(tmpfile, 'wb') as fou:
+            fou.write(_HEADER.pack(MAGIC, len(self._documents), len(self._sections), len(self._postings),
+                                   len(postings) // _POSTING_FIELDS, len(strings)))
+            for values in (documents, sections, table):
+                fou.write(_u32_array(values).tobytes())
+            fou.write(postings.tobytes())
+            fou.write(strings)
+        os.replace(tmpfile, filename)
+
+
+class SearchIndex:
+    """
+    以mmap打开的只读索引文件
+    """
+    def __init__(self, filename):
+        """
+        构造函数，文件无法读取时抛出OSError，不是索引文件或已损坏时抛出ValueError
+        """
+        self._map = None
+        self._views = []
+        with open(filename, 'rb') as fin:
+            header = fin.read(_HEADER.size)
+            if len(header) < _HEADER.size or not header.startswith(MAGIC):
+                raise ValueError('Not a search index.')
+            magic, documents, sections, terms, postings, size = _HEADER.unpack(header)
+            self._map = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            position = _HEADER.size
+            self._documents = self._table(position, documents * _DOCUMENT_FIELDS)
+            position += documents * _DOCUMENT_FIELDS * 4
+            self._sections = self._table(position, sections * _SECTION_FIELDS)
+            position += sections * _SECTION_FIELDS * 4
+            self._terms = self._table(position, terms * _TERM_FIELDS)
+            position += terms * _TERM_FIELDS * 4
+            self._postings = self._table(position, postings * _POSTING_FIELDS)
+            self._strings = position + postings * _POSTING_FIELDS * 4  # 字符串区的起始位置
+            if self._strings + size != len(self._map):
+                raise ValueError('Truncated or corrupt search index.')
+        except ValueError:
+            self.close()
+            raise
+        self._term_count = terms
+
+    def _table(self, position, count):
+        """
+        返回从position处开始的count个32位无符号整数
+        """
+        if position + count * 4 > len(self._map):
+            raise ValueError('Truncated or corrupt search index.')
+        if sys.byteorder == 'big':
+            data = array.array('I', self._map[position:position + count * 4])
+            data.byteswap()
+            return data
+        view = memoryview(self._map)[position:position + count * 4].cast('I')
+        self._views.append(view)
+        return view
+
+    def close(self):
+        """
+        关闭索引文件
+        """
+        for view in self._views:
+            view.release()
+        self._views = []
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self._documents) // _DOCUMENT_FIELDS
+
+    def _string(self, offset, size):
+        start = self._strings + offset
+        return self._map[start:start + size].decode('utf-8')
+
+    def documents(self):
+        """
+        返回全部文档的路径，下标为文档序号
+        """
+        table = self._documents
+        return [self._string(table[idx], table[idx + 1]) for idx in range(0, len(table), _DOCUMENT_FIELDS)]
+
+    def section_count(self):
+        return len(self._sections) // _SECTION_FIELDS
+
+    def section(self, section):
+        """
+        返回小节的(文档序号, 锚点, 标题)
+        """
+        doc, anchor, anchor_size, title, title_size = self._sections[section * _SECTION_FIELDS:
+                                                                     (section + 1) * _SECTION_FIELDS]
+        return doc, self._string(anchor, anchor_size), self._string(title, title_size)
+
+    def term_count(self):
+        return self._term_count
+
+    def _records(self, idx):
+        """
+        返回词项表中第idx个词项的倒排表：[小节序号, 词频, 小节序号, 词频, ...]
+        """
+        start, count = self._terms[idx * _TERM_FIELDS + 2:idx * _TERM_FIELDS + 4]
+        return self._postings[start * _POSTING_FIELDS:(start + count) * _POSTING_FIELDS].tolist()
+
+    def items(self):
+        """
+        按词项表的顺序逐个生成(词项, 倒排表)
+        """
+        table = self._terms
+        for idx in range(self._term_count):
+            yield self._string(table[idx * _TERM_FIELDS], table[idx * _TERM_FIELDS + 1]), self._records(idx)
+
+    def postings(self, term):
+        """
+        返回词项term的倒排表[(小节序号, 词频), ...]，按小节序号排列；索引中没有该词项时返回空列表
+        """
+        key = term.encode('utf-8')
+        table = self._terms
+        low, high = 0, self._term_count
+        while low < high:  # 在按字节序排列的词项表中二分查找
+            middle = (low + high) // 2
+            start = self._strings + table[middle * _TERM_FIELDS]
+            current = self._map[start:start + table[middle * _TERM_FIELDS + 1]]
+            if current < key:
+                low = middle + 1
+            elif current > key:
+                high = middle
+            else:
+                records = self._records(middle)
+                return list(zip(records[0::2], records[1::2]))
+        return []
+
+    def search(self, text, limit=10):
+        """
+        查询包含text中全部词项的小节，返回得分最高的至多limit个结果[(得分, 文档路径, 锚点, 标题), ...]
+        得分为各词项的(1 + log词频) * log(1 + 小节总数 / 含有该词项的小节数)之和
+        """
+        words = set(terms(text))
+        if not words:
+            return []
+        total = self.section_count()
+        lists = sorted((self.postings(word) for word in words), key=len)
+        scores = None  # 小节序号 -> 得分
+        for postings in lists:
+            if not postings:
+                return []
+            weight = math.log(1 + total / len(postings))
+            if scores is None:
+                scores = dict((section, (1 + math.log(count)) * weight) for section, count in postings)
+                continue
+            matched = {}
+            for section, count in postings:
+                score = scores.get(section)
+                if score is not None:
+                    matched[section] = score + (1 + math.log(count)) * weight
+            scores = matched
+            if not scores:
+                return []
+        documents = self.documents()
+        results = []
+        for section, score in sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]:
+            doc, anchor, title = self.section(section)
+            results.append((score, documents[doc], anchor, title))
+        return results
+
+
+def query(filename, text, limit=10):
+    """
+    打开索引文件filename，查询包含text中全部词项的小节（见SearchIndex.search）
+    """
+    with SearchIndex(filename) as index:
+        return index.search(text, limit)
+
+
+
+if __name__ == '__main__':  # 主程序
+
+    argparser = argparse.ArgumentParser(description='Query a search index written by md2html.py --search-index.')
+    argparser.add_argument('index', help='search index file')
+    argparser.add_argument('words', nargs='+', help='words that every matching section must contain')
+    argparser.add_argument('-n', '--limit', type=int, default=10, help='maximum number of results (default: 10)')
+    args = argparser.parse_args()
+
+    try:
+        with SearchIndex(args.index) as index:
+            results = index.search(' '.join(args.words), args.limit)
+            print('%d document(s), %d section(s), %d term(s).' % (len(index), index.section_count(), index.term_count()))
+    except OSError as error:
+        print('Fatal Error: Cannot read search index "%s": %s.' % (args.index, error.strerror))
+        sys.exit(2)
+    except ValueError as error:
+        print('Fatal Error: %s' % error)
+        sys.exit(2)
+    for score, document, anchor, title in results:
+        print('%8.3f  %s%s  %s' % (score, document, '#' + anchor if anchor else '', title))
+    if not results:
+        print('No matching sections.')
+        sys.exit(1)
@@ -0,0 +1,319 @@
+"""
+Markdown转换服务
+
+基于asyncio的HTTP服务，预先构造一组转换器常驻内存，避免每次转换都要启动解释器、导入模块并编译正则表达式
+转换在线程池（或进程池）中执行，不阻塞事件循环；转换器用完后重置状态再放回池中
+
+使用：
+    (1). python Server.py  # 监听127.0.0.1:8000，以4个线程转换
+    (2). python Server.py --port 9000 --threads 8  # 指定端口和线程数
+    (3). python Server.py --unix /tmp/md2html.sock  # 监听Unix域套接字
+    (4). python Server.py --processes 4  # 以4个工作进程转换，可利用多个CPU核心
+
+    curl --data-binary @test.md http://127.0.0.1:8000/convert  # 返回HTML正文片段
+    curl --data-binary @test.md 'http://127.0.0.1:8000/convert?full=1&title=test'  # 返回完整页面
+    curl http://127.0.0.1:8000/stats  # 请求计数及延迟直方图
+"""
+
+import sys, json, time, asyncio, argparse, concurrent.futures
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qs
+import Rule
+from Parser import Parser
+
+
+MAX_BODY = 8 << 20  # 请求正文的默认最大字节数
+MAX_HEADERS = 100  # 请求头的最大行数
+# 延迟直方图各区间的上界（毫秒）
+LATENCY_BOUNDS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class LatencyHistogram:
+    """
+    延迟直方图，各区间的上界由bounds给出（毫秒），超出最大上界的计入最后一个区间
+    """
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)
+        self._total = 0.0
+        self._max = 0.0
+
+    def record(self, seconds):
+        """
+        记录一次耗时
+        """
+        ms = seconds * 1000
+        for idx, bound in enumerate(self._bounds):
+            if ms <= bound:
+                break
+        else:
+            idx = len(self._bounds)
+        self._counts[idx] += 1
+        self._total += ms
+        self._max = max(self._max, ms)
+
+    def to_dict(self):
+        """
+        返回可保存为JSON的统计结果
+        """
+        count = sum(self._counts)
+        labels = ['<=%gms' % bound for bound in self._bounds] + ['>%gms' % self._bounds[-1]]
+        return {
+            'count': count,
+            'mean_ms': self._total / count if count else 0.0,
+            'max_ms': self._max,
+            'buckets': dict(zip(labels, self._counts)),
+        }
+
+
+class ParserPool:
+    """
+    转换器池，保存预先构造好的转换器，同一时刻每个转换器只由一个请求使用
+    """
+    def __init__(self, size, options=None):
+        """
+        构造函数，size为转换器数目，options为构造转换器的参数（见Parser）
+        """
+        Rule.warm_up()
+        self._parsers = asyncio.Queue()
+        for _ in range(size):
+            self._parsers.put_nowait(Parser(**(options or {})))
+
+    async def acquire(self):
+        """
+        取出一个空闲的转换器，没有空闲转换器时等待
+        """
+        return await self._parsers.get()
+
+    def release(self, parser):
+        """
+        重置转换器的状态并放回池中
+        """
+        parser.reset()
+        self._parsers.put_nowait(parser)
+
+
+_worker_parser = None  # 工作进程中的转换器
+
+def _init_worker(options):
+    """
+    工作进程初始化函数
+    """
+    global _worker_parser
+    Rule.warm_up()
+    _worker_parser = Parser(**options)
+
+def _convert_in_worker(body, full_page, title):
+    """
+    在工作进程中转换，convert结束时自动重置转换器
+    """
+    return _worker_parser.convert(body, full_page, title)
+
+
+class ConversionServer:
+    """
+    Markdown转换服务
+
+    POST /convert：请求正文为UTF-8编码的Markdown文本，返回HTML；查询参数full=1时返回完整页面，title指定页面标题
+    GET /stats：返回请求计数及延迟直方图（JSON）
+    同时进行的转换数等于线程数（或进程数），等待中的请求超过backlog个时返回503，
+    正文超过max_body字节时返回413
+    """
+    def __init__(self, threads=4, processes=0, backlog=64, max_body=MAX_BODY, options=None):
+        self._options = options or {}
+        self._backlog = backlog
+        self._max_body = max_body
+        if processes > 0:
+            self._workers = processes
+            self._executor = concurrent.futures.ProcessPoolExecutor(processes, initializer=_init_worker,
+                                                                    initargs=(self._options,))
+        else:
+            self._workers = threads
+            self._executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self._pool = None  # 线程池模式下的转换器池，须在事件循环中构造，见serve
+        self._slots = None  # 进程池模式下限制同时进行的转换数
+        self._pending = 0  # 等待中及进行中的转换数
+        self._statuses = {}  # 响应状态码 -> 次数
+        self._latency = LatencyHistogram()  # 请求从读完请求头到生成响应的耗时
+        self._convert_latency = LatencyHistogram()  # 转换本身的耗时
+
+    async def serve(self, host='127.0.0.1', port=8000, unix=None):
+        """
+        启动服务并一直运行
+        """
+        if isinstance(self._executor, concurrent.futures.ThreadPoolExecutor):
+            self._pool = ParserPool(self._workers, self._options)
+        else:
+            self._slots = asyncio.Semaphore(self._workers)
+        if unix:
+            server = await asyncio.start_unix_server(self._handle, unix)
+            print('Serving on unix socket %s' % unix)
+        else:
+            server = await asyncio.start_server(self._handle, host, port)
+            print('Serving on http://%s:%d' % (host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self._executor.shutdown(wait=False)
+
+    def stats(self):
+        """
+        返回请求计数及延迟直方图
+        """
+        return {
+            'workers': self._workers,
+            'pending': self._pending,
+            'statuses': dict((str(status), count) for status, count in sorted(self._statuses.items())),
+            'latency': self._latency.to_dict(),
+            'convert_latency': self._convert_latency.to_dict(),
+        }
+
+    async def convert(self, body, full_page=False, title=None):
+        """
+        在执行器中转换body，返回HTML字符串
+        """
+        loop = asyncio.get_running_loop()
+        if self._pool is None:  # 进程池模式
+            async with self._slots:
+                start = time.perf_counter()
+                html = await loop.run_in_executor(self._executor, _convert_in_worker, body, full_page, title)
+        else:
+            parser = await self._pool.acquire()
+            start = time.perf_counter()
+            future = self._executor.submit(parser.convert, body, full_page, title)
+            # 请求被取消时执行器线程可能仍在使用该转换器，转换结束后才放回池中；ParserPool只能在事件循环中使用
+            future.add_done_callback(lambda future: loop.call_soon_threadsafe(self._pool.release, parser))
+            html = await asyncio.wrap_future(future)
+        self._convert_latency.record(time.perf_counter() - start)
+        return html
+
+    async def _handle(self, reader, writer):
+        """
+        处理一个连接，支持HTTP/1.1持久连接
+        """
+        try:
+            while True:
+                request = await self._read_head(reader)
+                if request is None:
+                    break
+                start = time.perf_counter()
+                status, content_type, content, keep_alive = await self._dispatch(reader, *request)
+                self._statuses[status] = self._statuses.get(status, 0) + 1
+                self._latency.record(time.perf_counter() - start)
+                writer.write(('HTTP/1.1 %d %s\r\n'
+                              'Content-Type: %s\r\n'
+                              'Content-Length: %d\r\n'
+                              'Connection: %s\r\n\r\n'
+                              % (status, HTTPStatus(status).phrase, content_type, len(content),
+                                 'keep-alive' if keep_alive else 'close')).encode('latin-1') + content)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass  # 客户端断开连接或请求格式错误
+        finally:
+            writer.close()
+
+    async def _read_head(self, reader):
+        """
+        读取请求行及请求头，连接关闭时返回None
+        """
+        line = await reader.readline()
+        if not line.strip():
+            return None
+        method, target, version = line.decode('latin-1').split()
+        headers = {}
+        for _ in range(MAX_HEADERS):
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise ValueError('Too many headers.')
+        return method, target, version, headers
+
+    async def _dispatch(self, reader, method, target, version, headers):
+        """
+        处理一个请求，返回(状态码, Content-Type, 响应正文, 是否保持连接)
+        """
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+        url = urlsplit(target)
+        if url.path == '/stats':
+            if method != 'GET':
+                return self._error(HTTPStatus.METHOD_NOT_ALLOWED, keep_alive)
+            return 200, 'application/json', json.dumps(self.stats()).encode(), keep_alive
+        if url.path not in ('/', '/convert'):
+            return self._error(HTTPStatus.NOT_FOUND, keep_alive)
+        if method != 'POST':
+            return self._error(HTTPStatus.METHOD_NOT_ALLOWED, keep_alive)
+
+        # 未读取正文就返回时须关闭连接，否则残留的正文会被当作下一个请求
+        try:
+            length = int(headers['content-length'])
+        except (KeyError, ValueError):
+            return self._error(HTTPStatus.LENGTH_REQUIRED, False)
+        if length < 0 or length > self._max_body:
+            return self._error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, False)
+        if self._pending >= self._workers + self._backlog:  # 过载，拒绝新的转换请求
+            return self._error(HTTPStatus.SERVICE_UNAVAILABLE, False)
+
+        self._pending += 1
+        try:
+            body = await reader.readexactly(length)
+            query = parse_qs(url.query)
+            full_page = query.get('full', ['0'])[0] not in ('', '0', 'false')
+            title = query.get('title', [''])[0]
+            try:
+                html = await self.convert(body, full_page, title)
+            except UnicodeDecodeError:
+                return self._error(HTTPStatus.BAD_REQUEST, keep_alive)
+            except Exception as error:
+                print('Error: conversion failed: %r' % error)
+                return self._error(HTTPStatus.INTERNAL_SERVER_ERROR, keep_alive)
+        finally:
+            self._pending -= 1
+        return 200, 'text/html; charset=utf-8', html.encode('utf-8'), keep_alive
+
+    @classmethod
+    def _error(cls, status, keep_alive):
+        """
+        生成错误响应
+        """
+        return status.value, 'text/plain; charset=utf-8', ('%d %s\n' % (status, status.phrase)).encode(), keep_alive
+
+
+
+if __name__ == '__main__':  # 主程序
+
+    argparser = argparse.ArgumentParser(description='Serve Markdown to HTML conversion over HTTP.')
+    argparser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    argparser.add_argument('--port', type=int, default=8000, help='port to listen on (default: 8000)')
+    argparser.add_argument('--unix', metavar='PATH', help='listen on a Unix domain socket instead of TCP')
+    argparser.add_argument('--threads', type=int, default=4, help='number of conversion threads (default: 4)')
+    argparser.add_argument('--processes', type=int, default=0,
+                           help='convert in this many worker processes instead of threads')
+    argparser.add_argument('--backlog', type=int, default=64,
+                           help='number of requests allowed to wait for a converter before replying 503')
+    argparser.add_argument('--max-body', type=int, default=MAX_BODY, metavar='BYTES',
+                           help='largest accepted request body (default: %d)' % MAX_BODY)
+    argparser.add_argument('--engine', default='rules', choices=('rules', 'tokenizer'), help='conversion engine')
+    argparser.add_argument('--cache-size', type=int, default=0, help='number of converted blocks to cache per parser')
+    argparser.add_argument('--toc', action='store_true',
+                           help='replace a paragraph consisting of [TOC] with a table of contents')
+    argparser.add_argument('--email-obfuscation', default='random', choices=Rule.LinkRule.email_obfuscations,
+                           help='how email addresses are obfuscated: "deterministic" makes responses cacheable')
+    args = argparser.parse_args()
+
+    server = ConversionServer(max(1, args.threads), args.processes, args.backlog, args.max_body,
+                              {'engine': args.engine, 'cache_size': args.cache_size,
+                               'email_obfuscation': args.email_obfuscation, 'toc': args.toc})
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        print('Server stopped.')
+    except OSError as error:
+        print('Fatal Error: %s' % error)
+        sys.exit(1)
@@ -0,0 +1,351 @@
+"""
+单遍扫描的转换引擎，作为Rule模块规则级联的替代实现
+
+规则级联对每个文本块依次执行11条规则，共约30次整块正则替换，每次替换都会生成新的字符串。
+本引擎对每个文本块只做三次扫描：
+
+    1. 转义扫描：一次替换完成SpecialChRule与BackslashRule的工作
+    2. 行级扫描：逐行识别代码块、标题和水平线，生成行级记号流，区块引用和列表由ContainerRule的容器栈一次扫描确定
+    3. 行内扫描：一个合并的正则表达式识别图片、链接及&lt;，&lt;处再依次尝试自动链接、Email和HTML标签，生成行内记号流
+
+最后由记号流生成HTML，强调规则仅在文本块中出现*或_时执行。
+
+规则级联中有少数写法会使正则匹配跨越多行（例如只有#号的行、只有星号的行、setext标题的下划线），
+遇到这类文本块时引擎放弃快速路径，退回规则级联处理该文本块，以保证输出与规则级联逐字节一致；
+含有参考式链接定义或引用的文本块同样交由规则级联处理。
+引擎与规则级联共享同一组规则对象，因此跨文本块的状态（代码块、列表、区块引用）在两者之间保持一致。
+"""
+
+import re
+import Rule
+
+
+# 行级记号类型
+MARKUP = 'markup'  # 转换器生成的HTML标记行，如<p>及代码块的占位符
+TEXT = 'text'  # 普通文本行
+BLOCK = 'block'  # 已识别的块级结构：标题、水平线、列表项等
+
+# 行内记号类型
+PLAIN = 'plain'
+IMAGE = 'image'
+LINK = 'link'
+AUTOLINK = 'autolink'
+EMAIL = 'email'
+TAG = 'tag'
+
+# 内置规则类型，引擎之外追加的规则在引擎输出之后依次执行
+BUILTIN_RULES = (
+    Rule.SpecialChRule, Rule.BackslashRule, Rule.CodeBlockandParagraphRule,
+    Rule.ReferenceRule, Rule.InlineCodeRule, Rule.HeaderRule, Rule.HrRule, Rule.ContainerRule,
+    Rule.ImageRule, Rule.LinkRule, Rule.EmphasisRule,
+)
+
+
+class Tokenizer:
+    """
+    单遍扫描的转换引擎
+    """
+    # SpecialChRule与BackslashRule合并为一次扫描
+    _escape_pattern = Rule.LazyPattern(r'[<>\x02\x03]|&(?!#[0-9]+|[a-zA-Z]+|#x[0-9a-fA-F]+;)|\\([*+()[\]{}\\_.!#`-])')
+    _escape_map = {'<': '&lt;', '>': '&gt;', '&': '&amp;', '\x02': '\ufffd', '\x03': '\ufffd'}
+    # 只由#号和空白组成的行，规则级联中会与下一行一起匹配为标题
+    _atx_hazard_pattern = Rule.LazyPattern(r'#+\s*$')
+    # 只由星号（减号）和空白组成的行，若不能单独匹配为水平线，规则级联中可能跨行匹配
+    _hr_star_only_pattern = Rule.LazyPattern(r'[*\s]+$')
+    _hr_dash_only_pattern = Rule.LazyPattern(r'[-\s]+$')
+    _hr_star_pattern = Rule.LazyPattern(r'\*\s*\*\s*\*\**$')
+    _hr_dash_pattern = Rule.LazyPattern(r'-\s*-\s*--*$')
+    # 以空白分隔的一串星号（减号），规则级联中这串星号可以跨行延续（见Rule.HrRule._hr_sub）
+    _hr_star_run_pattern = Rule.LazyPattern(r'\*\s*\*\s*\*(?:\s*\*)*$')
+    _hr_dash_run_pattern = Rule.LazyPattern(r'-\s*-\s*-(?:\s*-)*$')
+    _underline_pattern = Rule.LazyPattern(r'[=-]+\s*$')
+    # 行级扫描中需逐行处理的行：Atx标题、空白行、Setext标题的下划线、水平线及可能跨行匹配的星号（减号）行
+    # 以换行符代替^匹配行首（在文本前补一个换行符），正则引擎可按字面前缀直接跳到各行行首，不必逐个位置尝试
+    _line_hazard_pattern = Rule.LazyPattern(r'\n(?:#|\s*$|[=-]+\s*$|_{3,}$|[*\s]+$|[-\s]+$)', re.M)
+    # 与ContainerRule._item_search_pattern相同，引擎生成的文本以标记行开头，列表项只可能出现在换行符之后
+    _item_search_pattern = Rule.LazyPattern(r'\n\s*(?:[\+\-\*]|\d+\.)\s')
+    # 图片、链接及&lt;合并为一次扫描，分支顺序与规则执行顺序一致
+    # 各分支不加捕获组，以便正则引擎按首字符快速跳过无关位置，匹配后再由首字符区分类型；
+    # 自动链接和HTML标签的正则写法在不能匹配的&lt;处会扫描到行尾，因此&lt;之后的部分由Rule.AngleScanner确定
+    _inline_pattern = Rule.LazyPattern(
+        r'!\[[^\[\]]+\]\([^\(\)]+\)'  # 图片
+        r'|\[[^\[\]]+\]\([^\(\)]+\)'  # 链接
+        '|&lt;')  # 自动链接、Email和HTML标签
+    # 没有&lt;时只有图片和链接，一次替换完成行内扫描与HTML生成，分支顺序同上
+    _link_pattern = Rule.LazyPattern(r'!\[([^\[\]]+)\]\(([^\(\)]+)\)|\[([^\[\]]+)\]\(([^\(\)]+)\)')
+
+    def __init__(self, rulesets):
+        """
+        构造函数，rulesets为转换器的规则列表，引擎复用其中内置规则的正则表达式、替换函数和状态
+        """
+        self._rulesets = rulesets
+        self._code = self._find_rule(Rule.CodeBlockandParagraphRule)
+        self._inlinecode = self._find_rule(Rule.InlineCodeRule)
+        self._header = self._find_rule(Rule.HeaderRule)
+        self._hr = self._find_rule(Rule.HrRule)
+        self._containers = self._find_rule(Rule.ContainerRule)
+        self._image = self._find_rule(Rule.ImageRule)
+        self._link = self._find_rule(Rule.LinkRule)
+        self._emphasis = self._find_rule(Rule.EmphasisRule)
+        self._backslash = self._find_rule(Rule.BackslashRule)
+
+        self._inline_renderers = {
+            IMAGE: lambda s: self._image._img_pattern.sub(self._image._img_substring, s),
+            LINK: lambda s: self._link._link_1_pattern.sub(self._link._link_1_substring, s),
+            AUTOLINK: lambda s: self._link._autolink_html(s[4:-4]),
+            EMAIL: lambda s: self._link._email_pattern.sub(self._link._email_substring, s),
+            TAG: lambda s: self._link._html_tag_html(s[4:-4]),
+        }
+        # 追加的规则排在全部内置规则之后时，在引擎输出之后依次执行；
+        # 若有追加的规则排在某条内置规则之前，引擎无法在单遍扫描中间执行它，全部文本块交由规则级联处理
+        last = max(idx for idx, rule in enumerate(rulesets) if isinstance(rule, BUILTIN_RULES))
+        self._cascade_only = any(not isinstance(rule, BUILTIN_RULES) for rule in rulesets[:last])
+        self._pipeline = [(rule, Rule.trigger(rule)) for rule in rulesets]
+        self._extra_rules = self._pipeline[last + 1:]
+
+    def _find_rule(self, ruletype):
+        """
+        在规则列表中查找指定类型的内置规则
+        """
+        for rule in self._rulesets:
+            if type(rule) is ruletype:
+                return rule
+        raise ValueError('Tokenizer requires a %s in the ruleset.' % ruletype.__name__)
+
+    def _escape_substring(self, match):
+        """
+        转义扫描的替换函数
+        """
+        text = match.group(0)
+        if text[0] == '\\':
+            return self._backslash._backslash_substring(match)
+        return self._escape_map[text]
+
+    def _escape(self, block):
+        """
+        转义扫描：HTML特殊字符（及占位符使用的控制字符，见Rule.PLACEHOLDER_ESCAPES）与反斜杠逃逸
+        """
+        if '<' in block or '>' in block or '&' in block or '\\' in block or '\x02' in block or '\x03' in block:
+            block = self._escape_pattern.sub(self._escape_substring, block)
+        return block
+
+    def scan_paragraph(self, block):
+        """
+        行级扫描的快速路径：不在代码块中、不含```且没有需逐行处理的行的文本块整体是一个段落，
+        返回其HTML（已处理行内代码），与scan_lines的结果相同；不满足条件时返回None
+        block为经过转义扫描的文本块
+        """
+        if self._code._inside_code or '```' in block:
+            return None
+        body = block[:-1] if block.endswith('\n') else block
+        if not body or self._line_hazard_pattern.search('\n' + body):
+            return None
+        if '`' in body:  # 行内代码不跨行，整段替换与逐行替换相同
+            body = self._inlinecode._inlinecode_pattern.sub(self._inlinecode._inlinecode_substring, body)
+        return '<p>\n' + body + '\n</p>\n'
+
+    def scan_lines(self, block):
+        """
+        行级扫描，返回行级记号流(kind, text)及扫描后代码块的状态；
+        遇到无法单遍处理的写法时返回None，block为经过转义扫描的文本块
+        """
+        tokens = []
+        underlines = rules = False  # 是否有以=或-（_、*或-）开头的行，没有时跳过Setext标题（水平线）的扫描
+        # 行间代码块与段落，由CodeBlockandParagraphRule生成，代码块以占位符行表示；
+        # 没有代码块时全部非空行组成一个段落，结果与render_lines相同；
+        # 文本行逐行处理行内代码与Atx标题（InlineCodeRule、HeaderRule）
+        if self._code._inside_code or '```' in block:
+            lines, inside_code = self._code.render_lines(block, self._code._inside_code)
+        else:
+            lines = [(line, True) for line in block.split('\n') if line]
+            if lines:
+                lines = [('<p>', False)] + lines + [('</p>', False)]
+            inside_code = False
+        for line, text in lines:
+            if not text:
+                tokens.append((MARKUP, line))
+                continue
+            if line.isspace():  # 空白行会被规则级联中的\s*跨行匹配
+                return None
+            if '`' in line:
+                line = self._inlinecode._inlinecode_pattern.sub(self._inlinecode._inlinecode_substring, line)
+            first = line[0]
+            if first == '#':
+                if self._atx_hazard_pattern.match(line):
+                    return None
+                header = self._header._atx_pattern.sub(self._header._atx_substring, line)
+                if header != line:
+                    tokens.append((BLOCK, header))
+                    continue
+            elif first in '=-_*':
+                underlines = underlines or first in '=-'
+                rules = rules or first in '_*-'
+            tokens.append((TEXT, line))
+
+        # Setext标题（HeaderRule），下划线与其上一行组成标题
+        idx = 1
+        while underlines and idx < len(tokens):
+            kind, line = tokens[idx]
+            if kind == TEXT and line[0] in '=-' and self._underline_pattern.match(line):
+                if idx == len(tokens) - 1:  # 规则级联中下划线之后的空白会吞掉文本块末尾的换行符
+                    return None
+                # 两行组成的文本由_setext_sub匹配时，标题为上一行去掉开头空白后的内容，这里直接生成
+                level = 1 if line[0] == '=' else 2
+                title = tokens[idx - 1][1].lstrip()
+                # 合并后下一行位于idx处，它只能作为下一个标题的首行
+                tokens[idx - 1:idx + 1] = [(BLOCK, '<h%d>%s</h%d>' % (level, title, level))]
+            idx += 1
+
+        # 水平线（HrRule），区块引用与列表由ContainerRule在拼接后的文本上处理
+        for idx, (kind, line) in enumerate(tokens if rules else ()):
+            if kind != TEXT:
+                continue
+            first = line[0]
+            if first == '_' and self._hr._hr_1_pattern.match(line):
+                tokens[idx] = (BLOCK, '<hr />')
+            elif first == '*' and self._hr_star_only_pattern.match(line):
+                if not self._hr_star_pattern.match(line) and not (
+                        self._hr_star_run_pattern.match(line) and self._isolated(tokens, idx, '*')):
+                    return None
+                tokens[idx] = (BLOCK, '<hr />')
+            elif first == '-' and self._hr_dash_only_pattern.match(line):
+                if not self._hr_dash_pattern.match(line) and not (
+                        self._hr_dash_run_pattern.match(line) and self._isolated(tokens, idx, '-')):
+                    return None
+                tokens[idx] = (BLOCK, '<hr />')
+        return tokens, inside_code
+
+    @classmethod
+    def _isolated(cls, tokens, idx, mark):
+        """
+        判断tokens中idx处的行前后两行是否都不会与它组成同一串星号（减号），是时该行单独成为水平线
+        """
+        for near in (idx - 1, idx + 1):
+            if 0 <= near < len(tokens):
+                line = tokens[near][1]
+                if line == '<hr />' or line.lstrip()[:1] == mark:
+                    return False
+        return True
+
+    def _angle_match(self, text, start, scanner):
+        """
+        确定从start处的&lt;开始的匹配，返回(类型, 结束位置)，不能匹配时返回(None, -1)
+        """
+        # 三个分支均以&lt;开头，按规则执行顺序依次尝试
+        end = scanner.autolink_end(start)
+        if end >= 0:
+            return AUTOLINK, end
+        email = self._link._email_pattern.match(text, start)
+        if email is not None:
+            return EMAIL, email.end()
+        end = scanner.tag_end(start)
+        if end >= 0:
+            return TAG, end
+        return None, -1
+
+    def scan_inline(self, text):
+        """
+        行内扫描，返回行内记号流(kind, text)；遇到无法单遍处理的写法时返回None
+        """
+        tokens = []
+        position = 0
+        consumed = 0  # 被图片和链接消耗的'](' 数目
+        scanner = Rule.AngleScanner(text)
+        search = self._inline_pattern.search
+        match = search(text)
+        while match is not None:
+            start = match.start()
+            first = text[start]
+            if first == '!' or first == '[':
+                kind = IMAGE if first == '!' else LINK
+                end = match.end()
+                consumed += 1
+            else:
+                kind, end = self._angle_match(text, start, scanner)
+                if kind is None:
+                    match = search(text, start + 1)
+                    continue
+            source = text[start:end]
+            # 生成的HTML中若仍有&lt;，规则级联中后续规则会继续在其中匹配
+            if '&lt;' in (source if kind == IMAGE or kind == LINK else source[4:]):
+                return None
+            if start > position:
+                tokens.append((PLAIN, text[position:start]))
+            tokens.append((kind, source))
+            position = end
+            match = search(text, end)
+        if consumed != text.count(']('):
+            return None
+        if position < len(text):
+            tokens.append((PLAIN, text[position:]))
+        return tokens
+
+    def _link_substring(self, match):
+        """
+        图片与链接的替换函数
+        """
+        if match.group(1) is not None:
+            return self._image._img_html(match.group(1), match.group(2))
+        return self._link._link_html(match.group(3), match.group(4))
+
+    def render_inline(self, tokens):
+        """
+        由行内记号流生成HTML
+        """
+        renderers = self._inline_renderers
+        return ''.join(text if kind == PLAIN else renderers[kind](text) for kind, text in tokens)
+
+    def _cascade(self, block):
+        """
+        退回规则级联处理文本块
+        """
+        for rule, triggered in self._pipeline:
+            if triggered is None or triggered(block):
+                block = rule.process(block)
+        return block
+
+    def process(self, block):
+        """
+        处理一个文本块
+        """
+        if self._cascade_only or Rule.ReferenceRule.may_apply(block):  # 参考式链接的定义和引用由规则级联处理
+            return self._cascade(block)
+        escaped = self._escape(block)
+        text = self.scan_paragraph(escaped)
+        if text is not None:
+            inside_code = False
+        else:
+            scanned = self.scan_lines(escaped)
+            if scanned is None:
+                return self._cascade(block)
+            tokens, inside_code = scanned
+            text = '\n'.join([line for kind, line in tokens])
+            if tokens:
+                text += '\n'
+        # 区块引用与列表，与规则级联使用同一容器栈扫描
+        containers = self._containers._inside_containers
+        if containers or '&gt;' in text or self._item_search_pattern.search(text):
+            text, containers = self._containers.structure(text, containers)
+
+        if '&lt;' not in text:
+            if '](' in text:
+                html, count = self._link_pattern.subn(self._link_substring, text)
+                if count != text.count(']('):  # 与scan_inline相同，有未被消耗的](时退回规则级联
+                    return self._cascade(block)
+                text = html
+        else:
+            inline = self.scan_inline(text)
+            if inline is None:
+                return self._cascade(block)
+            text = self.render_inline(inline)
+
+        # 行级与行内扫描均成功后才更新规则状态
+        self._code._inside_code = inside_code
+        self._containers._inside_containers = containers
+
+        if '*' in text or '_' in text:
+            text = self._emphasis.process(text)
+        for rule, triggered in self._extra_rules:
+            if triggered is None or triggered(text):
+                text = rule.process(text)
+        return text
@@ -0,0 +1,112 @@
+"""
+输入目录的递归遍历
+
+以os.scandir逐个目录扫描，找到的Markdown文件立即生成给调用者，不必先列出整个目录树，
+转换可以与遍历同时进行；输出文件按输入文件的相对路径保存在输出目录下，子目录结构与输入目录相同，
+不同子目录中的同名文件不会互相覆盖
+
+使用：
+    walker = Walker('docs', 'site', excludes=('drafts', 'vendor/*'))
+    for inputfile, outputfile in walker.walk():
+        walker.prepare(outputfile)  # 创建输出文件所在的目录
+        parser.parse(inputfile, outputfile)
+"""
+
+import os, re, fnmatch, posixpath
+
+
+DEFAULT_INCLUDES = ('*.md', '*.markdown', '*.mdown')  # 默认转换的文件
+DEFAULT_EXCLUDES = ('.git', '.hg', '.svn')  # 默认跳过的版本控制目录
+
+
+class Walker:
+    """
+    输入目录的遍历器
+
+    includes和excludes为glob模式，不区分大小写：含/的模式与相对于输入目录的路径（以/分隔）比较，
+    开头的/可以省略；不含/的模式与文件名或目录名比较。文件名与includes中任一模式匹配、
+    且与excludes中的模式都不匹配时才转换；与excludes匹配的目录整个跳过
+    """
+    def __init__(self, root, output_root='output', suffix='.html', includes=DEFAULT_INCLUDES, excludes=DEFAULT_EXCLUDES):
+        """
+        构造函数，root为输入目录，output_root为输出目录，suffix为输出文件的扩展名
+        """
+        self._root = root
+        self._output_root = output_root
+        self._suffix = suffix
+        self._includes = self._compile(includes)
+        self._excludes = self._compile(excludes)
+        self._output_path = os.path.abspath(output_root)  # 输出目录位于输入目录之中时不进入输出目录
+        self._prepared = set()  # 已创建的输出目录
+
+    @classmethod
+    def _compile(cls, patterns):
+        """
+        编译glob模式，返回[(是否与相对路径比较, 正则表达式), ...]
+        """
+        return [('/' in pattern, re.compile(fnmatch.translate(pattern.lstrip('/')), re.I)) for pattern in patterns]
+
+    @classmethod
+    def _matches(cls, patterns, name, relpath):
+        """
+        检查名称为name、相对路径为relpath的文件或目录是否与patterns中的任一模式匹配
+        """
+        for anchored, pattern in patterns:
+            if pattern.match(relpath if anchored else name):
+                return True
+        return False
+
+    def walk(self):
+        """
+        深度优先遍历输入目录，逐个生成(输入文件名, 输出文件名)
+        同一目录中先按名称顺序生成文件，再依次进入子目录；不进入指向目录的符号链接，以免循环
+        输入目录本身无法读取时抛出OSError，无法读取的子目录打印警告后跳过
+        """
+        stack = [(self._root, '')]  # (目录, 相对路径前缀)
+        while stack:
+            directory, prefix = stack.pop()
+            try:
+                with os.scandir(directory) as iterator:
+                    entries = sorted(iterator, key=lambda entry: entry.name)
+            except OSError as error:
+                if not prefix:
+                    raise
+                print('Warning: cannot read directory "%s": %s.' % (directory, error.strerror))
+                continue
+            subdirectories = []
+            for entry in entries:
+                relpath = prefix + entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if (not self._matches(self._excludes, entry.name, relpath)
+                                and os.path.abspath(entry.path) != self._output_path):
+                            subdirectories.append((entry.path, relpath + '/'))
+                        continue
+                    if (self._matches(self._includes, entry.name, relpath)
+                            and not self._matches(self._excludes, entry.name, relpath) and entry.is_file()):
+                        yield entry.path, self._output_of(relpath)
+                except OSError:  # 文件在列出后被删除
+                    continue
+            stack.extend(reversed(subdirectories))
+
+    def _output_of(self, relpath):
+        """
+        返回相对路径为relpath的输入文件对应的输出文件名
+        """
+        return os.path.join(self._output_root, *posixpath.splitext(relpath)[0].split('/')) + self._suffix
+
+    def output_of(self, inputfile):
+        """
+        返回walk生成的输入文件inputfile对应的输出文件名
+        """
+        return self._output_of(os.path.relpath(inputfile, self._root).replace(os.sep, '/'))
+
+    def prepare(self, outputfile):
+        """
+        创建输出文件所在的目录，返回outputfile；已创建过的目录不再检查
+        """
+        directory = os.path.dirname(outputfile)
+        if directory and directory not in self._prepared:
+            os.makedirs(directory, exist_ok=True)
+            self._prepared.add(directory)
+        return outputfile
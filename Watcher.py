@@ -0,0 +1,71 @@
+"""
+文件变化监视，轮询输入文件的修改时间和大小，合并短时间内的连续修改后报告新增、修改和删除的文件
+"""
+
+import os, time
+
+
+class Watcher:
+    """
+    轮询式文件监视器
+    """
+    def __init__(self, scan, interval=0.25, debounce=0.1):
+        """
+        构造函数
+
+        scan为返回待监视文件名列表的函数，每次轮询时调用，因此能够发现新增的文件
+        interval为轮询间隔（秒），debounce为合并连续修改的静默时长（秒）：
+        发现变化后，直到连续debounce秒没有新的变化才报告，编辑器保存文件时的多次写入只触发一次转换
+        """
+        self._scan = scan
+        self._interval = interval
+        self._debounce = debounce
+        self._snapshot = {}
+        self._snapshot = self.snapshot()
+
+    def snapshot(self):
+        """
+        返回各文件的(修改时间, 大小)
+        """
+        try:
+            filenames = self._scan()
+        except OSError:  # 被监视的目录暂时无法访问，视为没有变化
+            return self._snapshot
+        result = {}
+        for filename in filenames:
+            try:
+                stat = os.stat(filename)
+            except OSError:  # 文件在列出后被删除
+                continue
+            result[filename] = (stat.st_mtime_ns, stat.st_size)
+        return result
+
+    def poll(self):
+        """
+        检查一次变化，返回(新增或修改的文件列表, 删除的文件列表)
+        """
+        current = self.snapshot()
+        if current == self._snapshot:
+            return [], []
+        # 等待文件静默，合并连续的修改
+        while True:
+            time.sleep(self._debounce)
+            latest = self.snapshot()
+            if latest == current:
+                break
+            current = latest
+        changed = sorted(f for f in current if self._snapshot.get(f) != current[f])
+        removed = sorted(f for f in self._snapshot if f not in current)
+        self._snapshot = current
+        return changed, removed
+
+    def __iter__(self):
+        """
+        持续轮询，每当有文件变化时生成(新增或修改的文件列表, 删除的文件列表)
+        """
+        while True:
+            changed, removed = self.poll()
+            if changed or removed:
+                yield changed, removed
+            else:
+                time.sleep(self._interval)
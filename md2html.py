@@ -3,65 +3,433 @@
 
 使用：
     (1). python md2html.py test.md  # 将指定的输入文件test.md转换为test.html
-    (2). python md2html.py input # 批量转换/input目录下的Markdown文件，结果保存到/output目录
+    (2). python md2html.py input # 批量转换/input目录及其子目录下的Markdown文件，结果按相同的目录结构保存到/output目录
+    (3). python md2html.py -j 4 input # 使用4个工作进程并行转换，-j 0表示使用全部CPU核心
+    (4). python md2html.py -i input # 增量转换，跳过自上次转换以来未修改的文件，并删除已不存在的输入文件的转换结果
+    (5). python md2html.py --profile profile.json input # 统计各条规则的耗时并以JSON格式保存，文件名为-时打印到标准输出
+    (6). python md2html.py --large huge.md # 大文件模式，按固定大小的缓冲区读取输入，并对超长的文本块打印警告
+    (7). python md2html.py --watch input # 转换后持续监视，只重新转换修改过的文件，并删除已删除文件的转换结果
+    (8). python md2html.py --compress gz input # 输出gzip压缩的.html.gz文件，br为brotli压缩（需要安装brotli模块）
+    (9). python md2html.py -o - test.md # 将单个文件的转换结果输出到标准输出，-o也可指定输出文件名
+    (10). python md2html.py --email-obfuscation deterministic input # Email地址的混淆结果可重现，相同输入总是得到相同输出
+    (11). python md2html.py -d site --include '*.txt' --exclude drafts input # 输出到site目录，另外转换.txt文件，跳过drafts目录
+    (12). python md2html.py --link-index input # 先预扫描全部文件，将指向.md文件的链接改为.html，并报告失效的链接和锚点
+    (13). python md2html.py --toc input # 将单独成段的[TOC]替换为由文档中的标题生成的目录
+    (14). python md2html.py --format json input # 输出文档树（JsonML格式的.json文件），binary为紧凑的二进制格式（.mdast文件）
+    (15). python md2html.py -i --search-index output/search.idx input # 同时按标题小节建立全文检索索引，再次转换时合并未修改文档的索引
+          python SearchIndex.py output/search.idx 安装 linux # 查询索引
 """
 
-import os, sys
+import os, sys, io, time, argparse, contextlib, multiprocessing
+import Rule
+from Parser import Parser
+from Manifest import Manifest
+from Profile import ProfileStats
+from Watcher import Watcher
+from Walker import Walker, DEFAULT_INCLUDES, DEFAULT_EXCLUDES
+from LinkIndex import LinkIndex
+import SearchIndex
 
 
-def is_markdown_file(filename):
+LARGE_CHUNK_SIZE = 1 << 20  # 大文件模式每次读取的字符数
+LARGE_MAX_BLOCK = 1 << 24  # 大文件模式下文本块大小的默认警告阈值（字符数）
+WATCH_CACHE_SIZE = 4096  # 监视模式下缓存的文本块数目
+STREAM_CHUNKSIZE = 8  # 边遍历边转换时每次分配给工作进程的文件数
+FORMAT_SUFFIXES = {'html': '.html', 'json': '.json', 'binary': '.mdast'}  # 输出格式 -> 输出文件的扩展名
+
+_worker_parser = None  # 工作进程中的转换器，规则带有状态，每个进程各自持有一个
+
+def _init_worker(profile=False, options=None):
+    """
+    工作进程初始化函数，options为构造转换器的参数
+    """
+    global _worker_parser
+    Rule.warm_up()  # 工作进程启动时即编译全部正则表达式
+    _worker_parser = Parser(**(options or {}))
+    if profile:
+        _worker_parser.enable_profiling()
+
+def _convert_in_worker(filenames):
     """
-    检查filename是否为已存在的Markdown文档
+    在工作进程中转换一个文件，返回转换结果、转换过程中打印的信息、该文件的性能剖析统计（未启用时为None）
+    及各小节的词频（见section_terms）
     """
-    return os.path.isfile(filename) and (  # 检查filename是文件还是目录
-             filename.lower().endswith('.md') or  # 通过后缀名检查是否属于Markdown文档
-             filename.lower().endswith('.markdown') or 
-             filename.lower().endswith('.mdown')
-           )
+    messages = io.StringIO()
+    with contextlib.redirect_stdout(messages):
+        result = _worker_parser.parse(*filenames)
+    sections = section_terms(_worker_parser)
+    stats = _worker_parser.profile_stats()
+    if stats is None:
+        return result, messages.getvalue(), None, sections
+    data = stats.to_dict()
+    stats.clear()
+    return result, messages.getvalue(), data, sections
 
+def section_terms(parser):
+    """
+    返回parser最近转换的文档各小节的词频[(锚点, 标题, 词项 -> 次数), ...]，小节的标题也计入词频
+    分词在转换所在的进程中完成，交给主进程的只是词频
+    """
+    return [(anchor, title, SearchIndex.count_terms(title + '\n' + text)) for anchor, title, text in parser.sections()]
 
+def update_search_index(filename, documents, keep):
+    """
+    更新全文检索索引filename：先合并原索引中keep(文档路径)为True的文档，再加入documents中的文档，
+    documents为[(输出文件, 各小节的词频), ...]，文档路径为输出文件相对于索引文件所在目录的路径（见SearchIndex.document_path）
+    原索引不存在或已损坏时重新建立；返回新索引的IndexBuilder，无法写入时打印错误信息并返回None
+    """
+    base = os.path.dirname(os.path.abspath(filename))
+    builder = SearchIndex.IndexBuilder()
+    try:
+        with SearchIndex.SearchIndex(filename) as index:
+            builder.merge(index, keep)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as error:
+        print('Warning: cannot read search index "%s": %s; rebuilding it.'
+              % (filename, getattr(error, 'strerror', None) or str(error).rstrip('.')))
+    for output_file, sections in documents:
+        builder.add(SearchIndex.document_path(output_file, base), sections)
+    try:
+        builder.write(filename)
+    except OSError:
+        print('Error: I/O failure occurred when writing search index "%s".' % filename)
+        return None
+    except ValueError as error:
+        print('Error: %s' % error)
+        return None
+    return builder
 
-if __name__ == '__main__':  # 主程序
+def search_index_readable(filename):
+    """
+    检查全文检索索引filename能否打开
+    """
+    try:
+        SearchIndex.SearchIndex(filename).close()
+    except (OSError, ValueError):
+        return False
+    return True
+
+def watch(scan, output_of, options=None, manifest=None, search_index=None):
+    """
+    监视scan返回的输入文件，重新转换新增或修改过的文件，删除已删除文件的转换结果，直到被Ctrl-C中断
+    output_of返回输入文件对应的输出文件名；全程使用同一个转换器，并缓存文本块的转换结果，
+    修改一个段落只需重新转换该段落；options中有站点链接索引时，转换前先更新新增、修改或删除的文件在索引中的登记，
+    站点中的文档或锚点因此发生变化时重新转换全部文件；
+    search_index为全文检索索引的文件名时（options中须启用sections），每批修改转换后合并到索引中
+    """
+    options = dict(options or {})
+    options.setdefault('cache_size', WATCH_CACHE_SIZE)
+    link_index = options.get('link_index')
+    parser = Parser(**options)
+    Rule.warm_up()
+    print('Watching for changes, press Ctrl-C to stop.')
+    base = os.path.dirname(os.path.abspath(search_index)) if search_index is not None else None
+    link_fingerprint = link_index.fingerprint() if link_index is not None else None
+    try:
+        for changed, removed in Watcher(scan):
+            documents = []  # 转换成功的(输出文件, 各小节的词频)
+            for input_file in removed:
+                output_file = output_of(input_file)
+                try:
+                    os.remove(output_file)
+                    print('Removed "%s".' % output_file)
+                except FileNotFoundError:
+                    pass
+                if manifest is not None:
+                    manifest.discard(input_file)
+                if link_index is not None:
+                    link_index.discard(input_file)
+            if link_index is not None:
+                for input_file in changed:
+                    try:
+                        link_index.scan(input_file)
+                    except OSError:  # 由转换时报告
+                        link_index.discard(input_file)
+                fingerprint = link_index.fingerprint()
+                if fingerprint != link_fingerprint:  # 其它文档中的链接的改写结果可能改变
+                    link_fingerprint = fingerprint
+                    try:
+                        changed = sorted(set(changed) | set(scan()))
+                    except OSError:
+                        pass
+                    print('Documents or anchors changed, reconverting %d file(s).' % len(changed))
+            for input_file in changed:
+                start = time.perf_counter()
+                result = parser.parse(input_file, output_of(input_file))
+                if result:
+                    print('Converted "%s" in %.1f ms.' % (input_file, (time.perf_counter() - start) * 1000))
+                    documents.append((output_of(input_file), section_terms(parser)))
+                if manifest is not None:
+                    if result:
+                        manifest.update(input_file, output_of(input_file), Manifest.digest(input_file))
+                    else:
+                        manifest.discard(input_file)
+            if search_index is not None:  # 修改和删除的文件原有的小节都从索引中去掉
+                stale = set(SearchIndex.document_path(output_of(f), base) for f in changed + removed)
+                if update_search_index(search_index, documents, lambda document: document not in stale) is None \
+                        and manifest is not None:
+                    manifest.invalidate()
+            if manifest is not None:
+                manifest.save()
+    except KeyboardInterrupt:
+        print('Watch stopped.')
+
+def stream_files(walker, manifest=None, pending=None, files=None, digests=None, fresh=None):
+    """
+    逐个生成walker找到的(输入文件, 输出文件)，并创建输出文件所在的目录；files不为None时改为逐个生成files中已找到的文件
+    manifest不为None时跳过自上次转换以来未修改的文件，遍历结束后删除已不存在的输入文件的转换结果；
+    pending为列表时依次追加生成的(输入文件, 输出文件, 内容摘要)，供转换后更新清单；
+    fresh为列表时依次追加跳过的(输入文件, 输出文件)；
+    digests为预扫描时已计算的内容摘要（输入文件 -> 摘要），其中的文件不再读取
+    """
+    seen = []
+    skipped = 0
+    for input_file, output_file in (walker.walk() if files is None else files):
+        digest = None
+        if manifest is not None:
+            seen.append(input_file)
+            try:
+                digest = digests[input_file] if digests and input_file in digests else Manifest.digest(input_file)
+            except OSError:  # 文件在列出后被删除或无法读取，由转换时报告
+                digest = None
+            if manifest.is_fresh(input_file, output_file, digest):
+                skipped += 1
+                if fresh is not None:
+                    fresh.append((input_file, output_file))
+                continue
+        if pending is not None:
+            pending.append((input_file, output_file, digest))
+        try:
+            walker.prepare(output_file)
+        except OSError:  # 无法创建输出目录，由转换时打开输出文件的错误信息报告
+            pass
+        yield input_file, output_file
+    if manifest is not None:
+        removed = manifest.remove_stale(seen)
+        print('Incremental: %d unchanged file(s) skipped, %d stale output(s) removed.' % (skipped, removed))
+
+def index_files(walker, link_index):
+    """
+    预扫描walker找到的全部文件，登记到站点链接索引link_index中，返回((输入文件, 输出文件)的列表, 内容摘要字典)
+    无法读取的文件不登记，由转换时报告；输入目录本身无法读取时抛出OSError
+    """
+    files = []
+    digests = {}
+    for input_file, output_file in walker.walk():
+        files.append((input_file, output_file))
+        try:
+            digests[input_file] = link_index.scan(input_file)
+        except OSError:
+            pass
+    return files, digests
+
+def convert_files(files, jobs=1, profile=None, options=None, sections=None):
+    """
+    转换files中的文件，files为(输入文件, 输出文件)的列表或迭代器，返回各文件的转换结果（1为成功，0为失败）
+    jobs大于1时将文件分配给多个工作进程并行转换，打印的信息仍按输入文件的顺序输出；
+    files为迭代器时边生成边转换，不必等待全部文件列出
+    profile为ProfileStats对象时统计各条规则的耗时，多个工作进程的统计汇总到profile中
+    options为构造转换器的参数（见Parser）；sections为列表时依次追加各文件各小节的词频（见section_terms）
+    """
+    if jobs <= 1 or (isinstance(files, list) and len(files) <= 1):
+        parser = Parser(**(options or {}))
+        if profile is not None:
+            parser.enable_profiling(profile)
+        results = []
+        for input_file, output_file in files:
+            results.append(parser.parse(input_file, output_file))
+            if sections is not None:
+                sections.append(section_terms(parser))
+        return results
+
+    results = []
+    if isinstance(files, list):
+        chunksize = max(1, len(files) // (jobs * 4))  # 每次分配多个文件以减少进程间通信
+    else:
+        chunksize = STREAM_CHUNKSIZE
+    with multiprocessing.Pool(jobs, _init_worker, (profile is not None, options)) as pool:
+        for result, messages, data, terms in pool.imap(_convert_in_worker, files, chunksize):
+            sys.stdout.write(messages)
+            results.append(result)
+            if sections is not None:
+                sections.append(terms)
+            if data is not None:
+                profile.merge(data)
+    return results
 
-    from Parser import Parser
+
+
+if __name__ == '__main__':  # 主程序
 
     input_files = []  # 输入文件列表
     output_files = []  # 输出文件列表
-    parser = Parser()  # 转换器
+    pending = []  # 输入为目录时已交给转换的(输入文件, 输出文件, 内容摘要)
+    fresh = []  # 增量转换时跳过的(输入文件, 输出文件)
+    manifest = None  # 增量转换清单
+
+    argparser = argparse.ArgumentParser(description='Convert Markdown files to HTML files.')
+    argparser.add_argument('input', nargs='?', help='Markdown file or directory of Markdown files')
+    argparser.add_argument('-j', '--jobs', type=int, default=1,
+                           help='number of worker processes for directory input, 0 means all CPU cores')
+    argparser.add_argument('-i', '--incremental', action='store_true',
+                           help='skip unchanged files and remove outputs of deleted files (directory input only)')
+    argparser.add_argument('--profile', metavar='FILE',
+                           help='collect per-rule timings and dump them as JSON to FILE, "-" means stdout')
+    argparser.add_argument('--large', action='store_true',
+                           help='read input through fixed-size buffers to bound memory on very large files')
+    argparser.add_argument('--max-block', type=int, default=None, metavar='CHARS',
+                           help='warn about blocks longer than CHARS characters (default with --large: %d)'
+                                % LARGE_MAX_BLOCK)
+    argparser.add_argument('-w', '--watch', action='store_true',
+                           help='keep watching the input and reconvert files as they change')
+    argparser.add_argument('-o', '--output', metavar='FILE',
+                           help='output file for a single input file, "-" means stdout')
+    argparser.add_argument('-z', '--compress', choices=('gz', 'br'),
+                           help='write compressed .html.gz or .html.br files')
+    argparser.add_argument('--email-obfuscation', default='random', choices=Rule.LinkRule.email_obfuscations,
+                           help='how email addresses are obfuscated: "deterministic" makes the output reproducible '
+                                '(default: random)')
+    argparser.add_argument('-d', '--output-dir', default='output', metavar='DIR',
+                           help='root of the mirrored output tree for directory input (default: output)')
+    argparser.add_argument('--include', action='append', metavar='GLOB',
+                           help='convert files matching GLOB, may be repeated (default: %s); '
+                                'globs containing "/" match the path relative to the input directory'
+                                % ' '.join(DEFAULT_INCLUDES))
+    argparser.add_argument('--exclude', action='append', default=list(DEFAULT_EXCLUDES), metavar='GLOB',
+                           help='skip files and directories matching GLOB, may be repeated (always skipped: %s)'
+                                % ' '.join(DEFAULT_EXCLUDES))
+    argparser.add_argument('--format', default='html', choices=Parser.output_formats,
+                           help='write HTML pages, or the document tree as JSON (.json) or compact binary (.mdast)')
+    argparser.add_argument('--toc', action='store_true',
+                           help='replace a paragraph consisting of [TOC] with a table of contents built from the headings')
+    argparser.add_argument('--link-index', action='store_true',
+                           help='prescan all documents, rewrite links between Markdown documents and report dangling '
+                                'links; with -i, adding or removing documents or anchors reconverts every page '
+                                '(directory input only)')
+    argparser.add_argument('--search-index', metavar='FILE',
+                           help='also build a full-text index of the heading sections in FILE, merged with the '
+                                'existing index across runs (query it with SearchIndex.py)')
+    args = argparser.parse_args()
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
 
-    if len(sys.argv) < 2:
+    if args.input is None:
         print('Fatal Error: Input files need to be appointed.')
         sys.exit()
+    if args.output is not None and not os.path.isfile(args.input):
+        print('Fatal Error: --output requires a single input file.')
+        sys.exit()
+    if args.output == '-' and (args.compress or args.watch or args.search_index):
+        print('Fatal Error: Cannot compress, watch or build a search index when writing to stdout.')
+        sys.exit()
+    suffix = FORMAT_SUFFIXES[args.format]  # 输出文件的扩展名
+    if args.compress is not None:
+        suffix += '.' + args.compress
+    options = {'email_obfuscation': args.email_obfuscation, 'toc': args.toc,
+               'output_format': args.format}  # 构造转换器的参数
+    if args.large:
+        options['chunk_size'] = LARGE_CHUNK_SIZE
+        options['max_block'] = LARGE_MAX_BLOCK
+    if args.max_block is not None:
+        options['max_block'] = args.max_block
+    if args.search_index is not None:
+        options['sections'] = True
+    report = sys.stderr if args.output == '-' else sys.stdout  # 输出到标准输出时，提示信息改为打印到标准错误
 
     # 生成输入输出文件列表
-    if os.path.isfile(sys.argv[1]):  # 检查所给参数是不是有效的文件
-        input_files = [sys.argv[1]]
-        input_filename_split = sys.argv[1].rsplit('.', 1)  # rsplit从右向左切分字符串，参数意义是以'.'为切分点且只切分1次
-        output_files = [input_filename_split[0] + '.html']  # 输出文件为同名的.html文件
+    if os.path.isfile(args.input):  # 检查所给参数是不是有效的文件
+        input_files = [args.input]
+        input_filename_split = args.input.rsplit('.', 1)  # rsplit从右向左切分字符串，参数意义是以'.'为切分点且只切分1次
+        output_files = [input_filename_split[0] + suffix]  # 输出文件为同名的.html文件
+        if args.output is not None:
+            output_files = [args.output]
+        files = list(zip(input_files, output_files))
     else:  # 所给参数不是文件，可能是路径
+        if not os.path.isdir(args.input):  # input文件夹不存在
+            print('Fatal Error: Cannot find "%s" file or directory.' % args.input)
+            sys.exit()
+        walker = Walker(args.input, args.output_dir, suffix, args.include or DEFAULT_INCLUDES, args.exclude)
         try:
-            os.chdir(sys.argv[1])
-        except FileNotFoundError:  # input文件夹不存在
-            print('Fatal Error: Cannot find "%s" file or directory.' % sys.argv[1])
+            os.makedirs(args.output_dir, exist_ok=True)  # 如果没有输出目录则自动创建
+        except OSError as error:
+            print('Fatal Error: Cannot create output directory "%s": %s.' % (args.output_dir, error.strerror))
             sys.exit()
-        filenames = [f for f in os.listdir() if is_markdown_file(f)]  # 列出指定目录下所有Markdown文档的文件名
-        os.chdir('..')  # 回到原目录
-        # 输入文件名中需包含目录名sys.argv[1]
-        input_files = [sys.argv[1] + '/' + f for f in filenames]
-        # 如果没有output目录则自动创建
-        if not os.path.isdir('output'):
-            os.mkdir('output')
-        # 输出文件名中需包含目录名'output/'
-        output_files = ['output/' + f.rsplit('.', 1)[0] + '.html' for f in filenames]
+        if not args.link_index:
+            files, digests = None, None  # 边遍历边转换
+        else:  # 先预扫描全部文件建立站点链接索引，转换时据此改写文档之间的链接
+            start = time.perf_counter()
+            # 文档树中的链接同样指向HTML页面
+            options['link_index'] = LinkIndex(args.input, suffix if args.format == 'html' else '.html')
+            try:
+                files, digests = index_files(walker, options['link_index'])
+            except OSError as error:
+                print('Fatal Error: Cannot read directory "%s": %s.' % (args.input, error.strerror))
+                sys.exit()
+            print('Indexed %d document(s) with %d anchor(s) in %.1f ms.'
+                  % (len(options['link_index']), options['link_index'].anchors(), (time.perf_counter() - start) * 1000))
+        if args.incremental:  # 只转换新增或修改过的文件
+            manifest = Manifest(os.path.join(args.output_dir, '.md2html-manifest.json'), Parser(**options).fingerprint())
+            # 跳过的文件沿用原索引中的小节，原索引无法读取时全部重新转换
+            if args.search_index is not None and not search_index_readable(args.search_index):
+                manifest.invalidate()
+        files = stream_files(walker, manifest, pending, files, digests, fresh)
 
+    # 对输入文件进行转换
+    profile = ProfileStats() if args.profile is not None else None
+    sections = [] if args.search_index is not None else None  # 各文件各小节的词频
+    try:
+        results = convert_files(files, jobs, profile, options, sections)
+    except OSError as error:  # 输入目录在遍历开始前变得无法读取
+        print('Fatal Error: Cannot read directory "%s": %s.' % (args.input, error.strerror))
+        sys.exit()
+    success = sum(results)
+
+    if sections is not None:  # 合并全文检索索引
+        start = time.perf_counter()
+        base = os.path.dirname(os.path.abspath(args.search_index))
+        if os.path.isfile(args.input):  # 保留索引中其它文档
+            converted = [output_file for input_file, output_file in files]
+            stale = set(SearchIndex.document_path(output_file, base) for output_file in converted)
+            keep = lambda document: document not in stale
+        else:  # 只保留跳过的未修改文件，已删除或转换失败的文件从索引中去掉
+            converted = [output_file for input_file, output_file, digest in pending]
+            unchanged = set(SearchIndex.document_path(output_file, base) for input_file, output_file in fresh)
+            keep = lambda document: document in unchanged
+        documents = [(output_file, terms) for output_file, terms, result in zip(converted, sections, results) if result]
+        builder = update_search_index(args.search_index, documents, keep)
+        if builder is not None:
+            print('Search index: %d document(s), %d section(s), %d term(s) written to "%s" in %.1f ms.'
+                  % (len(builder), builder.section_count(), builder.term_count(), args.search_index,
+                     (time.perf_counter() - start) * 1000))
 
-    # 对输入文件列表中的文件依次进行转换
-    success = 0
-    for i in range(0, len(input_files)):
-#        print(input_files[i])
-        success += parser.parse(input_files[i], output_files[i])
+    if manifest is not None:  # 记录转换结果，转换失败的文件下次重新转换
+        for (input_file, output_file, digest), result in zip(pending, results):
+            if result:
+                manifest.update(input_file, output_file, digest)
+            else:
+                manifest.discard(input_file)
+        if sections is not None and builder is None:  # 全文检索索引未更新，下次全部重新转换
+            manifest.invalidate()
+        manifest.save()
 
 
     # 打印总结信息
     print('All finished: %d conversion(s) successed, %d conversion(s) failed.' 
-          % (success, len(input_files) - success))
+          % (success, len(results) - success), file=report)
+
+    if profile is not None:  # 输出性能剖析统计
+        if args.profile == '-':
+            profile.dump(report)
+        else:
+            try:
+                with open(args.profile, 'w', -1, 'utf-8') as fou:
+                    profile.dump(fou)
+            except OSError:
+                print('Error: I/O failure occurred when opening file "%s".' % args.profile)
+
+    if args.watch:  # 持续监视输入文件的变化
+        if os.path.isfile(args.input):
+            watch(lambda: [args.input], lambda f: output_files[0], options, None, args.search_index)
+        else:
+            watch(lambda: [input_file for input_file, output_file in walker.walk()],
+                  lambda f: walker.prepare(walker.output_of(f)), options, manifest, args.search_index)